@@ -0,0 +1,30 @@
+"""Benchmark of ffi.cdef() on a large declaration, without the cdef
+cache, then with it (the first call fills the cache, the next ones
+find the result there).
+"""
+import shutil, tempfile, time
+import cffi
+
+N = 5000
+
+csource = "".join("struct s%d { int a; double b; struct s%d *next; };\n"
+                  "typedef struct s%d s%d_t;\n"
+                  "int f%d(s%d_t *, const char *, ...);\n"
+                  "#define K%d %d\n" % ((i,) * 7 + (i,))
+                  for i in range(N))
+
+def bench(name, cache_dir):
+    ffi = cffi.FFI()
+    ffi.set_cdef_cache(cache_dir)
+    start = time.perf_counter()
+    ffi.cdef(csource)
+    print("%-20s %8.1f ms" % (name, (time.perf_counter() - start) * 1e3))
+
+cache_dir = tempfile.mkdtemp()
+try:
+    bench("no cache", None)
+    bench("cache miss", cache_dir)
+    bench("cache hit", cache_dir)
+    bench("cache hit", cache_dir)
+finally:
+    shutil.rmtree(cache_dir)
@@ -0,0 +1,29 @@
+"""Benchmark of ffi.cdef() on a large declaration made of plain function
+declarations, structs, typedefs and constants, parsed by the fast parser
+of the simple declarations and by pycparser.
+"""
+import time
+import cffi
+from cffi import cparser
+
+N = 5000
+
+csource = "".join("struct s%d { int a; double b; struct s%d *next; };\n"
+                  "typedef struct s%d s%d_t;\n"
+                  "int f%d(s%d_t *, const char *, ...);\n"
+                  "enum e%d { E%d_A, E%d_B = -1 };\n"
+                  "#define K%d %d\n" % ((i,) * 10 + (i,))
+                  for i in range(N))
+
+def bench(name, use_fast_parser):
+    cparser._use_fast_parser = use_fast_parser
+    best = float('inf')
+    for i in range(3):
+        ffi = cffi.FFI()
+        start = time.perf_counter()
+        ffi.cdef(csource)
+        best = min(best, time.perf_counter() - start)
+    print("%-20s %8.1f ms" % (name, best * 1e3))
+
+bench("pycparser", False)
+bench("fast parser", True)
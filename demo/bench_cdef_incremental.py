@@ -0,0 +1,20 @@
+"""Benchmark of bindings assembled from many small ffi.cdef() calls,
+each declaring a typedef and a function using the previous typedefs.
+The time per call should not grow with the number of calls.
+"""
+import time
+import cffi
+
+def run(n):
+    ffi = cffi.FFI()
+    start = time.perf_counter()
+    ffi.cdef("typedef int t0;")
+    for i in range(1, n):
+        ffi.cdef("typedef struct s%d { t%d a; } t%d; t%d f%d(t%d *);" % (
+            i, i - 1, i, i - 1, i, i))
+    return time.perf_counter() - start
+
+for n in [250, 500, 1000, 2000, 4000]:
+    elapsed = run(n)
+    print("%5d calls: %8.1f ms total, %6.1f us per call" % (
+        n, elapsed * 1e3, elapsed / n * 1e6))
@@ -0,0 +1,72 @@
+"""Benchmark of re-entrant calls: Python calls C, which calls back
+Python synchronously, many times.  Measures extern "Python" functions
+called from an API-mode function and from a function pointer, and an
+ffi.callback() passed to qsort().
+"""
+import sys, time
+import cffi
+
+ffi = cffi.FFI()
+
+ffi.cdef("""
+    int my_algo(int);
+    extern "Python" int f(int);
+    extern int (*my_algo_ptr)(int);
+    void qsort(void *, size_t, size_t, int(*)(const void *, const void *));
+""")
+
+ffi.set_source("_bench_extern_python_cffi", """
+    #include <stdlib.h>
+    static int f(int);
+    static int my_algo(int n) {
+        int i, sum = 0;
+        for (i = 0; i < n; i++)
+            sum += f(i);
+        return sum;
+    }
+    static int (*my_algo_ptr)(int) = my_algo;
+""")
+
+ffi.compile()
+
+
+sys.path.insert(0, ".")
+from _bench_extern_python_cffi import ffi, lib
+
+@ffi.def_extern()
+def f(n):
+    return n
+
+def compare_ints(a, b):
+    a = ffi.cast("int *", a)[0]
+    b = ffi.cast("int *", b)[0]
+    return (a > b) - (a < b)
+compare = ffi.callback("int(*)(const void *, const void *)", compare_ints)
+
+
+def bench(name, func, n_inner):
+    func()
+    best = float('inf')
+    for i in range(5):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print("%-40s %8.1f ns per round-trip" % (name, best / n_inner * 1e9))
+
+N = 1000000
+bench('extern "Python" from lib.my_algo()', lambda: lib.my_algo(N), N)
+bench('extern "Python" from lib.my_algo_ptr()', lambda: lib.my_algo_ptr(N), N)
+
+reversed_items = ffi.new("int[]", list(range(200000, 0, -1)))
+items = ffi.new("int[]", len(reversed_items))
+def do_qsort():
+    ffi.memmove(items, reversed_items, ffi.sizeof(items))
+    lib.qsort(items, len(items), ffi.sizeof("int"), compare)
+n_compare = []
+@ffi.callback("int(*)(const void *, const void *)")
+def counting_compare(a, b):
+    n_compare.append(1)
+    return compare_ints(a, b)
+ffi.memmove(items, reversed_items, ffi.sizeof(items))
+lib.qsort(items, len(items), ffi.sizeof("int"), counting_compare)
+bench('ffi.callback() from qsort()', do_qsort, len(n_compare))
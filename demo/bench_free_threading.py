@@ -0,0 +1,94 @@
+"""Benchmark of the scaling of common operations with the number of
+threads.  Only interesting on a free-threaded build of Python
+(python3.13t or later), where the threads really run in parallel.
+
+Prints, for each operation, the total throughput in millions of
+operations per second for 1, 2, 4, ... threads.
+"""
+import os, sys, time, threading
+import cffi
+
+N_STRUCTS = 500
+
+ffi = cffi.FFI()
+ffi.cdef("struct point { int x, y; };\n" +
+         "".join("struct s%d { int a; struct point p; };\n" % i
+                 for i in range(N_STRUCTS)))
+ffi.set_source("_bench_free_threading_cffi",
+               "struct point { int x, y; };\n" +
+               "".join("struct s%d { int a; struct point p; };\n" % i
+                       for i in range(N_STRUCTS)))
+ffi.compile()
+
+sys.path.insert(0, ".")
+from _bench_free_threading_cffi import ffi
+
+
+def op_new(n):
+    new = ffi.new
+    for i in range(n):
+        new("struct point *")
+
+def op_typeof(n):
+    typeof = ffi.typeof
+    for i in range(n):
+        typeof("struct point *")
+
+def op_slice(n):
+    p = ffi.new("int[]", 100)
+    for i in range(n):
+        p[10:20]
+
+def op_getattr(n):
+    p = ffi.new("struct s0 *")
+    for i in range(n):
+        p.p.x
+
+def run_threads(func, n_threads, n):
+    barrier = threading.Barrier(n_threads + 1)
+    def body():
+        barrier.wait()
+        func(n)
+    threads = [threading.Thread(target=body) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def main():
+    max_threads = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count()
+    counts = []
+    n_threads = 1
+    while n_threads <= max_threads:
+        counts.append(n_threads)
+        n_threads *= 2
+    gil = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print("GIL enabled: %s" % (gil,))
+    print("%-12s" % "threads" + "".join("%8d" % c for c in counts))
+
+    for name, func, n in [("new", op_new, 200000),
+                          ("typeof", op_typeof, 200000),
+                          ("slice", op_slice, 200000),
+                          ("getattr", op_getattr, 200000)]:
+        results = []
+        for n_threads in counts:
+            elapsed = run_threads(func, n_threads, n)
+            results.append(n * n_threads / elapsed / 1e6)
+        print("%-12s" % name + "".join("%8.2f" % r for r in results))
+
+    # first-access realization of the lazy struct types: every thread
+    # asks for all types, in a different order
+    n_threads = counts[-1]
+    def realize(n):
+        k = threading.get_ident()
+        for i in range(N_STRUCTS):
+            ffi.typeof("struct s%d" % ((i + k) % N_STRUCTS)).fields
+    elapsed = run_threads(realize, n_threads, 0)
+    print("realizing %d struct types in %d threads: %.1f ms" % (
+        N_STRUCTS, n_threads, elapsed * 1e3))
+
+if __name__ == '__main__':
+    main()
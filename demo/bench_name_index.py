@@ -0,0 +1,44 @@
+"""Benchmark of the first access to the names of a module with many
+globals and types: 'lib.X' and 'ffi.typeof("T")'.  Builds the module
+twice, with and without the hash tables emitted by the recompiler for
+the large sorted arrays of names.
+"""
+import sys, time
+import cffi
+from cffi import recompiler
+
+N = 15000
+
+cdef = "".join("int f%d(int); typedef struct s%d s%d_t;\n" % (i, i, i)
+               for i in range(N))
+source = "".join("static int f%d(int x) { return x; } "
+                 "typedef struct s%d s%d_t;\n" % (i, i, i)
+                 for i in range(N))
+sys.path.insert(0, ".")
+
+def build(module_name):
+    ffi = cffi.FFI()
+    ffi.cdef(cdef)
+    ffi.set_source(module_name, source)
+    ffi.compile()
+    mod = __import__(module_name)
+    return mod.ffi, mod.lib
+
+def bench(name, ffi, lib):
+    start = time.perf_counter()
+    for i in range(N):
+        getattr(lib, "f%d" % i)
+    middle = time.perf_counter()
+    for i in range(N):
+        ffi.typeof("s%d_t" % i)
+    end = time.perf_counter()
+    print("%-20s lib.f<i>: %6.1f ns   typeof('s<i>_t'): %6.1f ns" % (
+        name, (middle - start) / N * 1e9, (end - middle) / N * 1e9))
+
+min_size = recompiler.Recompiler.NAME_INDEX_MIN_SIZE
+recompiler.Recompiler.NAME_INDEX_MIN_SIZE = N + 1
+ffi1, lib1 = build("_bench_name_index_sorted_cffi")
+recompiler.Recompiler.NAME_INDEX_MIN_SIZE = min_size
+ffi2, lib2 = build("_bench_name_index_hashed_cffi")
+bench("binary search", ffi1, lib1)
+bench("hash index", ffi2, lib2)
@@ -0,0 +1,44 @@
+"""Benchmark of the generation of the C source of a module, without
+compiling it, for a large synthetic cdef.  Prints the time taken by
+ffi.cdef() and by the generation of the C source.
+
+Usage: python bench_recompiler.py [number of declarations]
+"""
+import sys, time, io
+import cffi
+from cffi.recompiler import make_c_source
+
+N_DECLS = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+
+def make_cdef(n):
+    # about n declarations, of all kinds
+    lines = []
+    for i in range(n // 6):
+        lines.append("typedef struct s%d { int a; double b[4]; struct s%d *next;"
+                     " const char *name; } s%d_t;" % (i, i, i))
+        lines.append("typedef int (*cb%d_t)(s%d_t *, long, void *);" % (i, i))
+        lines.append("enum e%d { E%d_A, E%d_B = %d, E%d_C };" % (i, i, i, i, i))
+        lines.append("int f%d(s%d_t *, cb%d_t, unsigned short, float);"
+                     % (i, i, i))
+        lines.append("extern s%d_t *g%d;" % (i, i))
+        lines.append("#define C%d %d" % (i, i))
+    return "\n".join(lines)
+
+cdef = make_cdef(N_DECLS)
+ffi = cffi.FFI()
+start = time.perf_counter()
+ffi.cdef(cdef)
+print("cdef() of %d declarations:       %6.2f s" % (N_DECLS,
+                                                    time.perf_counter() - start))
+
+def generate():
+    f = io.StringIO()
+    start = time.perf_counter()
+    make_c_source(ffi, "_bench_recompiler_cffi", "", f)
+    return time.perf_counter() - start, len(f.getvalue())
+
+best = float('inf')
+for i in range(3):
+    elapsed, size = generate()
+    best = min(best, elapsed)
+print("generation of %d KB of C:       %6.2f s" % (size // 1024, best))
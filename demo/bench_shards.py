@@ -0,0 +1,34 @@
+"""Benchmark of the compilation time of a module with many functions,
+in one C file or split with set_source(..., shards=N).  The shards are
+compiled in parallel, so the speed-up depends on the number of CPUs.
+
+Usage: python bench_shards.py [number of functions] [number of shards]
+"""
+import os, sys, time, shutil
+import cffi
+
+N_FUNCS = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+N_SHARDS = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+
+cdef = "".join("struct s%d { int a; double b; };\n"
+               "struct s%d f%d(struct s%d, int, long, const char *);\n"
+               % (i, i, i, i) for i in range(N_FUNCS))
+source = "".join("struct s%d { int a; double b; };\n"
+                 "static struct s%d f%d(struct s%d p, int x, long y, "
+                 "const char *z) { p.a += x + (int)y + z[0]; return p; }\n"
+                 % (i, i, i, i) for i in range(N_FUNCS))
+
+def build(shards):
+    tmpdir = '_bench_shards_%d' % shards
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    ffi = cffi.FFI()
+    ffi.cdef(cdef)
+    ffi.set_source("_bench_shards_cffi", source, shards=shards)
+    start = time.perf_counter()
+    ffi.compile(tmpdir=tmpdir)
+    return time.perf_counter() - start
+
+t1 = build(1)
+print("%d functions, one C file:  %6.1f s" % (N_FUNCS, t1))
+tn = build(N_SHARDS)
+print("%d functions, %d shards:  %6.1f s" % (N_FUNCS, N_SHARDS, tn))
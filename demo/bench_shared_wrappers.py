@@ -0,0 +1,64 @@
+"""Benchmark of set_source(..., shared_wrappers=True), with a module
+that wraps many functions of only a few different types.  Prints the
+compilation time, the size of the compiled module, and the time of a
+call, without and with shared wrappers.
+
+Usage: python bench_shared_wrappers.py [number of functions]
+"""
+import os, sys, time, shutil
+import cffi
+
+N_FUNCS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+SIGNATURES = [
+    ("int", "int x", "x + %d"),
+    ("double", "double x, double y", "x * y + %d"),
+    ("long", "const char *s, long n", "n + s[0] + %d"),
+    ("void", "void", ""),
+]
+
+cdef = []
+source = []
+for i in range(N_FUNCS):
+    restype, args, expr = SIGNATURES[i % len(SIGNATURES)]
+    cdef.append("%s f%d(%s);\n" % (restype, i, args))
+    if restype == "void":
+        body = ""
+    else:
+        body = "return " + expr % i + ";"
+    source.append("static %s f%d(%s) { %s }\n" % (restype, i, args, body))
+
+def build(shared_wrappers):
+    module_name = "_bench_shared_wrappers_%d_cffi" % shared_wrappers
+    tmpdir = '_bench_shared_wrappers_%d' % shared_wrappers
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    ffi = cffi.FFI()
+    ffi.cdef("".join(cdef))
+    ffi.set_source(module_name, "".join(source),
+                   shared_wrappers=shared_wrappers)
+    start = time.perf_counter()
+    so_file = ffi.compile(tmpdir=tmpdir)
+    elapsed = time.perf_counter() - start
+    sys.path.insert(0, tmpdir)
+    lib = __import__(module_name).lib
+    del sys.path[0]
+    return elapsed, os.path.getsize(so_file), lib
+
+def time_call(func, *args):
+    n = 1000000
+    best = float('inf')
+    for i in range(5):
+        start = time.perf_counter()
+        for j in range(n):
+            func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best / n * 1e9
+
+for shared_wrappers in [False, True]:
+    elapsed, size, lib = build(shared_wrappers)
+    print("shared_wrappers=%s:" % (shared_wrappers,))
+    print("    %d functions compiled in %.1f s, module size %d KB" % (
+        N_FUNCS, elapsed, size // 1024))
+    print("    %-30s %6.1f ns" % ("f0(42)", time_call(lib.f0, 42)))
+    print("    %-30s %6.1f ns" % ("f1(1.5, 2.5)", time_call(lib.f1, 1.5, 2.5)))
+    print("    %-30s %6.1f ns" % ("f2(b'x', 42)", time_call(lib.f2, b'x', 42)))
+    print("    %-30s %6.1f ns" % ("f3()", time_call(lib.f3)))
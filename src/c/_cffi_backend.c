@@ -12,6 +12,8 @@
 #include <stdint.h>
 #include <dlfcn.h>
 #include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
 #include <ffi.h>
 #include <sys/mman.h>
 #include "misc_thread_posix.h"
@@ -347,6 +349,7 @@ typedef struct {
     Py_ssize_t length;     /* same as CDataObject_own_length up to here */
     PyObject *origobj;
     PyObject *destructor;
+    int batched;           /* ffi.gc(..., batch=True) */
 } CDataObject_gcp;
 
 typedef struct {
@@ -354,8 +357,19 @@ typedef struct {
     ffi_closure *closure;
 } CDataObject_closure;
 
+#define CIF_FREE_CLOSURES   8
+
 typedef struct {
     ffi_cif cif;
+    /* callbacks of this function type: closures that have already been
+       prepared by ffi_prep_closure() and that are free.  The next
+       ffi.callback() can reuse them by just changing their 'user_data'
+       (see b_callback()).  Protected by the ctype's critical section. */
+    int num_free_closures;
+    struct {
+        ffi_closure *closure;
+        char *fnptr;
+    } free_closures[CIF_FREE_CLOSURES];
     /* the following information is used when doing the call:
        - a buffer of size 'exchange_size' is malloced
        - the arguments are converted from Python objects to raw data
@@ -366,6 +380,16 @@ typedef struct {
     Py_ssize_t exchange_offset_arg[1];
 } cif_description_t;
 
+static void free_callback_closure(ffi_closure *closure)
+{
+#if CFFI_CHECK_FFI_CLOSURE_ALLOC_MAYBE
+    if (CFFI_CHECK_FFI_CLOSURE_ALLOC) {
+        ffi_closure_free(closure);
+    } else
+#endif
+        cffi_closure_free(closure);
+}
+
 #define ADD_WRAPAROUND(x, y)  ((Py_ssize_t)(((size_t)(x)) + ((size_t)(y))))
 #define MUL_WRAPAROUND(x, y)  ((Py_ssize_t)(((size_t)(x)) * ((size_t)(y))))
 
@@ -469,8 +493,16 @@ ctypedescr_dealloc(CTypeDescrObject *ct)
     }
     Py_XDECREF(ct->ct_itemdescr);
     Py_XDECREF(ct->ct_stuff);
-    if (ct->ct_flags & CT_FUNCTIONPTR)
+    if (ct->ct_flags & CT_FUNCTIONPTR) {
+        cif_description_t *cif_descr = (cif_description_t *)ct->ct_extra;
+        if (cif_descr != NULL) {
+            while (cif_descr->num_free_closures > 0) {
+                int i = --cif_descr->num_free_closures;
+                free_callback_closure(cif_descr->free_closures[i].closure);
+            }
+        }
         PyObject_Free(ct->ct_extra);
+    }
     Py_TYPE(ct)->tp_free((PyObject *)ct);
 }
 
@@ -1939,6 +1971,35 @@ static void cdataowning_dealloc(CDataObject *cd)
     cdata_dealloc(cd);
 }
 
+static void invoke_callback(ffi_cif *cif, void *result, void **args,
+                            void *userdata);
+static void invoke_deferred_callback(ffi_cif *cif, void *result, void **args,
+                                     void *userdata);
+static Py_ssize_t discard_deferred_calls(void *userdata);
+
+static void release_callback_closure(CTypeDescrObject *ct,
+                                     ffi_closure *closure, char *fnptr)
+{
+    /* keep a few prepared closures per function type, for reuse.
+       Only closures for regular callbacks are reused: b_callback()
+       prepares a new closure for deferred callbacks. */
+    cif_description_t *cif_descr = (cif_description_t *)ct->ct_extra;
+    int kept = 0;
+
+    closure->user_data = NULL;
+    Py_BEGIN_CRITICAL_SECTION(ct);
+    if (closure->fun == invoke_callback &&
+            cif_descr->num_free_closures < CIF_FREE_CLOSURES) {
+        int i = cif_descr->num_free_closures++;
+        cif_descr->free_closures[i].closure = closure;
+        cif_descr->free_closures[i].fnptr = fnptr;
+        kept = 1;
+    }
+    Py_END_CRITICAL_SECTION();
+    if (!kept)
+        free_callback_closure(closure);
+}
+
 static void cdataowninggc_dealloc(CDataObject *cd)
 {
     PyObject_GC_UnTrack(cd);
@@ -1949,14 +2010,26 @@ static void cdataowninggc_dealloc(CDataObject *cd)
     }
     else if (cd->c_type->ct_flags & CT_FUNCTIONPTR) {   /* a callback */
         ffi_closure *closure = ((CDataObject_closure *)cd)->closure;
-        PyObject *args = (PyObject *)(closure->user_data);
-        Py_XDECREF(args);
-#if CFFI_CHECK_FFI_CLOSURE_ALLOC_MAYBE
-        if (CFFI_CHECK_FFI_CLOSURE_ALLOC) {
-            ffi_closure_free(closure);
-        } else
-#endif
-            cffi_closure_free(closure);
+        if (closure != NULL) {      /* NULL if b_callback() failed */
+            PyObject *args = (PyObject *)(closure->user_data);
+            if (args != NULL && closure->fun == invoke_deferred_callback) {
+                /* the calls still in the queue are discarded: we must
+                   not run the Python function from a deallocator */
+                Py_ssize_t n = discard_deferred_calls(args);
+                if (n > 0) {
+                    PyObject *t, *v, *tb;
+                    PyErr_Fetch(&t, &v, &tb);
+                    if (PyErr_WarnFormat(PyExc_RuntimeWarning, 1,
+                            "deferred callback freed with %zd queued "
+                            "call(s), which are discarded; call "
+                            "ffi.drain_callbacks() before", n) < 0)
+                        PyErr_WriteUnraisable(NULL);
+                    PyErr_Restore(t, v, tb);
+                }
+            }
+            Py_XDECREF(args);
+            release_callback_closure(cd->c_type, closure, cd->c_data);
+        }
     }
     else {
         Py_FatalError("cdata CDataOwningGC_Type with unexpected type flags");
@@ -2060,8 +2133,144 @@ static void gcp_finalize(PyObject *destructor, PyObject *origobj)
     Py_XDECREF(origobj);
 }
 
+/* ffi.gc(..., batch=True): when the cdata dies, the destructor (which
+   must be a C function pointer) is not called immediately.  Instead, it
+   is queued together with its argument.  The queue is flushed with the
+   GIL released: from a pending call that runs at the next safe point of
+   the main thread, from an atexit handler, or explicitly with
+   ffi.gc_flush().  This turns the death of a large graph of objects into
+   a few tight loops of C calls, instead of one Python-level call per
+   object.  The queue is never flushed from the deallocator, which would
+   run other destructors in the middle of it: instead, it grows as
+   needed.  After the atexit handler ran, nothing would flush the queue
+   any more, so the destructors are then called immediately. */
+
+#define GC_BATCH_SIZE   512     /* initial size of the queue */
+
+typedef struct {
+    void (*fn)(void *);
+    void *arg;
+    PyObject *destructor;    /* keeps 'fn' alive, e.g. if it's a callback */
+} gc_batch_entry_t;
+
+static gc_batch_entry_t *gc_batch_queue = NULL;
+static Py_ssize_t gc_batch_count = 0;
+static Py_ssize_t gc_batch_allocated = 0;
+static int gc_batch_scheduled = 0;
+static int gc_batch_exiting = 0;
+
+#ifdef Py_GIL_DISABLED
+static PyMutex gc_batch_lock;
+# define LOCK_GC_BATCH()   PyMutex_Lock(&gc_batch_lock)
+# define UNLOCK_GC_BATCH() PyMutex_Unlock(&gc_batch_lock)
+#else
+# define LOCK_GC_BATCH()   ((void)0)
+# define UNLOCK_GC_BATCH() ((void)0)
+#endif
+
+static Py_ssize_t gc_batch_flush(void)
+{
+    /* must be called with the GIL; returns the number of destructors
+       called */
+    gc_batch_entry_t *entries;
+    Py_ssize_t i, n, allocated;
+
+    /* take the whole queue: the destructors may queue more entries */
+    LOCK_GC_BATCH();
+    entries = gc_batch_queue;
+    n = gc_batch_count;
+    allocated = gc_batch_allocated;
+    gc_batch_queue = NULL;
+    gc_batch_count = 0;
+    gc_batch_allocated = 0;
+    UNLOCK_GC_BATCH();
+
+    if (n > 0) {
+        Py_BEGIN_ALLOW_THREADS
+        for (i = 0; i < n; i++)
+            entries[i].fn(entries[i].arg);
+        Py_END_ALLOW_THREADS
+        for (i = 0; i < n; i++)
+            Py_DECREF(entries[i].destructor);
+    }
+
+    /* reuse the array for the next entries, unless it grew larger than
+       the initial size or a new one was already allocated */
+    LOCK_GC_BATCH();
+    if (gc_batch_queue == NULL && allocated <= GC_BATCH_SIZE) {
+        gc_batch_queue = entries;
+        gc_batch_allocated = allocated;
+        entries = NULL;
+    }
+    UNLOCK_GC_BATCH();
+    PyMem_RawFree(entries);
+    return n;
+}
+
+static int gc_batch_pending_call(void *ignored)
+{
+    LOCK_GC_BATCH();
+    gc_batch_scheduled = 0;
+    UNLOCK_GC_BATCH();
+    gc_batch_flush();
+    return 0;
+}
+
+static void gc_batch_push(PyObject *destructor, void *arg)
+{
+    /* NOTE: this steals the reference to 'destructor' */
+    int schedule;
+    void (*fn)(void *) = (void (*)(void *))((CDataObject *)destructor)->c_data;
+
+    LOCK_GC_BATCH();
+    if (!gc_batch_exiting && gc_batch_count == gc_batch_allocated) {
+        /* the queue is full: make it larger */
+        Py_ssize_t allocated = gc_batch_allocated * 2;
+        gc_batch_entry_t *queue;
+        if (allocated < GC_BATCH_SIZE)
+            allocated = GC_BATCH_SIZE;
+        queue = (gc_batch_entry_t *)PyMem_RawRealloc(gc_batch_queue,
+                                     allocated * sizeof(gc_batch_entry_t));
+        if (queue != NULL) {
+            gc_batch_queue = queue;
+            gc_batch_allocated = allocated;
+        }
+    }
+    if (gc_batch_exiting || gc_batch_count == gc_batch_allocated) {
+        /* after the exit flush, or out of memory: call it now */
+        UNLOCK_GC_BATCH();
+        fn(arg);
+        Py_DECREF(destructor);
+        return;
+    }
+    gc_batch_queue[gc_batch_count].fn = fn;
+    gc_batch_queue[gc_batch_count].arg = arg;
+    gc_batch_queue[gc_batch_count].destructor = destructor;
+    gc_batch_count++;
+    schedule = !gc_batch_scheduled;
+    gc_batch_scheduled = 1;
+    UNLOCK_GC_BATCH();
+
+    if (schedule && Py_AddPendingCall(gc_batch_pending_call, NULL) < 0) {
+        /* CPython's queue of pending calls is full; try again with the
+           next destructor */
+        LOCK_GC_BATCH();
+        gc_batch_scheduled = 0;
+        UNLOCK_GC_BATCH();
+    }
+}
+
+static void gcp_finalize_batched(PyObject *destructor, PyObject *origobj)
+{
+    /* NOTE: this decrements the reference count of the two arguments */
+    if (destructor != NULL)
+        gc_batch_push(destructor, ((CDataObject *)origobj)->c_data);
+    Py_XDECREF(origobj);
+}
+
 static void cdatagcp_finalize(CDataObject_gcp *cd)
 {
+    /* called by ffi.release(): always calls the destructor now */
     PyObject *destructor = cd->destructor;
     PyObject *origobj = cd->origobj;
     cd->destructor = NULL;
@@ -2069,14 +2278,30 @@ static void cdatagcp_finalize(CDataObject_gcp *cd)
     gcp_finalize(destructor, origobj);
 }
 
+static void cdatagcp_tp_finalize(CDataObject_gcp *cd)
+{
+    PyObject *destructor = cd->destructor;
+    PyObject *origobj = cd->origobj;
+    cd->destructor = NULL;
+    cd->origobj = NULL;
+    if (cd->batched)
+        gcp_finalize_batched(destructor, origobj);
+    else
+        gcp_finalize(destructor, origobj);
+}
+
 static void cdatagcp_dealloc(CDataObject_gcp *cd)
 {
     PyObject *destructor = cd->destructor;
     PyObject *origobj = cd->origobj;
+    int batched = cd->batched;
     PyObject_GC_UnTrack(cd);
     cdata_dealloc((CDataObject *)cd);
 
-    gcp_finalize(destructor, origobj);
+    if (batched)
+        gcp_finalize_batched(destructor, origobj);
+    else
+        gcp_finalize(destructor, origobj);
 }
 
 static int cdatagcp_traverse(CDataObject_gcp *cd, visitproc visit, void *arg)
@@ -2576,14 +2801,19 @@ cdata_slice(CDataObject *cd, PySliceObject *slice)
     CTypeDescrObject *ct = _cdata_getslicearg(cd, slice, bounds);
     if (ct == NULL)
         return NULL;
-    CTypeDescrObject *array_type = NULL;
-    Py_BEGIN_CRITICAL_SECTION(ct);
-    array_type = (CTypeDescrObject *)ct->ct_stuff;
-    if (ct->ct_stuff == NULL) {
-        array_type = (CTypeDescrObject *)new_array_type(ct, -1);
-        ct->ct_stuff = (PyObject *)array_type;
+    /* the array type is cached in ct->ct_stuff, which is only set
+       once: read it without locking, and lock only to create it */
+    CTypeDescrObject *array_type =
+        (CTypeDescrObject *)cffi_load_ptr(ct->ct_stuff);
+    if (array_type == NULL) {
+        Py_BEGIN_CRITICAL_SECTION(ct);
+        array_type = (CTypeDescrObject *)ct->ct_stuff;
+        if (array_type == NULL) {
+            array_type = (CTypeDescrObject *)new_array_type(ct, -1);
+            cffi_store_ptr(ct->ct_stuff, (PyObject *)array_type);
+        }
+        Py_END_CRITICAL_SECTION();
     }
-    Py_END_CRITICAL_SECTION();
 
     if (array_type == NULL) {
         return NULL;
@@ -3041,48 +3271,100 @@ _prepare_pointer_call_argument(CTypeDescrObject *ctptr, PyObject *init,
     return convert_from_object((char *)output_data, ctptr, init);
 }
 
-static PyObject*
-cdata_call(CDataObject *cd, PyObject *args, PyObject *kwds)
+/* Re-entrant callbacks.  cffi_enter_c_call() and cffi_leave_c_call()
+   are called around the C calls done with the GIL released, by
+   cdata_call() and by the _cffi_f_ wrappers of out-of-line modules
+   (as the exported functions _cffi_restore_errno and _cffi_save_errno).
+   If the C code calls back into Python synchronously, the first
+   callback gets its PyThreadState with gil_ensure() and remembers it
+   for the current nesting level of C calls.  The following callbacks
+   from the same C call only need to call PyEval_RestoreThread() and
+   PyEval_SaveThread().  The PyThreadState cannot go away in the
+   meantime, because the Python frame that did the C call is still
+   running in it.
+*/
+#ifdef USE__THREAD
+static __thread int cffi_c_call_depth = 0;
+static __thread int cffi_reentrant_depth = 0;
+static __thread PyThreadState *cffi_reentrant_tstate = NULL;
+
+static void cffi_enter_c_call(void)
+{
+    cffi_c_call_depth++;
+    restore_errno();
+}
+
+static void cffi_leave_c_call(void)
 {
-    char *buffer;
-    void** buffer_array;
-    cif_description_t *cif_descr;
-    Py_ssize_t i, nargs, nargs_declared;
-    PyObject *signature, *res = NULL, *fvarargs;
-    CTypeDescrObject *fresult;
-    char *resultdata;
-    char *errormsg;
-    struct freeme_s {
-        struct freeme_s *next;
-        union_alignment alignment;
-    } *freeme = NULL;
+    save_errno();
+    if (cffi_reentrant_depth == cffi_c_call_depth)
+        cffi_reentrant_tstate = NULL;
+    cffi_c_call_depth--;
+}
+
+static PyThreadState *cffi_get_reentrant_tstate(void)
+{
+    if (cffi_reentrant_depth != cffi_c_call_depth)
+        return NULL;
+    return cffi_reentrant_tstate;   /* NULL if depth is 0 */
+}
+
+static void cffi_set_reentrant_tstate(PyGILState_STATE state)
+{
+    /* called with the GIL, after gil_ensure() returned 'state' */
+    if (state == PyGILState_UNLOCKED && cffi_c_call_depth > 0) {
+        cffi_reentrant_depth = cffi_c_call_depth;
+        cffi_reentrant_tstate = get_current_ts();
+    }
+}
+#else
+# define cffi_enter_c_call             restore_errno
+# define cffi_leave_c_call             save_errno
+# define cffi_get_reentrant_tstate()   ((PyThreadState *)NULL)
+# define cffi_set_reentrant_tstate(state)   ((void)0)
+#endif
 
+struct freeme_s {
+    struct freeme_s *next;
+    union_alignment alignment;
+};
+
+static int _check_callable_cdata(CDataObject *cd)
+{
     if (!(cd->c_type->ct_flags & CT_FUNCTIONPTR)) {
         PyErr_Format(PyExc_TypeError, "cdata '%s' is not callable",
                      cd->c_type->ct_name);
-        return NULL;
+        return -1;
     }
     if (cd->c_data == NULL) {
         PyErr_Format(PyExc_RuntimeError,
                      "cannot call null pointer pointer from cdata '%s'",
                      cd->c_type->ct_name);
-        return NULL;
-    }
-    if (kwds != NULL && PyDict_Size(kwds) != 0) {
-        PyErr_SetString(PyExc_TypeError,
-                "a cdata function cannot be called with keyword arguments");
-        return NULL;
+        return -1;
     }
-    signature = cd->c_type->ct_stuff;
-    nargs = PyTuple_Size(args);
-    if (nargs < 0)
-        return NULL;
-    nargs_declared = PyTuple_GET_SIZE(signature) - 2;
-    fresult = (CTypeDescrObject *)PyTuple_GET_ITEM(signature, 1);
-    fvarargs = NULL;
-    buffer = NULL;
+    return 0;
+}
+
+static cif_description_t *
+_prepare_call_cif(CTypeDescrObject *ct, Py_ssize_t nargs, PyObject *args,
+                  PyObject **p_fvarargs)
+{
+    /* Returns the cif_description_t to use to call a function of type
+       'ct' with the given arguments.  If the function is variadic,
+       '*p_fvarargs' is set to a new tuple of the argument types, and
+       the returned cif_description_t must be freed with PyObject_Free().
+    */
+    PyObject *signature = ct->ct_stuff;
+    PyObject *fvarargs;
+    CTypeDescrObject *fresult;
+    cif_description_t *cif_descr;
+    Py_ssize_t i, nargs_declared;
+    char *errormsg;
+    ffi_abi fabi;
 
-    cif_descr = (cif_description_t *)cd->c_type->ct_extra;
+    nargs_declared = PyTuple_GET_SIZE(signature) - 2;
+    *p_fvarargs = NULL;
+    cif_descr = (cif_description_t *)ct->ct_extra;
 
     if (cif_descr != NULL) {
         /* regular case: this function does not take '...' arguments */
@@ -3090,58 +3372,122 @@ cdata_call(CDataObject *cd, PyObject *args, PyObject *kwds)
             errormsg = "'%s' expects %zd arguments, got %zd";
           bad_number_of_arguments:
             PyErr_Format(PyExc_TypeError, errormsg,
-                         cd->c_type->ct_name, nargs_declared, nargs);
-            goto error;
+                         ct->ct_name, nargs_declared, nargs);
+            return NULL;
         }
+        return cif_descr;
     }
-    else {
-        /* call of a variadic function */
-        ffi_abi fabi;
-        if (nargs < nargs_declared) {
-            errormsg = "'%s' expects at least %zd arguments, got %zd";
-            goto bad_number_of_arguments;
-        }
-        fvarargs = PyTuple_New(nargs);
-        if (fvarargs == NULL)
-            goto error;
-        for (i = 0; i < nargs_declared; i++) {
-            PyObject *o = PyTuple_GET_ITEM(signature, 2 + i);
-            Py_INCREF(o);
-            PyTuple_SET_ITEM(fvarargs, i, o);
-        }
-        for (i = nargs_declared; i < nargs; i++) {
-            PyObject *obj = PyTuple_GET_ITEM(args, i);
-            CTypeDescrObject *ct;
-
-            if (CData_Check(obj)) {
-                ct = ((CDataObject *)obj)->c_type;
-                if (ct->ct_flags & (CT_PRIMITIVE_CHAR | CT_PRIMITIVE_UNSIGNED |
-                                    CT_PRIMITIVE_SIGNED)) {
-                    if (ct->ct_size < (Py_ssize_t)sizeof(int)) {
-                        ct = _get_ct_int();
-                        if (ct == NULL)
-                            goto error;
-                    }
-                }
-                else if (ct->ct_flags & CT_ARRAY) {
-                    ct = (CTypeDescrObject *)ct->ct_stuff;
+
+    /* call of a variadic function */
+    if (nargs < nargs_declared) {
+        errormsg = "'%s' expects at least %zd arguments, got %zd";
+        goto bad_number_of_arguments;
+    }
+    fvarargs = PyTuple_New(nargs);
+    if (fvarargs == NULL)
+        return NULL;
+    for (i = 0; i < nargs_declared; i++) {
+        PyObject *o = PyTuple_GET_ITEM(signature, 2 + i);
+        Py_INCREF(o);
+        PyTuple_SET_ITEM(fvarargs, i, o);
+    }
+    for (i = nargs_declared; i < nargs; i++) {
+        PyObject *obj = PyTuple_GET_ITEM(args, i);
+        CTypeDescrObject *ct1;
+
+        if (CData_Check(obj)) {
+            ct1 = ((CDataObject *)obj)->c_type;
+            if (ct1->ct_flags & (CT_PRIMITIVE_CHAR | CT_PRIMITIVE_UNSIGNED |
+                                 CT_PRIMITIVE_SIGNED)) {
+                if (ct1->ct_size < (Py_ssize_t)sizeof(int)) {
+                    ct1 = _get_ct_int();
+                    if (ct1 == NULL)
+                        goto error;
                 }
-                Py_INCREF(ct);
             }
-            else {
-                PyErr_Format(PyExc_TypeError,
-                             "argument %zd passed in the variadic part "
-                             "needs to be a cdata object (got %.200s)",
-                             i + 1, Py_TYPE(obj)->tp_name);
-                goto error;
+            else if (ct1->ct_flags & CT_ARRAY) {
+                ct1 = (CTypeDescrObject *)ct1->ct_stuff;
             }
-            PyTuple_SET_ITEM(fvarargs, i, (PyObject *)ct);
+            Py_INCREF(ct1);
         }
-        fabi = PyLong_AS_LONG(PyTuple_GET_ITEM(signature, 0));
-        cif_descr = fb_prepare_cif(fvarargs, fresult, nargs_declared, fabi);
-        if (cif_descr == NULL)
+        else {
+            PyErr_Format(PyExc_TypeError,
+                         "argument %zd passed in the variadic part "
+                         "needs to be a cdata object (got %.200s)",
+                         i + 1, Py_TYPE(obj)->tp_name);
             goto error;
+        }
+        PyTuple_SET_ITEM(fvarargs, i, (PyObject *)ct1);
+    }
+    fresult = (CTypeDescrObject *)PyTuple_GET_ITEM(signature, 1);
+    fabi = PyLong_AS_LONG(PyTuple_GET_ITEM(signature, 0));
+    cif_descr = fb_prepare_cif(fvarargs, fresult, nargs_declared, fabi);
+    if (cif_descr == NULL)
+        goto error;
+    *p_fvarargs = fvarargs;
+    return cif_descr;
+
+ error:
+    Py_DECREF(fvarargs);
+    return NULL;
+}
+
+static PyObject *_convert_call_result(char *resultdata,
+                                      CTypeDescrObject *fresult)
+{
+    if (fresult->ct_flags & (CT_PRIMITIVE_CHAR | CT_PRIMITIVE_SIGNED |
+                             CT_PRIMITIVE_UNSIGNED)) {
+#ifdef WORDS_BIGENDIAN
+        /* For results of precisely these types, libffi has a strange
+           rule that they will be returned as a whole 'ffi_arg' if they
+           are smaller.  The difference only matters on big-endian. */
+        if (fresult->ct_size < sizeof(ffi_arg))
+            resultdata += (sizeof(ffi_arg) - fresult->ct_size);
+#endif
+        return convert_to_object(resultdata, fresult);
+    }
+    else if (fresult->ct_flags & CT_VOID) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    else if (fresult->ct_flags & CT_STRUCT) {
+        return convert_struct_to_owning_object(resultdata, fresult);
+    }
+    else {
+        return convert_to_object(resultdata, fresult);
+    }
+}
+
+static PyObject*
+cdata_call(CDataObject *cd, PyObject *args, PyObject *kwds)
+{
+    char *buffer;
+    void** buffer_array;
+    cif_description_t *cif_descr;
+    Py_ssize_t i, nargs, nargs_declared;
+    PyObject *signature, *res = NULL, *fvarargs;
+    CTypeDescrObject *fresult;
+    char *resultdata;
+    struct freeme_s *freeme = NULL;
+
+    if (_check_callable_cdata(cd) < 0)
+        return NULL;
+    if (kwds != NULL && PyDict_Size(kwds) != 0) {
+        PyErr_SetString(PyExc_TypeError,
+                "a cdata function cannot be called with keyword arguments");
+        return NULL;
     }
+    signature = cd->c_type->ct_stuff;
+    nargs = PyTuple_Size(args);
+    if (nargs < 0)
+        return NULL;
+    nargs_declared = PyTuple_GET_SIZE(signature) - 2;
+    fresult = (CTypeDescrObject *)PyTuple_GET_ITEM(signature, 1);
+    buffer = NULL;
+
+    cif_descr = _prepare_call_cif(cd->c_type, nargs, args, &fvarargs);
+    if (cif_descr == NULL)
+        return NULL;
 
     buffer = PyObject_Malloc(cif_descr->exchange_size);
     if (buffer == NULL) {
@@ -3201,33 +3547,13 @@ cdata_call(CDataObject *cd, PyObject *args, PyObject *kwds)
     /*READ(cd->c_data, sizeof(void(*)(void)))*/
 
     Py_BEGIN_ALLOW_THREADS
-    restore_errno();
+    cffi_enter_c_call();
     ffi_call(&cif_descr->cif, CFFI_CLOSURE_TO_FNPTR(void (*)(void), cd->c_data),
              resultdata, buffer_array);
-    save_errno();
+    cffi_leave_c_call();
     Py_END_ALLOW_THREADS
 
-    if (fresult->ct_flags & (CT_PRIMITIVE_CHAR | CT_PRIMITIVE_SIGNED |
-                             CT_PRIMITIVE_UNSIGNED)) {
-#ifdef WORDS_BIGENDIAN
-        /* For results of precisely these types, libffi has a strange
-           rule that they will be returned as a whole 'ffi_arg' if they
-           are smaller.  The difference only matters on big-endian. */
-        if (fresult->ct_size < sizeof(ffi_arg))
-            resultdata += (sizeof(ffi_arg) - fresult->ct_size);
-#endif
-        res = convert_to_object(resultdata, fresult);
-    }
-    else if (fresult->ct_flags & CT_VOID) {
-        res = Py_None;
-        Py_INCREF(res);
-    }
-    else if (fresult->ct_flags & CT_STRUCT) {
-        res = convert_struct_to_owning_object(resultdata, fresult);
-    }
-    else {
-        res = convert_to_object(resultdata, fresult);
-    }
+    res = _convert_call_result(resultdata, fresult);
     /* fall-through */
 
  error:
@@ -3240,8 +3566,7 @@ cdata_call(CDataObject *cd, PyObject *args, PyObject *kwds)
         PyObject_Free(buffer);
     if (fvarargs != NULL) {
         Py_DECREF(fvarargs);
-        if (cif_descr != NULL)  /* but only if fvarargs != NULL, if variadic */
-            PyObject_Free(cif_descr);
+        PyObject_Free(cif_descr);  /* only if variadic */
     }
     return res;
 }
@@ -3627,7 +3952,7 @@ static PyTypeObject CDataGCP_Type = {
     0,                                          /* tp_weaklist */
     0,                                          /* tp_del */
     0,                                          /* version_tag */
-    (destructor)cdatagcp_finalize,              /* tp_finalize */
+    (destructor)cdatagcp_tp_finalize,           /* tp_finalize */
 #endif
 };
 
@@ -3777,6 +4102,11 @@ static CDataObject *allocate_gcp_object(CDataObject *origobj,
     cd->head.c_weakreflist = NULL;
     cd->origobj = (PyObject *)origobj;
     cd->destructor = destructor;
+    cd->batched = 0;
+    if (origobj->c_type == ct && (ct->ct_flags & CT_ARRAY))
+        cd->length = get_array_length(origobj);  /* ffi.gc() on 'T[]' */
+    else
+        cd->length = 0;   /* overwritten by direct_newp() if needed */
 
     PyObject_GC_Track(cd);
     return (CDataObject *)cd;
@@ -5945,6 +6275,7 @@ static cif_description_t *fb_prepare_cif(PyObject *fargs,
     assert(funcbuffer.bufferp == buffer + funcbuffer.nb_bytes);
 
     cif_descr = (cif_description_t *)buffer;
+    cif_descr->num_free_closures = 0;
 
     /* use `ffi_prep_cif_var` if necessary and available */
 #if CFFI_CHECK_FFI_PREP_CIF_VAR_MAYBE
@@ -6289,38 +6620,690 @@ static void general_invoke_callback(int decode_args_from_libffi,
 static void invoke_callback(ffi_cif *cif, void *result, void **args,
                             void *userdata)
 {
+    PyThreadState *ts;
     save_errno();
-    {
+    ts = cffi_get_reentrant_tstate();
+    if (ts == NULL) {
         PyGILState_STATE state = gil_ensure();
+        cffi_set_reentrant_tstate(state);
         general_invoke_callback(1, result, (char *)args, userdata);
         gil_release(state);
     }
+    else if (ts != get_current_ts()) {
+        /* fast path: called from inside a C call done by this thread */
+        PyEval_RestoreThread(ts);
+        general_invoke_callback(1, result, (char *)args, userdata);
+        PyEval_SaveThread();
+    }
+    else {
+        /* the C code took the GIL again itself */
+        general_invoke_callback(1, result, (char *)args, userdata);
+    }
     restore_errno();
 }
 
-static PyObject *prepare_callback_info_tuple(CTypeDescrObject *ct,
-                                             PyObject *ob,
-                                             PyObject *error_ob,
-                                             PyObject *onerror_ob,
-                                             int decode_args_from_libffi)
+/* ffi.callback(..., deferred=True): the C-level callback does not take
+   the GIL.  It only copies the arguments into a queue and returns.  The
+   Python function is called later, from the main thread at the next
+   point where it runs "pending calls", or from ffi.drain_callbacks().
+   All the calls queued so far are then done with a single GIL
+   acquisition.  The queue is protected by a plain OS lock, held only
+   for a few instructions.  If it grows too large, the C thread falls
+   back to taking the GIL and doing the calls itself.
+
+   The first call queued after a drain also writes a byte to each file
+   descriptor registered with add_callbacks_wakeup_fd().  This is used
+   by cffi.aio to wake up the event loops, which may be sleeping in
+   select() or similar and so not running the pending calls; there is
+   one descriptor per event loop.  The writes are done with the lock
+   held, so that after remove_callbacks_wakeup_fd() returns, no thread
+   can still write to the removed descriptor and it can be closed.
+*/
+
+typedef struct deferred_call_s {
+    struct deferred_call_s *dc_next;
+    void *dc_userdata;          /* the 'infotuple' of the callback */
+    void **dc_args;             /* points inside the same malloced block */
+    /* if not NULL, called instead of the callback; it frees 'dc' */
+    void (*dc_complete)(struct deferred_call_s *dc);
+    /* followed by the array of 'nargs' pointers, then the arguments */
+} deferred_call_t;
+
+#define DEFERRED_CALLS_MAX   65536
+
+static PyThread_type_lock deferred_lock = NULL;
+static deferred_call_t *deferred_head = NULL;
+static deferred_call_t **deferred_tail = &deferred_head;
+static Py_ssize_t deferred_count = 0;
+static int deferred_scheduled = 0;
+static int *deferred_wakeup_fds = NULL;
+static int deferred_num_wakeup_fds = 0;
+
+static deferred_call_t *new_deferred_call(ffi_cif *cif, void **args,
+                                          void *userdata)
+{
+    /* no GIL here: only use malloc() */
+    unsigned int i;
+    size_t size = sizeof(deferred_call_t) + cif->nargs * sizeof(void *);
+    deferred_call_t *dc;
+    char *p;
+
+    for (i = 0; i < cif->nargs; i++) {
+        ffi_type *t = cif->arg_types[i];
+        size_t align = t->alignment > 0 ? t->alignment : 1;
+        size = (size + align - 1) & ~(align - 1);
+        size += t->size;
+    }
+    dc = (deferred_call_t *)malloc(size);
+    if (dc == NULL)
+        return NULL;
+    dc->dc_next = NULL;
+    dc->dc_userdata = userdata;
+    dc->dc_complete = NULL;
+    dc->dc_args = (void **)(dc + 1);
+    p = (char *)(dc->dc_args + cif->nargs);
+    for (i = 0; i < cif->nargs; i++) {
+        ffi_type *t = cif->arg_types[i];
+        size_t align = t->alignment > 0 ? t->alignment : 1;
+        p = (char *)dc + ((p - (char *)dc + align - 1) & ~(align - 1));
+        memcpy(p, args[i], t->size);
+        dc->dc_args[i] = p;
+        p += t->size;
+    }
+    return dc;
+}
+
+static deferred_call_t *take_deferred_calls(void *only_userdata)
+{
+    /* remove from the queue and return the list of calls.  If
+       'only_userdata' is not NULL, only the calls to this particular
+       callback. */
+    deferred_call_t *dc, *list = NULL, **plist = &list, **pp;
+
+    if (deferred_lock == NULL)
+        return NULL;
+    PyThread_acquire_lock(deferred_lock, WAIT_LOCK);
+    if (only_userdata == NULL)
+        deferred_scheduled = 0;
+    pp = &deferred_head;
+    while ((dc = *pp) != NULL) {
+        if (only_userdata == NULL || dc->dc_userdata == only_userdata) {
+            *pp = dc->dc_next;      /* move 'dc' to the end of 'list' */
+            dc->dc_next = NULL;
+            *plist = dc;
+            plist = &dc->dc_next;
+            deferred_count--;
+        }
+        else
+            pp = &dc->dc_next;
+    }
+    deferred_tail = pp;
+    PyThread_release_lock(deferred_lock);
+    return list;
+}
+
+static Py_ssize_t drain_deferred_calls(void)
 {
-    CTypeDescrObject *ctresult;
-    PyObject *py_rawerr, *infotuple;
-    Py_ssize_t size;
+    /* must be called with the GIL */
+    deferred_call_t *dc, *list = take_deferred_calls(NULL);
+    Py_ssize_t n = 0;
+    ffi_arg result[4];   /* ignored, the callbacks return void */
 
-    if (!(ct->ct_flags & CT_FUNCTIONPTR)) {
-        PyErr_Format(PyExc_TypeError, "expected a function ctype, got '%s'",
-                     ct->ct_name);
-        return NULL;
+    /* the calls are no longer in the queue, so freeing a callback from
+       one of them would not discard the others: keep the 'infotuple'
+       of each one alive until it has been called */
+    for (dc = list; dc != NULL; dc = dc->dc_next) {
+        if (dc->dc_complete == NULL)
+            Py_INCREF((PyObject *)dc->dc_userdata);
     }
-    if (!PyCallable_Check(ob)) {
-        PyErr_Format(PyExc_TypeError,
-                     "expected a callable object, not %.200s",
-                     Py_TYPE(ob)->tp_name);
-        return NULL;
+    while (list != NULL) {
+        dc = list;
+        list = dc->dc_next;
+        if (dc->dc_complete != NULL) {
+            dc->dc_complete(dc);
+        }
+        else {
+            general_invoke_callback(1, result, (char *)dc->dc_args,
+                                    dc->dc_userdata);
+            Py_DECREF((PyObject *)dc->dc_userdata);
+            free(dc);
+        }
+        n++;
     }
-    if (onerror_ob != Py_None && !PyCallable_Check(onerror_ob)) {
-        PyErr_Format(PyExc_TypeError,
+    return n;
+}
+
+static Py_ssize_t discard_deferred_calls(void *userdata)
+{
+    deferred_call_t *dc, *list = take_deferred_calls(userdata);
+    Py_ssize_t n = 0;
+
+    while (list != NULL) {
+        dc = list;
+        list = dc->dc_next;
+        free(dc);
+        n++;
+    }
+    return n;
+}
+
+static int deferred_pending_call(void *ignored)
+{
+    drain_deferred_calls();
+    return 0;
+}
+
+static int queue_deferred_call(deferred_call_t *dc)
+{
+    /* no GIL here.  Returns 0 if the queue is full. */
+    int schedule;
+
+    PyThread_acquire_lock(deferred_lock, WAIT_LOCK);
+    if (deferred_count >= DEFERRED_CALLS_MAX) {
+        PyThread_release_lock(deferred_lock);
+        return 0;
+    }
+    *deferred_tail = dc;
+    deferred_tail = &dc->dc_next;
+    deferred_count++;
+    schedule = !deferred_scheduled;
+    deferred_scheduled = 1;
+#ifndef MS_WIN32
+    if (schedule) {
+        int i;
+        for (i = 0; i < deferred_num_wakeup_fds; i++) {
+            /* errors are ignored: if the pipe is full, there is already
+               a wakeup pending */
+            ssize_t ignored = write(deferred_wakeup_fds[i], "", 1);
+            (void)ignored;
+        }
+    }
+#endif
+    PyThread_release_lock(deferred_lock);
+
+    if (schedule) {
+        if (Py_AddPendingCall(deferred_pending_call, NULL) < 0) {
+            /* CPython's queue of pending calls is full; try again with
+               the next deferred call */
+            PyThread_acquire_lock(deferred_lock, WAIT_LOCK);
+            deferred_scheduled = 0;
+            PyThread_release_lock(deferred_lock);
+        }
+    }
+    return 1;
+}
+
+static void invoke_deferred_callback(ffi_cif *cif, void *result,
+                                     void **args, void *userdata)
+{
+    int saved_errno = errno;
+    deferred_call_t *dc = new_deferred_call(cif, args, userdata);
+
+    if (dc == NULL || !queue_deferred_call(dc)) {
+        /* the queue is full, or out of memory: do the call now, after
+           all the calls already queued */
+        PyGILState_STATE state;
+        free(dc);
+        save_errno();
+        state = gil_ensure();
+        drain_deferred_calls();
+        general_invoke_callback(1, result, (char *)args, userdata);
+        gil_release(state);
+        restore_errno();
+        return;
+    }
+    errno = saved_errno;
+}
+
+#ifndef MS_WIN32
+static PyObject *b_add_callbacks_wakeup_fd(PyObject *self, PyObject *args)
+{
+    int fd, *fds;
+    if (!PyArg_ParseTuple(args, "i:add_callbacks_wakeup_fd", &fd))
+        return NULL;
+    if (fd < 0) {
+        PyErr_SetString(PyExc_ValueError, "invalid file descriptor");
+        return NULL;
+    }
+    PyThread_acquire_lock(deferred_lock, WAIT_LOCK);
+    fds = (int *)realloc(deferred_wakeup_fds,
+                         (deferred_num_wakeup_fds + 1) * sizeof(int));
+    if (fds != NULL) {
+        fds[deferred_num_wakeup_fds++] = fd;
+        deferred_wakeup_fds = fds;
+    }
+    PyThread_release_lock(deferred_lock);
+    if (fds == NULL)
+        return PyErr_NoMemory();
+    Py_RETURN_NONE;
+}
+
+static PyObject *b_remove_callbacks_wakeup_fd(PyObject *self, PyObject *args)
+{
+    int fd, i, found = 0;
+    if (!PyArg_ParseTuple(args, "i:remove_callbacks_wakeup_fd", &fd))
+        return NULL;
+    PyThread_acquire_lock(deferred_lock, WAIT_LOCK);
+    for (i = 0; i < deferred_num_wakeup_fds; i++) {
+        if (deferred_wakeup_fds[i] == fd) {
+            deferred_wakeup_fds[i] =
+                deferred_wakeup_fds[--deferred_num_wakeup_fds];
+            found = 1;
+            break;
+        }
+    }
+    PyThread_release_lock(deferred_lock);
+    if (!found) {
+        PyErr_SetString(PyExc_ValueError, "file descriptor not registered");
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+#endif
+
+static PyObject *b_drain_callbacks(PyObject *self, PyObject *noarg)
+{
+    return PyLong_FromSsize_t(drain_deferred_calls());
+}
+
+/* offload_call(fn, args, on_done): do the call to the C function 'fn'
+   in a pool of native threads.  The arguments are converted here, with
+   the GIL.  The worker thread only does the ffi_call(), never taking
+   the GIL, and then queues its completion like a deferred callback.
+   When it runs, the result is converted and 'on_done(result, None)' is
+   called; if the conversion fails, 'on_done(None, exception)' is called
+   instead.  The objects in 'args' are kept alive until then.
+
+   The pool starts threads on demand, up to the number given to
+   set_offload_threads().  Idle workers are stacked in 'offload_idle',
+   each one sleeping on its own lock.
+
+   After fork(), the worker threads do not exist in the child process:
+   offload_after_fork_child() forgets about them, so that the child
+   starts new ones.  The jobs that were queued or running at the time
+   of the fork are never completed in the child.
+*/
+
+typedef struct offload_job_s {
+    deferred_call_t oj_dc;      /* must be first */
+    struct offload_job_s *oj_next;
+    cif_description_t *oj_cif;
+    char *oj_buffer;            /* the exchange buffer, as in cdata_call() */
+    struct freeme_s *oj_freeme;
+    PyObject *oj_fvarargs;      /* if variadic, see _prepare_call_cif() */
+    CDataObject *oj_fn;
+    PyObject *oj_args;
+    PyObject *oj_on_done;
+} offload_job_t;
+
+typedef struct offload_worker_s {
+    struct offload_worker_s *ow_next_idle;
+    PyThread_type_lock ow_lock;     /* released to wake up the worker */
+    offload_job_t *ow_job;
+} offload_worker_t;
+
+#define OFFLOAD_DEFAULT_THREADS   4
+
+static PyThread_type_lock offload_lock = NULL;
+static offload_job_t *offload_head = NULL;
+static offload_job_t **offload_tail = &offload_head;
+static offload_worker_t *offload_idle = NULL;
+static int offload_num_threads = 0;
+static int offload_max_threads = OFFLOAD_DEFAULT_THREADS;
+
+static void free_offload_job(offload_job_t *job)
+{
+    /* must be called with the GIL */
+    while (job->oj_freeme != NULL) {
+        void *p = (void *)job->oj_freeme;
+        job->oj_freeme = job->oj_freeme->next;
+        PyObject_Free(p);
+    }
+    if (job->oj_buffer != NULL)
+        PyObject_Free(job->oj_buffer);
+    if (job->oj_fvarargs != NULL) {
+        Py_DECREF(job->oj_fvarargs);
+        PyObject_Free(job->oj_cif);
+    }
+    Py_XDECREF(job->oj_fn);
+    Py_XDECREF(job->oj_args);
+    Py_XDECREF(job->oj_on_done);
+    PyObject_Free(job);
+}
+
+static void offload_complete(deferred_call_t *dc)
+{
+    /* called with the GIL, from drain_deferred_calls() */
+    offload_job_t *job = (offload_job_t *)dc;
+    CTypeDescrObject *fresult;
+    PyObject *res, *x;
+
+    fresult = (CTypeDescrObject *)PyTuple_GET_ITEM(
+                                      job->oj_fn->c_type->ct_stuff, 1);
+    res = _convert_call_result(job->oj_buffer +
+                                   job->oj_cif->exchange_offset_arg[0],
+                               fresult);
+    if (res != NULL) {
+        x = PyObject_CallFunctionObjArgs(job->oj_on_done, res, Py_None,
+                                         NULL);
+        Py_DECREF(res);
+    }
+    else {
+        PyObject *t, *v, *tb;
+        PyErr_Fetch(&t, &v, &tb);
+        PyErr_NormalizeException(&t, &v, &tb);
+        if (tb != NULL)
+            PyException_SetTraceback(v, tb);
+        x = PyObject_CallFunctionObjArgs(job->oj_on_done, Py_None, v, NULL);
+        Py_XDECREF(t);
+        Py_XDECREF(v);
+        Py_XDECREF(tb);
+    }
+    if (x == NULL)
+        PyErr_WriteUnraisable(job->oj_on_done);
+    else
+        Py_DECREF(x);
+    free_offload_job(job);
+}
+
+static void run_offload_job(offload_job_t *job)
+{
+    /* no GIL here */
+    job->oj_dc.dc_next = NULL;
+    job->oj_dc.dc_userdata = job;
+    job->oj_dc.dc_args = NULL;
+    job->oj_dc.dc_complete = offload_complete;
+
+    ffi_call(&job->oj_cif->cif,
+             CFFI_CLOSURE_TO_FNPTR(void (*)(void), job->oj_fn->c_data),
+             job->oj_buffer + job->oj_cif->exchange_offset_arg[0],
+             (void **)job->oj_buffer);
+
+    if (!queue_deferred_call(&job->oj_dc)) {
+        /* the queue is full: complete the call from this thread */
+        PyGILState_STATE state = gil_ensure();
+        drain_deferred_calls();
+        offload_complete(&job->oj_dc);
+        gil_release(state);
+    }
+}
+
+static void offload_dispatch_locked(offload_job_t *job)
+{
+    /* called with 'offload_lock' held, which is released */
+    offload_worker_t *w = offload_idle;
+    if (w != NULL) {
+        offload_idle = w->ow_next_idle;
+        w->ow_job = job;
+        PyThread_release_lock(offload_lock);
+        PyThread_release_lock(w->ow_lock);
+    }
+    else {
+        job->oj_next = NULL;
+        *offload_tail = job;
+        offload_tail = &job->oj_next;
+        PyThread_release_lock(offload_lock);
+    }
+}
+
+static void offload_worker_main(void *arg)
+{
+    offload_worker_t *w = (offload_worker_t *)arg;
+    offload_job_t *job = w->ow_job;
+
+    while (1) {
+        if (job != NULL)
+            run_offload_job(job);
+
+        PyThread_acquire_lock(offload_lock, WAIT_LOCK);
+        job = offload_head;
+        if (job != NULL) {
+            offload_head = job->oj_next;
+            if (offload_head == NULL)
+                offload_tail = &offload_head;
+            PyThread_release_lock(offload_lock);
+            continue;
+        }
+        if (offload_num_threads > offload_max_threads) {
+            offload_num_threads--;
+            PyThread_release_lock(offload_lock);
+            break;
+        }
+        w->ow_job = NULL;
+        w->ow_next_idle = offload_idle;
+        offload_idle = w;
+        PyThread_release_lock(offload_lock);
+
+        PyThread_acquire_lock(w->ow_lock, WAIT_LOCK);   /* sleep */
+        job = w->ow_job;
+    }
+    PyThread_free_lock(w->ow_lock);
+    free(w);
+}
+
+static int start_offload_job(offload_job_t *job)
+{
+    offload_worker_t *w;
+
+    PyThread_acquire_lock(offload_lock, WAIT_LOCK);
+    if (offload_idle != NULL || offload_num_threads >= offload_max_threads) {
+        offload_dispatch_locked(job);
+        return 0;
+    }
+    offload_num_threads++;
+    PyThread_release_lock(offload_lock);
+
+    /* start a new worker thread, which will do this job first */
+    w = (offload_worker_t *)malloc(sizeof(offload_worker_t));
+    if (w != NULL) {
+        w->ow_next_idle = NULL;
+        w->ow_job = job;
+        w->ow_lock = PyThread_allocate_lock();
+        if (w->ow_lock != NULL) {
+            PyThread_acquire_lock(w->ow_lock, WAIT_LOCK);
+            if (PyThread_start_new_thread(offload_worker_main, w) !=
+                    PYTHREAD_INVALID_THREAD_ID)
+                return 0;
+            PyThread_free_lock(w->ow_lock);
+        }
+        free(w);
+    }
+
+    PyThread_acquire_lock(offload_lock, WAIT_LOCK);
+    offload_num_threads--;
+    if (offload_num_threads > 0) {
+        /* give the job to the existing threads */
+        offload_dispatch_locked(job);
+        return 0;
+    }
+    PyThread_release_lock(offload_lock);
+    PyErr_SetString(PyExc_RuntimeError, "cannot start a new offload thread");
+    return -1;
+}
+
+static PyObject *b_offload_call(PyObject *self, PyObject *args)
+{
+    PyObject *fn, *fnargs, *on_done, *signature;
+    CDataObject *cd;
+    offload_job_t *job;
+    Py_ssize_t i, nargs, nargs_declared;
+
+    if (!PyArg_ParseTuple(args, "OO!O:offload_call", &fn, &PyTuple_Type,
+                          &fnargs, &on_done))
+        return NULL;
+
+    if (!CData_Check(fn)) {
+        /* a function from an API-mode 'lib' */
+        PyObject *func_cdata = try_extract_directfnptr(fn);
+        if (func_cdata == NULL) {
+            if (!PyErr_Occurred())
+                PyErr_Format(PyExc_TypeError,
+                             "expected a cdata function pointer or a "
+                             "function from a compiled 'lib', got %.200s",
+                             Py_TYPE(fn)->tp_name);
+            return NULL;
+        }
+        fn = func_cdata;
+    }
+    cd = (CDataObject *)fn;
+    if (_check_callable_cdata(cd) < 0)
+        return NULL;
+    if (!PyCallable_Check(on_done)) {
+        PyErr_SetString(PyExc_TypeError, "'on_done' must be callable");
+        return NULL;
+    }
+
+    job = (offload_job_t *)PyObject_Malloc(sizeof(offload_job_t));
+    if (job == NULL)
+        return PyErr_NoMemory();
+    memset(job, 0, sizeof(offload_job_t));
+    Py_INCREF(cd);
+    job->oj_fn = cd;
+    Py_INCREF(fnargs);
+    job->oj_args = fnargs;
+    Py_INCREF(on_done);
+    job->oj_on_done = on_done;
+
+    signature = cd->c_type->ct_stuff;
+    nargs = PyTuple_GET_SIZE(fnargs);
+    nargs_declared = PyTuple_GET_SIZE(signature) - 2;
+    job->oj_cif = _prepare_call_cif(cd->c_type, nargs, fnargs,
+                                    &job->oj_fvarargs);
+    if (job->oj_cif == NULL)
+        goto error;
+
+    job->oj_buffer = PyObject_Malloc(job->oj_cif->exchange_size);
+    if (job->oj_buffer == NULL) {
+        PyErr_NoMemory();
+        goto error;
+    }
+
+    /* like cdata_call(), but the temporary buffers cannot be alloca()ed */
+    for (i = 0; i < nargs; i++) {
+        CTypeDescrObject *argtype;
+        char *data = job->oj_buffer + job->oj_cif->exchange_offset_arg[1 + i];
+        PyObject *obj = PyTuple_GET_ITEM(fnargs, i);
+
+        ((void **)job->oj_buffer)[i] = data;
+
+        if (i < nargs_declared)
+            argtype = (CTypeDescrObject *)PyTuple_GET_ITEM(signature, 2 + i);
+        else
+            argtype = (CTypeDescrObject *)PyTuple_GET_ITEM(job->oj_fvarargs,
+                                                           i);
+
+        if (argtype->ct_flags & CT_POINTER) {
+            struct freeme_s *fp;
+            Py_ssize_t datasize = _prepare_pointer_call_argument(
+                                            argtype, obj, (char **)data);
+            if (datasize == 0)
+                continue;    /* successfully filled '*data' */
+            if (datasize < 0)
+                goto error;
+            fp = (struct freeme_s *)PyObject_Malloc(
+                       offsetof(struct freeme_s, alignment) + (size_t)datasize);
+            if (fp == NULL) {
+                PyErr_NoMemory();
+                goto error;
+            }
+            fp->next = job->oj_freeme;
+            job->oj_freeme = fp;
+            memset(&fp->alignment, 0, datasize);
+            *(char **)data = (char *)&fp->alignment;
+            if (convert_array_from_object((char *)&fp->alignment,
+                                          argtype, obj) < 0)
+                goto error;
+        }
+        else if (convert_from_object(data, argtype, obj) < 0)
+            goto error;
+    }
+
+    if (start_offload_job(job) < 0)
+        goto error;
+    Py_RETURN_NONE;
+
+ error:
+    free_offload_job(job);
+    return NULL;
+}
+
+static PyObject *b_set_offload_threads(PyObject *self, PyObject *args)
+{
+    int n, old_n;
+    offload_worker_t *w;
+
+    if (!PyArg_ParseTuple(args, "i:set_offload_threads", &n))
+        return NULL;
+    if (n < 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "the number of threads must be at least 1");
+        return NULL;
+    }
+    PyThread_acquire_lock(offload_lock, WAIT_LOCK);
+    old_n = offload_max_threads;
+    offload_max_threads = n;
+    /* wake up all idle workers; the extra ones will exit */
+    w = offload_idle;
+    offload_idle = NULL;
+    PyThread_release_lock(offload_lock);
+    while (w != NULL) {
+        offload_worker_t *next = w->ow_next_idle;
+        w->ow_job = NULL;
+        PyThread_release_lock(w->ow_lock);
+        w = next;
+    }
+    return PyLong_FromLong(old_n);
+}
+
+#ifndef MS_WIN32
+static void offload_before_fork(void)
+{
+    /* make sure that no other thread holds these locks while forking */
+    PyThread_acquire_lock(deferred_lock, WAIT_LOCK);
+    PyThread_acquire_lock(offload_lock, WAIT_LOCK);
+}
+
+static void offload_after_fork_parent(void)
+{
+    PyThread_release_lock(offload_lock);
+    PyThread_release_lock(deferred_lock);
+}
+
+static void offload_after_fork_child(void)
+{
+    /* the jobs and the idle workers are leaked */
+    offload_head = NULL;
+    offload_tail = &offload_head;
+    offload_idle = NULL;
+    offload_num_threads = 0;
+    PyThread_release_lock(offload_lock);
+    PyThread_release_lock(deferred_lock);
+}
+#endif
+
+static PyObject *prepare_callback_info_tuple(CTypeDescrObject *ct,
+                                             PyObject *ob,
+                                             PyObject *error_ob,
+                                             PyObject *onerror_ob,
+                                             int decode_args_from_libffi)
+{
+    CTypeDescrObject *ctresult;
+    PyObject *py_rawerr, *infotuple;
+    Py_ssize_t size;
+
+    if (!(ct->ct_flags & CT_FUNCTIONPTR)) {
+        PyErr_Format(PyExc_TypeError, "expected a function ctype, got '%s'",
+                     ct->ct_name);
+        return NULL;
+    }
+    if (!PyCallable_Check(ob)) {
+        PyErr_Format(PyExc_TypeError,
+                     "expected a callable object, not %.200s",
+                     Py_TYPE(ob)->tp_name);
+        return NULL;
+    }
+    if (onerror_ob != Py_None && !PyCallable_Check(onerror_ob)) {
+        PyErr_Format(PyExc_TypeError,
                      "expected a callable object for 'onerror', not %.200s",
                      Py_TYPE(onerror_ob)->tp_name);
         return NULL;
@@ -6369,15 +7352,73 @@ static PyObject *b_callback(PyObject *self, PyObject *args)
     ffi_closure *closure;
     ffi_status status;
     void *closure_exec;
+    char *fnptr;
+    int deferred = 0;
+    void (*invoke)(ffi_cif *, void *, void **, void *) = invoke_callback;
 
-    if (!PyArg_ParseTuple(args, "O!O|OO:callback", &CTypeDescr_Type, &ct, &ob,
-                          &error_ob, &onerror_ob))
+    if (!PyArg_ParseTuple(args, "O!O|OOi:callback", &CTypeDescr_Type, &ct, &ob,
+                          &error_ob, &onerror_ob, &deferred))
         return NULL;
 
+    if (deferred) {
+        if ((ct->ct_flags & CT_FUNCTIONPTR) &&
+            !(((CTypeDescrObject *)PyTuple_GET_ITEM(ct->ct_stuff, 1))
+                  ->ct_flags & CT_VOID)) {
+            PyErr_Format(PyExc_TypeError,
+                         "%s: deferred callbacks must return void",
+                         ct->ct_name);
+            return NULL;
+        }
+        if (error_ob != Py_None) {
+            PyErr_SetString(PyExc_TypeError,
+                            "deferred callbacks cannot have an 'error' value");
+            return NULL;
+        }
+        invoke = invoke_deferred_callback;
+    }
+
     infotuple = prepare_callback_info_tuple(ct, ob, error_ob, onerror_ob, 1);
     if (infotuple == NULL)
         return NULL;
 
+    cif_descr = (cif_description_t *)ct->ct_extra;
+    if (cif_descr == NULL) {
+        Py_DECREF(infotuple);
+        PyErr_Format(PyExc_NotImplementedError,
+                     "%s: callback with unsupported argument or "
+                     "return type or with '...'", ct->ct_name);
+        return NULL;
+    }
+
+    /* fast path: reuse a closure that was already prepared for this
+       function type by a previous callback */
+    closure = NULL;
+    fnptr = NULL;
+    Py_BEGIN_CRITICAL_SECTION(ct);
+    if (!deferred && cif_descr->num_free_closures > 0) {
+        int i = --cif_descr->num_free_closures;
+        closure = cif_descr->free_closures[i].closure;
+        fnptr = cif_descr->free_closures[i].fnptr;
+    }
+    Py_END_CRITICAL_SECTION();
+
+    if (closure != NULL) {
+        cd = PyObject_GC_New(CDataObject_closure, &CDataOwningGC_Type);
+        if (cd == NULL) {
+            release_callback_closure(ct, closure, fnptr);
+            Py_DECREF(infotuple);
+            return NULL;
+        }
+        Py_INCREF(ct);
+        cd->head.c_type = ct;
+        cd->head.c_data = fnptr;
+        cd->head.c_weakreflist = NULL;
+        closure->user_data = infotuple;
+        cd->closure = closure;
+        PyObject_GC_Track(cd);
+        return (PyObject *)cd;
+    }
+
 #if CFFI_CHECK_FFI_CLOSURE_ALLOC_MAYBE
     if (CFFI_CHECK_FFI_CLOSURE_ALLOC) {
         closure = ffi_closure_alloc(sizeof(ffi_closure), &closure_exec);
@@ -6407,18 +7448,10 @@ static PyObject *b_callback(PyObject *self, PyObject *args)
     closure->user_data = NULL;
     cd->closure = closure;
 
-    cif_descr = (cif_description_t *)ct->ct_extra;
-    if (cif_descr == NULL) {
-        PyErr_Format(PyExc_NotImplementedError,
-                     "%s: callback with unsupported argument or "
-                     "return type or with '...'", ct->ct_name);
-        goto error;
-    }
-
 #if CFFI_CHECK_FFI_PREP_CLOSURE_LOC_MAYBE
     if (CFFI_CHECK_FFI_PREP_CLOSURE_LOC) {
         status = ffi_prep_closure_loc(closure, &cif_descr->cif,
-                                      invoke_callback, infotuple, closure_exec);
+                                      invoke, infotuple, closure_exec);
     }
     else
 #endif
@@ -6428,7 +7461,7 @@ static PyObject *b_callback(PyObject *self, PyObject *args)
         goto error;
 #else
         status = ffi_prep_closure(closure, &cif_descr->cif,
-                                  invoke_callback, infotuple);
+                                  invoke, infotuple);
 #endif
     }
 
@@ -6456,18 +7489,13 @@ static PyObject *b_callback(PyObject *self, PyObject *args)
     return (PyObject *)cd;
 
  error:
+    /* don't recycle this closure: it may not be correctly prepared */
     closure->user_data = NULL;
-    if (cd == NULL) {
-#if CFFI_CHECK_FFI_CLOSURE_ALLOC_MAYBE
-        if (CFFI_CHECK_FFI_CLOSURE_ALLOC) {
-            ffi_closure_free(closure);
-        }
-        else
-#endif
-            cffi_closure_free(closure);
-    }
-    else
+    free_callback_closure(closure);
+    if (cd != NULL) {
+        cd->closure = NULL;
         Py_DECREF(cd);
+    }
     Py_XDECREF(infotuple);
     return NULL;
 }
@@ -7159,20 +8187,304 @@ static PyObject *b_from_handle(PyObject *self, PyObject *arg)
     return x;
 }
 
-static int _my_PyObject_GetContiguousBuffer(PyObject *x, Py_buffer *view,
-                                            int writable_only)
-{
-    if (PyObject_GetBuffer(x, view, writable_only ? PyBUF_WRITABLE
-                                                  : PyBUF_SIMPLE) < 0)
-        return -1;
+/* A handle table is an alternative to new_handle()/from_handle() when
+   there are many short-lived handles.  The 'void *' handles are not
+   addresses, but encode the index of a slot in the table and the
+   generation number of that slot, which is incremented every time the
+   slot is freed.  This means that using a handle after remove() is
+   detected and raises ValueError, instead of crashing (it is only missed
+   if the same slot was reused 2**32 times in between, or 2**8 times on
+   32-bit machines).  No Python object is allocated per handle, apart
+   from the 'void *' cdata returned by add().
+*/
 
-    if (!PyBuffer_IsContiguous(view, 'A')) {
-        PyBuffer_Release(view);
-        PyErr_SetString(PyExc_TypeError, "contiguous buffer expected");
-        return -1;
-    }
-    return 0;
-}
+#define HT_GENERATION_BITS  (sizeof(void *) >= 8 ? 32 : 8)
+#define HT_INDEX_BITS       (sizeof(void *) * 8 - HT_GENERATION_BITS)
+#define HT_INDEX_MASK       (((uintptr_t)1 << HT_INDEX_BITS) - 1)
+#define HT_GENERATION_MASK  (((uintptr_t)1 << HT_GENERATION_BITS) - 1)
+
+typedef struct {
+    PyObject *hs_obj;             /* NULL if the slot is free */
+    uintptr_t hs_generation;
+    Py_ssize_t hs_next_free;
+} handle_slot_t;
+
+typedef struct {
+    PyObject_HEAD
+    CTypeDescrObject *ht_ct_voidp;
+    handle_slot_t *ht_slots;
+    Py_ssize_t ht_size;           /* number of slots ever used */
+    Py_ssize_t ht_allocated;
+    Py_ssize_t ht_count;          /* number of live handles */
+    Py_ssize_t ht_free_head;      /* -1 if no free slot */
+} HandleTableObject;
+
+static PyTypeObject HandleTable_Type;
+
+static PyObject *new_handle_table(CTypeDescrObject *ct_voidp)
+{
+    HandleTableObject *ht;
+    ht = PyObject_GC_New(HandleTableObject, &HandleTable_Type);
+    if (ht == NULL)
+        return NULL;
+    Py_INCREF(ct_voidp);        /* must be "void *" */
+    ht->ht_ct_voidp = ct_voidp;
+    ht->ht_slots = NULL;
+    ht->ht_size = 0;
+    ht->ht_allocated = 0;
+    ht->ht_count = 0;
+    ht->ht_free_head = -1;
+    PyObject_GC_Track(ht);
+    return (PyObject *)ht;
+}
+
+static PyObject *b_new_handle_table(PyObject *self, PyObject *arg)
+{
+    CTypeDescrObject *ct = (CTypeDescrObject *)arg;
+    if (!CTypeDescr_Check(arg) || !(ct->ct_flags & CT_IS_VOID_PTR)) {
+        PyErr_SetString(PyExc_TypeError, "needs the ctype 'void *'");
+        return NULL;
+    }
+    return new_handle_table(ct);
+}
+
+static void handletable_dealloc(HandleTableObject *ht)
+{
+    Py_ssize_t i;
+    PyObject_GC_UnTrack(ht);
+    for (i = 0; i < ht->ht_size; i++)
+        Py_XDECREF(ht->ht_slots[i].hs_obj);
+    PyMem_Free(ht->ht_slots);
+    Py_DECREF(ht->ht_ct_voidp);
+    PyObject_GC_Del(ht);
+}
+
+static int handletable_traverse(HandleTableObject *ht, visitproc visit,
+                                void *arg)
+{
+    Py_ssize_t i;
+    for (i = 0; i < ht->ht_size; i++)
+        Py_VISIT(ht->ht_slots[i].hs_obj);
+    return 0;
+}
+
+static int handletable_clear(HandleTableObject *ht)
+{
+    /* all handles become invalid, but the table is still consistent */
+    Py_ssize_t i;
+    for (i = 0; i < ht->ht_size; i++) {
+        handle_slot_t *slot = &ht->ht_slots[i];
+        if (slot->hs_obj != NULL) {
+            PyObject *x = slot->hs_obj;
+            slot->hs_obj = NULL;
+            slot->hs_generation = (slot->hs_generation + 1) &
+                                  HT_GENERATION_MASK;
+            slot->hs_next_free = ht->ht_free_head;
+            ht->ht_free_head = i;
+            ht->ht_count--;
+            Py_DECREF(x);
+        }
+    }
+    return 0;
+}
+
+static Py_ssize_t handletable_length(HandleTableObject *ht)
+{
+    return ht->ht_count;
+}
+
+static uintptr_t _handletable_add(HandleTableObject *ht, PyObject *x)
+{
+    /* returns 0 and sets an exception in case of error */
+    Py_ssize_t index = ht->ht_free_head;
+    handle_slot_t *slot;
+
+    if (index >= 0) {
+        ht->ht_free_head = ht->ht_slots[index].hs_next_free;
+    }
+    else {
+        if (ht->ht_size == ht->ht_allocated) {
+            Py_ssize_t newsize = ht->ht_allocated ? ht->ht_allocated * 2 : 16;
+            handle_slot_t *newslots;
+            if ((uintptr_t)newsize > HT_INDEX_MASK)
+                newsize = (Py_ssize_t)HT_INDEX_MASK;
+            if (newsize <= ht->ht_allocated) {
+                PyErr_SetString(PyExc_MemoryError, "handle table is full");
+                return 0;
+            }
+            newslots = PyMem_Resize(ht->ht_slots, handle_slot_t, newsize);
+            if (newslots == NULL) {
+                PyErr_NoMemory();
+                return 0;
+            }
+            ht->ht_slots = newslots;
+            ht->ht_allocated = newsize;
+        }
+        index = ht->ht_size++;
+        ht->ht_slots[index].hs_generation = 0;
+    }
+    slot = &ht->ht_slots[index];
+    Py_INCREF(x);
+    slot->hs_obj = x;
+    slot->hs_next_free = -1;
+    ht->ht_count++;
+    return ((uintptr_t)(index + 1)) |
+           (slot->hs_generation << HT_INDEX_BITS);
+}
+
+static PyObject *handletable_add(HandleTableObject *ht, PyObject *x)
+{
+    uintptr_t handle;
+
+    Py_BEGIN_CRITICAL_SECTION(ht);
+    handle = _handletable_add(ht, x);
+    Py_END_CRITICAL_SECTION();
+
+    if (handle == 0)
+        return NULL;
+    return new_simple_cdata((char *)handle, ht->ht_ct_voidp);
+}
+
+static handle_slot_t *_handletable_find(HandleTableObject *ht,
+                                        uintptr_t handle, const char *where)
+{
+    /* returns NULL and sets an exception if the handle is not valid */
+    uintptr_t index = (handle & HT_INDEX_MASK) - 1;
+    handle_slot_t *slot;
+
+    if (index < (uintptr_t)ht->ht_size) {
+        slot = &ht->ht_slots[index];
+        if (slot->hs_obj != NULL &&
+                slot->hs_generation == (handle >> HT_INDEX_BITS))
+            return slot;
+    }
+    PyErr_Format(PyExc_ValueError,
+                 "%s(): invalid or stale handle %p (removed from the "
+                 "table, or returned by a different table)",
+                 where, (void *)handle);
+    return NULL;
+}
+
+static int _handletable_unpack(PyObject *arg, uintptr_t *p_handle)
+{
+    CTypeDescrObject *ct;
+    if (!CData_Check(arg)) {
+        PyErr_SetString(PyExc_TypeError, "expected a 'cdata' object");
+        return -1;
+    }
+    ct = ((CDataObject *)arg)->c_type;
+    if (!(ct->ct_flags & CT_IS_VOIDCHAR_PTR)) {
+        PyErr_Format(PyExc_TypeError,
+                     "expected a 'cdata' object with a 'void *' out of "
+                     "handle_table().add(), got '%s'", ct->ct_name);
+        return -1;
+    }
+    *p_handle = (uintptr_t)((CDataObject *)arg)->c_data;
+    return 0;
+}
+
+static PyObject *handletable_get(HandleTableObject *ht, PyObject *arg)
+{
+    uintptr_t handle;
+    handle_slot_t *slot;
+    PyObject *x = NULL;
+
+    if (_handletable_unpack(arg, &handle) < 0)
+        return NULL;
+
+    Py_BEGIN_CRITICAL_SECTION(ht);
+    slot = _handletable_find(ht, handle, "get");
+    if (slot != NULL) {
+        x = slot->hs_obj;
+        Py_INCREF(x);
+    }
+    Py_END_CRITICAL_SECTION();
+    return x;
+}
+
+static PyObject *handletable_remove(HandleTableObject *ht, PyObject *arg)
+{
+    uintptr_t handle;
+    handle_slot_t *slot;
+    PyObject *x = NULL;
+
+    if (_handletable_unpack(arg, &handle) < 0)
+        return NULL;
+
+    Py_BEGIN_CRITICAL_SECTION(ht);
+    slot = _handletable_find(ht, handle, "remove");
+    if (slot != NULL) {
+        x = slot->hs_obj;      /* steal the reference */
+        slot->hs_obj = NULL;
+        slot->hs_generation = (slot->hs_generation + 1) & HT_GENERATION_MASK;
+        slot->hs_next_free = ht->ht_free_head;
+        ht->ht_free_head = slot - ht->ht_slots;
+        ht->ht_count--;
+    }
+    Py_END_CRITICAL_SECTION();
+    return x;
+}
+
+static PyMethodDef handletable_methods[] = {
+    {"add",    (PyCFunction)handletable_add,    METH_O,
+     "Store a reference to the object and return a 'void *' handle for it."},
+    {"get",    (PyCFunction)handletable_get,    METH_O,
+     "Return the object corresponding to the handle."},
+    {"remove", (PyCFunction)handletable_remove, METH_O,
+     "Remove the handle from the table and return its object.  Using the\n"
+     "handle afterwards raises ValueError."},
+    {NULL,     NULL}           /* sentinel */
+};
+
+static PySequenceMethods handletable_as_sequence = {
+    (lenfunc)handletable_length,              /*sq_length*/
+};
+
+static PyTypeObject HandleTable_Type = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    "_cffi_backend.__HandleTable",
+    sizeof(HandleTableObject),
+    0,
+    (destructor)handletable_dealloc,            /* tp_dealloc */
+    0,                                          /* tp_print */
+    0,                                          /* tp_getattr */
+    0,                                          /* tp_setattr */
+    0,                                          /* tp_compare */
+    0,                                          /* tp_repr */
+    0,                                          /* tp_as_number */
+    &handletable_as_sequence,                   /* tp_as_sequence */
+    0,                                          /* tp_as_mapping */
+    0,                                          /* tp_hash */
+    0,                                          /* tp_call */
+    0,                                          /* tp_str */
+    PyObject_GenericGetAttr,                    /* tp_getattro */
+    0,                                          /* tp_setattro */
+    0,                                          /* tp_as_buffer */
+    Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,    /* tp_flags */
+    0,                                          /* tp_doc */
+    (traverseproc)handletable_traverse,         /* tp_traverse */
+    (inquiry)handletable_clear,                 /* tp_clear */
+    0,                                          /* tp_richcompare */
+    0,                                          /* tp_weaklistoffset */
+    0,                                          /* tp_iter */
+    0,                                          /* tp_iternext */
+    handletable_methods,                        /* tp_methods */
+};
+
+static int _my_PyObject_GetContiguousBuffer(PyObject *x, Py_buffer *view,
+                                            int writable_only)
+{
+    if (PyObject_GetBuffer(x, view, writable_only ? PyBUF_WRITABLE
+                                                  : PyBUF_SIMPLE) < 0)
+        return -1;
+
+    if (!PyBuffer_IsContiguous(view, 'A')) {
+        PyBuffer_Release(view);
+        PyErr_SetString(PyExc_TypeError, "contiguous buffer expected");
+        return -1;
+    }
+    return 0;
+}
 
 static PyObject *direct_from_buffer(CTypeDescrObject *ct, PyObject *x,
                                     int require_writable)
@@ -7283,6 +8595,498 @@ static PyObject *b_from_buffer(PyObject *self, PyObject *args)
     return direct_from_buffer(ct, x, require_writable);
 }
 
+/* ffi.map_file() is implemented on top of the standard 'mmap' module,
+   which already knows how to map files portably (and to unmap them in
+   its destructor).  The result is a regular 'from_buffer' cdata whose
+   buffer owns the last reference to the mmap object: ffi.release()
+   unmaps the file. */
+
+static const char *const map_file_advices[] = {
+    "normal", "random", "sequential", "willneed", "dontneed", NULL
+};
+
+static PyObject *_map_file_madvise(PyObject *mmap_mod, PyObject *m,
+                                   const char *advice)
+{
+    PyObject *cst, *res;
+    char name[32];
+    int i;
+
+    for (i = 0; map_file_advices[i] != NULL; i++)
+        if (strcmp(advice, map_file_advices[i]) == 0)
+            break;
+    if (map_file_advices[i] == NULL) {
+        PyErr_Format(PyExc_ValueError,
+                     "advice must be one of 'normal', 'random', 'sequential', "
+                     "'willneed' or 'dontneed', not '%.50s'", advice);
+        return NULL;
+    }
+    /* hints are only hints: silently ignore them on platforms that don't
+       support madvise() or this particular constant */
+    sprintf(name, "MADV_%s", advice);
+    for (i = 5; name[i]; i++)
+        name[i] += 'A' - 'a';
+    cst = PyObject_GetAttrString(mmap_mod, name);
+    if (cst == NULL) {
+        PyErr_Clear();
+        Py_RETURN_NONE;
+    }
+    if (!PyObject_HasAttrString(m, "madvise")) {
+        Py_DECREF(cst);
+        Py_RETURN_NONE;
+    }
+    res = PyObject_CallMethod(m, "madvise", "O", cst);
+    Py_DECREF(cst);
+    return res;
+}
+
+static PyObject *_map_fd_as_cdata(CTypeDescrObject *ct, int fd,
+                                  const char *access_name,
+                                  Py_ssize_t offset, Py_ssize_t maplength,
+                                  const char *advice, int require_writable)
+{
+    /* Map 'maplength' bytes (or up to the end if 0) of the open file
+       descriptor 'fd' and return a from_buffer() cdata over it.  The fd
+       can be closed afterwards. */
+    PyObject *mmap_mod, *mmap_type = NULL, *m = NULL, *x;
+    PyObject *buf = NULL, *kwds = NULL, *res = NULL;
+    Py_ssize_t granularity, delta;
+
+    mmap_mod = PyImport_ImportModule("mmap");
+    if (mmap_mod == NULL)
+        return NULL;
+
+    /* mmap() wants an offset that is a multiple of the allocation
+       granularity; map a little bit more and skip 'delta' bytes */
+    x = PyObject_GetAttrString(mmap_mod, "ALLOCATIONGRANULARITY");
+    if (x == NULL)
+        goto error;
+    granularity = PyNumber_AsSsize_t(x, PyExc_OverflowError);
+    Py_DECREF(x);
+    if (granularity <= 0) {
+        if (!PyErr_Occurred())
+            PyErr_SetString(PyExc_SystemError, "bad ALLOCATIONGRANULARITY");
+        goto error;
+    }
+    delta = offset % granularity;
+    if (maplength > 0)
+        maplength += delta;
+
+    kwds = PyDict_New();
+    if (kwds == NULL)
+        goto error;
+    x = PyObject_GetAttrString(mmap_mod, access_name);
+    if (x == NULL)
+        goto error;
+    if (PyDict_SetItemString(kwds, "access", x) < 0) {
+        Py_DECREF(x);
+        goto error;
+    }
+    Py_DECREF(x);
+    x = PyLong_FromSsize_t(offset - delta);
+    if (x == NULL)
+        goto error;
+    if (PyDict_SetItemString(kwds, "offset", x) < 0) {
+        Py_DECREF(x);
+        goto error;
+    }
+    Py_DECREF(x);
+    mmap_type = PyObject_GetAttrString(mmap_mod, "mmap");
+    if (mmap_type == NULL)
+        goto error;
+    x = Py_BuildValue("(in)", fd, maplength);
+    if (x == NULL)
+        goto error;
+    m = PyObject_Call(mmap_type, x, kwds);
+    Py_DECREF(x);
+    if (m == NULL)
+        goto error;
+
+    if (advice != NULL) {
+        x = _map_file_madvise(mmap_mod, m, advice);
+        if (x == NULL)
+            goto error;
+        Py_DECREF(x);
+    }
+
+    if (delta > 0) {
+        PyObject *mv = PyMemoryView_FromObject(m);
+        if (mv == NULL)
+            goto error;
+        buf = PySequence_GetSlice(mv, delta, PY_SSIZE_T_MAX);
+        Py_DECREF(mv);
+        if (buf == NULL)
+            goto error;
+    }
+    else {
+        Py_INCREF(m);
+        buf = m;
+    }
+    res = direct_from_buffer(ct, buf, require_writable);
+
+ error:
+    Py_XDECREF(buf);
+    Py_XDECREF(m);
+    Py_XDECREF(mmap_type);
+    Py_XDECREF(kwds);
+    Py_DECREF(mmap_mod);
+    return res;
+}
+
+static PyObject *direct_map_file(CTypeDescrObject *ct, PyObject *path,
+                                 const char *mode, Py_ssize_t offset,
+                                 PyObject *length, const char *advice)
+{
+    PyObject *io_mod, *f, *x, *res = NULL;
+    PyObject *t, *v, *tb;
+    const char *access_name, *file_mode;
+    Py_ssize_t maplength;
+    int require_writable, fd;
+
+    if (strcmp(mode, "r") == 0) {
+        access_name = "ACCESS_READ";
+        file_mode = "rb";
+        require_writable = 0;
+    }
+    else if (strcmp(mode, "r+") == 0) {
+        access_name = "ACCESS_WRITE";
+        file_mode = "r+b";
+        require_writable = 1;
+    }
+    else if (strcmp(mode, "c") == 0) {
+        access_name = "ACCESS_COPY";
+        file_mode = "rb";
+        require_writable = 1;
+    }
+    else {
+        PyErr_Format(PyExc_ValueError,
+                     "mode must be 'r', 'r+' or 'c', not '%.50s'", mode);
+        return NULL;
+    }
+    if (offset < 0) {
+        PyErr_SetString(PyExc_ValueError, "negative offset");
+        return NULL;
+    }
+    if (length == Py_None) {
+        maplength = 0;     /* up to the end of the file */
+    }
+    else {
+        maplength = PyNumber_AsSsize_t(length, PyExc_OverflowError);
+        if (maplength == -1 && PyErr_Occurred())
+            return NULL;
+        if (maplength <= 0) {
+            PyErr_SetString(PyExc_ValueError, "length must be positive");
+            return NULL;
+        }
+    }
+
+    io_mod = PyImport_ImportModule("_io");
+    if (io_mod == NULL)
+        return NULL;
+    f = PyObject_CallMethod(io_mod, "open", "Os", path, file_mode);
+    Py_DECREF(io_mod);
+    if (f == NULL)
+        return NULL;
+    x = PyObject_CallMethod(f, "fileno", NULL);
+    if (x != NULL) {
+        fd = PyLong_AsLong(x);
+        Py_DECREF(x);
+        if (!(fd == -1 && PyErr_Occurred()))
+            res = _map_fd_as_cdata(ct, fd, access_name, offset, maplength,
+                                   advice, require_writable);
+    }
+
+    /* the mapping stays valid after the file is closed */
+    PyErr_Fetch(&t, &v, &tb);
+    x = PyObject_CallMethod(f, "close", NULL);
+    Py_DECREF(f);
+    if (x == NULL) {
+        if (t == NULL) {
+            Py_CLEAR(res);
+            return NULL;
+        }
+        PyErr_Clear();
+    }
+    Py_XDECREF(x);
+    PyErr_Restore(t, v, tb);
+    return res;
+}
+
+static PyObject *b_map_file(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    CTypeDescrObject *ct;
+    PyObject *path, *length = Py_None;
+    const char *mode = "r", *advice = NULL;
+    Py_ssize_t offset = 0;
+    static char *keywords[] = {"ctype", "path", "mode", "offset", "length",
+                               "advice", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O|snOz:map_file",
+                                     keywords, &CTypeDescr_Type, &ct, &path,
+                                     &mode, &offset, &length, &advice))
+        return NULL;
+
+    return direct_map_file(ct, path, mode, offset, length, advice);
+}
+
+static PyObject *b_msync(PyObject *self, PyObject *arg)
+{
+    PyObject *obj, *mmap_mod, *mmap_type, *res;
+    int is_mmap;
+
+    if (!CData_Check(arg)) {
+        PyErr_SetString(PyExc_TypeError, "expected a 'cdata' object");
+        return NULL;
+    }
+    if (Py_TYPE(arg) != &CDataFromBuf_Type)
+        goto not_mapped;
+    obj = ((CDataObject_frombuf *)arg)->bufferview->obj;
+    if (obj == NULL) {
+        PyErr_SetString(PyExc_ValueError, "the mapping was already released");
+        return NULL;
+    }
+    Py_INCREF(obj);
+    if (PyMemoryView_Check(obj)) {
+        /* map_file() with an offset not aligned to the granularity */
+        PyObject *base = PyMemoryView_GET_BUFFER(obj)->obj;
+        Py_XINCREF(base);
+        Py_DECREF(obj);
+        obj = base;
+        if (obj == NULL)
+            goto not_mapped;
+    }
+    mmap_mod = PyImport_ImportModule("mmap");
+    if (mmap_mod == NULL) {
+        Py_DECREF(obj);
+        return NULL;
+    }
+    mmap_type = PyObject_GetAttrString(mmap_mod, "mmap");
+    Py_DECREF(mmap_mod);
+    if (mmap_type == NULL) {
+        Py_DECREF(obj);
+        return NULL;
+    }
+    is_mmap = PyObject_TypeCheck(obj, (PyTypeObject *)mmap_type);
+    Py_DECREF(mmap_type);
+    if (!is_mmap) {
+        Py_DECREF(obj);
+        goto not_mapped;
+    }
+    res = PyObject_CallMethod(obj, "flush", NULL);
+    Py_DECREF(obj);
+    if (res == NULL)
+        return NULL;
+    Py_DECREF(res);
+    Py_RETURN_NONE;
+
+ not_mapped:
+    PyErr_SetString(PyExc_TypeError,
+                    "expected a 'cdata' object returned by ffi.map_file()");
+    return NULL;
+}
+
+#ifndef MS_WIN32
+/* ffi.new_shared() and ffi.open_shared(): cdata in POSIX shared memory.
+   The shm_open() and shm_unlink() functions are taken from the
+   '_posixshmem' module of the standard library (used by
+   multiprocessing.shared_memory), which avoids the need to link with
+   '-lrt' on older systems.  The memory is allocated with the
+   cffi_allocator_t logic of ffi.new(), by passing two built-in functions
+   as the 'alloc' and 'free' of the allocator. */
+
+static int _shm_call(PyObject *shmmod, const char *funcname, PyObject *name,
+                     int flags)
+{
+    PyObject *x;
+    int result;
+
+    if (flags >= 0)
+        x = PyObject_CallMethod(shmmod, funcname, "Oii", name, flags, 0600);
+    else
+        x = PyObject_CallMethod(shmmod, funcname, "O", name);
+    if (x == NULL)
+        return -1;
+    result = (x == Py_None) ? 0 : PyLong_AsLong(x);
+    Py_DECREF(x);
+    return result;
+}
+
+static PyObject *_shared_name(PyObject *name)
+{
+    if (!PyUnicode_Check(name)) {
+        PyErr_Format(PyExc_TypeError,
+                     "shared memory name must be a str, not %.200s",
+                     Py_TYPE(name)->tp_name);
+        return NULL;
+    }
+    /* like multiprocessing.shared_memory, add the leading slash that
+       POSIX requires for portable names */
+    if (PyUnicode_GET_LENGTH(name) > 0 &&
+            PyUnicode_READ_CHAR(name, 0) == '/') {
+        Py_INCREF(name);
+        return name;
+    }
+    return PyUnicode_FromFormat("/%U", name);
+}
+
+/* 'info' is a tuple (name, ctype, creator_pid, _posixshmem module).  The
+   module is kept there because _shared_free() may run during interpreter
+   shutdown, when importing is no longer possible. */
+
+static PyObject *_shared_alloc(PyObject *info, PyObject *arg)
+{
+    PyObject *name = PyTuple_GET_ITEM(info, 0);
+    CTypeDescrObject *ct = (CTypeDescrObject *)PyTuple_GET_ITEM(info, 1);
+    PyObject *shmmod = PyTuple_GET_ITEM(info, 3);
+    PyObject *res, *t, *v, *tb;
+    Py_ssize_t size;
+    int fd;
+
+    size = PyNumber_AsSsize_t(arg, PyExc_OverflowError);
+    if (size == -1 && PyErr_Occurred())
+        return NULL;
+    if (size < 1)
+        size = 1;    /* cannot mmap() an empty object */
+
+    fd = _shm_call(shmmod, "shm_open", name, O_CREAT | O_EXCL | O_RDWR);
+    if (fd == -1 && PyErr_Occurred())
+        return NULL;
+
+    /* the newly created object is zero-filled by ftruncate() */
+    if (ftruncate(fd, (off_t)size) < 0) {
+        PyErr_SetFromErrno(PyExc_OSError);
+        res = NULL;
+    }
+    else {
+        res = _map_fd_as_cdata(ct, fd, "ACCESS_WRITE", 0, size, NULL, 1);
+    }
+    close(fd);
+    if (res == NULL) {
+        PyErr_Fetch(&t, &v, &tb);
+        if (_shm_call(shmmod, "shm_unlink", name, -1) < 0)
+            PyErr_Clear();
+        PyErr_Restore(t, v, tb);
+    }
+    return res;
+}
+
+static PyObject *_shared_free(PyObject *info, PyObject *origobj)
+{
+    PyObject *x;
+    long creator_pid = PyLong_AsLong(PyTuple_GET_ITEM(info, 2));
+
+    x = cdata_exit(origobj, NULL);    /* unmaps the memory */
+    if (x == NULL)
+        return NULL;
+    Py_DECREF(x);
+
+    /* only the process that created the object removes its name.  This
+       matters after a fork(): the children also release their copy of
+       the cdata at some point, but must not unlink the name. */
+    if (creator_pid == (long)getpid()) {
+        if (_shm_call(PyTuple_GET_ITEM(info, 3), "shm_unlink",
+                      PyTuple_GET_ITEM(info, 0), -1) < 0) {
+            if (!PyErr_ExceptionMatches(PyExc_FileNotFoundError))
+                return NULL;
+            PyErr_Clear();
+        }
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *direct_new_shared(CTypeDescrObject *ct, PyObject *name,
+                                   PyObject *init)
+{
+    static PyMethodDef md_alloc = {"shared_alloc",
+                                   (PyCFunction)_shared_alloc, METH_O};
+    static PyMethodDef md_free = {"shared_free",
+                                  (PyCFunction)_shared_free, METH_O};
+    cffi_allocator_t allocator;
+    PyObject *shmmod, *info, *res = NULL;
+
+    shmmod = PyImport_ImportModule("_posixshmem");
+    if (shmmod == NULL)
+        return NULL;
+    name = _shared_name(name);
+    if (name == NULL) {
+        Py_DECREF(shmmod);
+        return NULL;
+    }
+    info = Py_BuildValue("(OOlO)", name, (PyObject *)ct, (long)getpid(),
+                         shmmod);
+    Py_DECREF(name);
+    Py_DECREF(shmmod);
+    if (info == NULL)
+        return NULL;
+
+    allocator.ca_alloc = PyCFunction_New(&md_alloc, info);
+    allocator.ca_free = PyCFunction_New(&md_free, info);
+    allocator.ca_dont_clear = 1;
+    if (allocator.ca_alloc != NULL && allocator.ca_free != NULL)
+        res = direct_newp(ct, init, &allocator);
+
+    Py_XDECREF(allocator.ca_free);
+    Py_XDECREF(allocator.ca_alloc);
+    Py_DECREF(info);
+    return res;
+}
+
+static PyObject *b_new_shared(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    CTypeDescrObject *ct;
+    PyObject *name, *init = Py_None;
+    static char *keywords[] = {"ctype", "name", "init", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O|O:new_shared",
+                                     keywords, &CTypeDescr_Type, &ct, &name,
+                                     &init))
+        return NULL;
+
+    return direct_new_shared(ct, name, init);
+}
+
+static PyObject *direct_open_shared(CTypeDescrObject *ct, PyObject *name,
+                                    int readonly)
+{
+    PyObject *shmmod, *res;
+    int fd;
+
+    shmmod = PyImport_ImportModule("_posixshmem");
+    if (shmmod == NULL)
+        return NULL;
+    name = _shared_name(name);
+    if (name == NULL) {
+        Py_DECREF(shmmod);
+        return NULL;
+    }
+    fd = _shm_call(shmmod, "shm_open", name, readonly ? O_RDONLY : O_RDWR);
+    Py_DECREF(name);
+    Py_DECREF(shmmod);
+    if (fd == -1 && PyErr_Occurred())
+        return NULL;
+
+    res = _map_fd_as_cdata(ct, fd, readonly ? "ACCESS_READ" : "ACCESS_WRITE",
+                           0, 0, NULL, !readonly);
+    close(fd);
+    return res;
+}
+
+static PyObject *b_open_shared(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    CTypeDescrObject *ct;
+    PyObject *name;
+    int readonly = 0;
+    static char *keywords[] = {"ctype", "name", "readonly", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O|i:open_shared",
+                                     keywords, &CTypeDescr_Type, &ct, &name,
+                                     &readonly))
+        return NULL;
+
+    return direct_open_shared(ct, name, readonly);
+}
+#endif   /* !MS_WIN32 */
+
 static int _fetch_as_buffer(PyObject *x, Py_buffer *view, int writable_only)
 {
     if (CData_Check(x)) {
@@ -7342,17 +9146,107 @@ static PyObject *b__get_types(PyObject *self, PyObject *noarg)
 /* forward, in commontypes.c */
 static PyObject *b__get_common_types(PyObject *self, PyObject *arg);
 
+static int _check_gc_batch(CDataObject *origobj, PyObject *destructor)
+{
+    CTypeDescrObject *ct;
+    PyObject *abi;
+
+    if (Py_TYPE(origobj) != &CData_Type ||
+            !(origobj->c_type->ct_flags & CT_POINTER)) {
+        PyErr_Format(PyExc_TypeError,
+                     "ffi.gc(..., batch=True) needs a non-owning pointer, "
+                     "like one returned by a C function, not a cdata '%s' "
+                     "of type %.200s", origobj->c_type->ct_name,
+                     Py_TYPE(origobj)->tp_name);
+        return -1;
+    }
+    if (!CData_Check(destructor) ||
+            !(((CDataObject *)destructor)->c_type->ct_flags & CT_FUNCTIONPTR)) {
+        PyErr_SetString(PyExc_TypeError,
+                        "ffi.gc(..., batch=True) needs a destructor that is "
+                        "a cdata C function, not a Python callable");
+        return -1;
+    }
+    /* we call the function as a 'void(*)(void *)', which is only fine
+       for a single pointer argument and a result that can be ignored */
+    ct = ((CDataObject *)destructor)->c_type;
+    abi = PyTuple_GET_ITEM(ct->ct_stuff, 0);
+    if (ct->ct_extra == NULL ||          /* vararg function */
+            PyTuple_GET_SIZE(ct->ct_stuff) != 3 ||
+            !PyLong_Check(abi) || PyLong_AsLong(abi) != FFI_DEFAULT_ABI ||
+            !(((CTypeDescrObject *)PyTuple_GET_ITEM(ct->ct_stuff, 2))
+                  ->ct_flags & CT_POINTER) ||
+            !(((CTypeDescrObject *)PyTuple_GET_ITEM(ct->ct_stuff, 1))
+                  ->ct_flags & (CT_VOID | CT_POINTER | CT_PRIMITIVE_SIGNED |
+                                CT_PRIMITIVE_UNSIGNED))) {
+        PyErr_Format(PyExc_TypeError,
+                     "ffi.gc(..., batch=True) needs a destructor taking "
+                     "one pointer argument, like 'void(*)(void *)', not '%s'",
+                     ct->ct_name);
+        return -1;
+    }
+    if (((CDataObject *)destructor)->c_data == NULL) {
+        PyErr_SetString(PyExc_ValueError,
+                        "ffi.gc(..., batch=True): destructor is NULL");
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *b_gc_flush(PyObject *self, PyObject *noarg)
+{
+    return PyLong_FromSsize_t(gc_batch_flush());
+}
+
+static int gc_batch_atexit_registered = 0;
+
+static PyObject *gc_batch_atexit(PyObject *self, PyObject *noarg)
+{
+    LOCK_GC_BATCH();
+    gc_batch_exiting = 1;
+    UNLOCK_GC_BATCH();
+    return PyLong_FromSsize_t(gc_batch_flush());
+}
+
+static int _register_gc_batch_atexit(void)
+{
+    /* flush the queue when the interpreter exits, while the libraries
+       containing the destructors are still loaded */
+    static PyMethodDef md = {"gc_flush", gc_batch_atexit, METH_NOARGS};
+    PyObject *atexit_mod, *func, *res;
+
+    if (gc_batch_atexit_registered)
+        return 0;
+    atexit_mod = PyImport_ImportModule("atexit");
+    if (atexit_mod == NULL)
+        return -1;
+    func = PyCFunction_New(&md, NULL);
+    if (func == NULL) {
+        Py_DECREF(atexit_mod);
+        return -1;
+    }
+    res = PyObject_CallMethod(atexit_mod, "register", "O", func);
+    Py_DECREF(func);
+    Py_DECREF(atexit_mod);
+    if (res == NULL)
+        return -1;
+    Py_DECREF(res);
+    gc_batch_atexit_registered = 1;
+    return 0;
+}
+
 static PyObject *b_gcp(PyObject *self, PyObject *args, PyObject *kwds)
 {
     CDataObject *cd;
     CDataObject *origobj;
     PyObject *destructor;
     Py_ssize_t ignored;   /* for pypy */
-    static char *keywords[] = {"cdata", "destructor", "size", NULL};
+    int batch = 0;
+    static char *keywords[] = {"cdata", "destructor", "size", "batch", NULL};
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O|n:gc", keywords,
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!O|np:gc", keywords,
                                      &CData_Type, &origobj, &destructor,
-                                     &ignored))
+                                     &ignored, &batch))
         return NULL;
 
     if (destructor == Py_None) {
@@ -7366,7 +9260,16 @@ static PyObject *b_gcp(PyObject *self, PyObject *args, PyObject *kwds)
 	Py_RETURN_NONE;
     }
 
+    if (batch) {
+        if (_check_gc_batch(origobj, destructor) < 0)
+            return NULL;
+        if (_register_gc_batch_atexit() < 0)
+            return NULL;
+    }
+
     cd = allocate_gcp_object(origobj, origobj->c_type, destructor);
+    if (cd != NULL)
+        ((CDataObject_gcp *)cd)->batched = batch;
     return (PyObject *)cd;
 }
 
@@ -7668,9 +9571,25 @@ static PyMethodDef FFIBackendMethods[] = {
     {"set_errno", b_set_errno, METH_O},
     {"newp_handle", b_newp_handle, METH_VARARGS},
     {"from_handle", b_from_handle, METH_O},
+    {"new_handle_table", b_new_handle_table, METH_O},
     {"from_buffer", b_from_buffer, METH_VARARGS},
+    {"map_file", (PyCFunction)b_map_file, METH_VARARGS | METH_KEYWORDS},
+    {"msync", b_msync, METH_O},
+#ifndef MS_WIN32
+    {"new_shared", (PyCFunction)b_new_shared, METH_VARARGS | METH_KEYWORDS},
+    {"open_shared", (PyCFunction)b_open_shared, METH_VARARGS | METH_KEYWORDS},
+#endif
     {"memmove", (PyCFunction)b_memmove, METH_VARARGS | METH_KEYWORDS},
     {"gcp", (PyCFunction)b_gcp, METH_VARARGS | METH_KEYWORDS},
+    {"gc_flush", b_gc_flush, METH_NOARGS},
+    {"drain_callbacks", b_drain_callbacks, METH_NOARGS},
+    {"offload_call", b_offload_call, METH_VARARGS},
+    {"set_offload_threads", b_set_offload_threads, METH_VARARGS},
+#ifndef MS_WIN32
+    {"add_callbacks_wakeup_fd", b_add_callbacks_wakeup_fd, METH_VARARGS},
+    {"remove_callbacks_wakeup_fd", b_remove_callbacks_wakeup_fd,
+                                                         METH_VARARGS},
+#endif
     {"release", b_release, METH_O},
 #ifdef MS_WIN32
     {"getwinerror", (PyCFunction)b_getwinerror, METH_VARARGS | METH_KEYWORDS},
@@ -7848,8 +9767,8 @@ static void *cffi_exports[] = {
     _cffi_from_c_pointer,
     _cffi_to_c_pointer,
     _cffi_get_struct_layout,
-    restore_errno,
-    save_errno,
+    cffi_enter_c_call,      /* _cffi_restore_errno */
+    cffi_leave_c_call,      /* _cffi_save_errno */
     _cffi_from_c_char,
     convert_to_object,
     convert_from_object,
@@ -7919,6 +9838,7 @@ PyInit__cffi_backend(void)
         &CDataFromBuf_Type,
         &CDataGCP_Type,
         &CDataIter_Type,
+        &HandleTable_Type,
         &MiniBuffer_Type,
         &FFI_Type,
         &Lib_Type,
@@ -7949,6 +9869,23 @@ PyInit__cffi_backend(void)
         if (unique_cache == NULL)
             INITERROR;
     }
+    if (deferred_lock == NULL) {
+        deferred_lock = PyThread_allocate_lock();
+        if (deferred_lock == NULL)
+            INITERROR;
+    }
+    if (offload_lock == NULL) {
+        offload_lock = PyThread_allocate_lock();
+        if (offload_lock == NULL)
+            INITERROR;
+#ifndef MS_WIN32
+        if (pthread_atfork(offload_before_fork, offload_after_fork_parent,
+                           offload_after_fork_child) != 0) {
+            PyErr_SetString(PyExc_OSError, "pthread_atfork() failed");
+            INITERROR;
+        }
+#endif
+    }
 
     /* readify all types and add them to the module */
     for (i = 0; all_types[i] != NULL; i++) {
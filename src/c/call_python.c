@@ -252,7 +252,24 @@ static void cffi_call_python(struct _cffi_externpy_s *externpy, char *args)
         err = 1;
     }
     else {
-        PyGILState_STATE state = gil_ensure();
+        /* If we are called synchronously from a C function that was
+           itself called from Python by this thread, we can skip most
+           of the work of gil_ensure(): see cffi_enter_c_call(). */
+        PyThreadState *ts = cffi_get_reentrant_tstate();
+        PyGILState_STATE state = PyGILState_LOCKED;
+        int fast = (ts != NULL);
+
+        if (!fast) {
+            state = gil_ensure();
+            cffi_set_reentrant_tstate(state);
+        }
+        else if (ts != get_current_ts()) {
+            PyEval_RestoreThread(ts);
+        }
+        else {
+            ts = NULL;     /* the C code took the GIL again itself */
+        }
+
         if (externpy->reserved1 != _current_interp_key()) {
             /* Update the (reserved1, reserved2) cache.  This will fail
                if we didn't call @ffi.def_extern() in this particular
@@ -262,7 +279,11 @@ static void cffi_call_python(struct _cffi_externpy_s *externpy, char *args)
         if (!err) {
             general_invoke_callback(0, args, args, externpy->reserved2);
         }
-        gil_release(state);
+
+        if (!fast)
+            gil_release(state);
+        else if (ts != NULL)
+            PyEval_SaveThread();
     }
     if (err) {
         static const char *msg[] = {
@@ -169,7 +169,7 @@ static PyObject *b_init_cffi_1_0_external_module(PyObject *self, PyObject *arg)
 
     /* initialize the exports array */
     num_exports = 25;
-    if (ctx->flags & 1)    /* set to mean that 'extern "Python"' is used */
+    if (ctx->flags & _CFFI_CTX_EXTERN_PYTHON)
         num_exports = 26;
     if (version >= CFFI_VERSION_CHAR16CHAR32)
         num_exports = 28;
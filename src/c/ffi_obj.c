@@ -32,6 +32,7 @@ struct FFIObject_s {
     PyObject_HEAD
     PyObject *gc_wrefs, *gc_wrefs_freelist;
     PyObject *init_once_cache;
+    PyObject *callback_cache;
     char ctx_is_static, ctx_is_nonempty;
     builder_c_t types_builder;
 };
@@ -58,6 +59,7 @@ static FFIObject *ffi_internal_new(PyTypeObject *ffitype,
     ffi->gc_wrefs = NULL;
     ffi->gc_wrefs_freelist = NULL;
     ffi->init_once_cache = NULL;
+    ffi->callback_cache = NULL;
     ffi->ctx_is_static = (static_ctx != NULL);
     ffi->ctx_is_nonempty = (static_ctx != NULL);
     return ffi;
@@ -69,6 +71,7 @@ static void ffi_dealloc(FFIObject *ffi)
     Py_XDECREF(ffi->gc_wrefs);
     Py_XDECREF(ffi->gc_wrefs_freelist);
     Py_XDECREF(ffi->init_once_cache);
+    Py_XDECREF(ffi->callback_cache);
 
     free_builder_c(&ffi->types_builder, ffi->ctx_is_static);
 
@@ -81,6 +84,7 @@ static int ffi_traverse(FFIObject *ffi, visitproc visit, void *arg)
     Py_VISIT(ffi->types_builder.included_ffis);
     Py_VISIT(ffi->types_builder.included_libs);
     Py_VISIT(ffi->gc_wrefs);
+    Py_VISIT(ffi->callback_cache);
     return 0;
 }
 
@@ -693,6 +697,19 @@ PyDoc_STRVAR(ffi_from_handle_doc,
 #define ffi_from_handle  b_from_handle   /* ffi_from_handle => b_from_handle
                                             from _cffi_backend.c */
 
+PyDoc_STRVAR(ffi_handle_table_doc,
+"Return a new, empty handle table.  It is an alternative to new_handle()\n"
+"and from_handle() for programs with many handles: 'table.add(x)' returns\n"
+"a 'void *' handle for any Python object x, 'table.get(p)' returns x, and\n"
+"'table.remove(p)' returns x and invalidates p.  Unlike with from_handle(),\n"
+"using a handle that was removed raises ValueError instead of crashing.");
+
+static PyObject *ffi_handle_table(FFIObject *self, PyObject *noarg)
+{
+    /* g_ct_voidp is equal to <ctype 'void *'> */
+    return new_handle_table(g_ct_voidp);
+}
+
 PyDoc_STRVAR(ffi_from_buffer_doc,
 "Return a <cdata 'char[]'> that points to the data of the given Python\n"
 "object, which must support the buffer interface.  Note that this is\n"
@@ -726,6 +743,93 @@ static PyObject *ffi_from_buffer(FFIObject *self, PyObject *args,
     return direct_from_buffer(ct, python_buf, require_writable);
 }
 
+PyDoc_STRVAR(ffi_map_file_doc,
+"Map the file 'path' into memory and return a cdata of the given array\n"
+"or pointer type that points to the mapped data, like from_buffer().\n"
+"'mode' is 'r' (read-only), 'r+' (writes go to the file) or 'c' (private\n"
+"copy-on-write).  'offset' and 'length' select a part of the file; by\n"
+"default, all of it.  'advice' is an optional madvise() hint: 'normal',\n"
+"'random', 'sequential', 'willneed' or 'dontneed'.  Use release() to\n"
+"unmap the file at a known time.");
+
+static PyObject *ffi_map_file(FFIObject *self, PyObject *args,
+                              PyObject *kwds)
+{
+    PyObject *cdecl1, *path, *length = Py_None;
+    CTypeDescrObject *ct;
+    const char *mode = "r", *advice = NULL;
+    Py_ssize_t offset = 0;
+    static char *keywords[] = {"cdecl", "path", "mode", "offset", "length",
+                               "advice", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|snOz:map_file", keywords,
+                                     &cdecl1, &path, &mode, &offset, &length,
+                                     &advice))
+        return NULL;
+
+    ct = _ffi_type(self, cdecl1, ACCEPT_STRING|ACCEPT_CTYPE);
+    if (ct == NULL)
+        return NULL;
+    return direct_map_file(ct, path, mode, offset, length, advice);
+}
+
+PyDoc_STRVAR(ffi_msync_doc,
+"Flush the changes done to a cdata returned by map_file() back to the\n"
+"file on disk.");
+
+#define ffi_msync  b_msync     /* ffi_msync() => b_msync()
+                                  from _cffi_backend.c */
+
+#ifndef MS_WIN32
+PyDoc_STRVAR(ffi_new_shared_doc,
+"Like new(), but allocate the memory in a new POSIX shared memory object\n"
+"called 'name'.  Other processes can attach to the same memory with\n"
+"open_shared(cdecl, name).  Releasing the returned cdata, explicitly\n"
+"with release() or when it is garbage-collected, unmaps the memory and\n"
+"removes the name.");
+
+static PyObject *ffi_new_shared(FFIObject *self, PyObject *args,
+                                PyObject *kwds)
+{
+    PyObject *cdecl1, *name, *init = Py_None;
+    CTypeDescrObject *ct;
+    static char *keywords[] = {"cdecl", "name", "init", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|O:new_shared", keywords,
+                                     &cdecl1, &name, &init))
+        return NULL;
+
+    ct = _ffi_type(self, cdecl1, ACCEPT_STRING|ACCEPT_CTYPE);
+    if (ct == NULL)
+        return NULL;
+    return direct_new_shared(ct, name, init);
+}
+
+PyDoc_STRVAR(ffi_open_shared_doc,
+"Attach to the POSIX shared memory object 'name' made by new_shared()\n"
+"in any process.  Return a cdata of the given array or pointer type\n"
+"that points to the shared memory, like from_buffer().  Releasing it\n"
+"only unmaps the memory in this process.");
+
+static PyObject *ffi_open_shared(FFIObject *self, PyObject *args,
+                                 PyObject *kwds)
+{
+    PyObject *cdecl1, *name;
+    CTypeDescrObject *ct;
+    int readonly = 0;
+    static char *keywords[] = {"cdecl", "name", "readonly", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|i:open_shared", keywords,
+                                     &cdecl1, &name, &readonly))
+        return NULL;
+
+    ct = _ffi_type(self, cdecl1, ACCEPT_STRING|ACCEPT_CTYPE);
+    if (ct == NULL)
+        return NULL;
+    return direct_open_shared(ct, name, readonly);
+}
+#endif
+
 PyDoc_STRVAR(ffi_gc_doc,
 "Return a new cdata object that points to the same data.\n"
 "Later, when this new cdata object is garbage-collected,\n"
@@ -734,11 +838,22 @@ PyDoc_STRVAR(ffi_gc_doc,
 "The optional 'size' gives an estimate of the size, used to\n"
 "trigger the garbage collection more eagerly.  So far only used\n"
 "on PyPy.  It tells the GC that the returned object keeps alive\n"
-"roughly 'size' bytes of external memory.");
+"roughly 'size' bytes of external memory.\n"
+"\n"
+"If 'batch' is true, 'destructor' must be a C function taking one\n"
+"pointer argument.  Its calls are then queued and done later, in\n"
+"batches and without the GIL; see ffi.gc_flush().");
 
 #define ffi_gc  b_gcp     /* ffi_gc() => b_gcp()
                              from _cffi_backend.c */
 
+PyDoc_STRVAR(ffi_gc_flush_doc,
+"Call now all the destructors queued by ffi.gc(..., batch=True).\n"
+"Returns the number of destructors called.");
+
+#define ffi_gc_flush  b_gc_flush     /* ffi_gc_flush() => b_gc_flush()
+                                        from _cffi_backend.c */
+
 PyDoc_STRVAR(ffi_def_extern_doc,
 "A decorator.  Attaches the decorated Python function to the C code\n"
 "generated for the 'extern \"Python\"' function of the same name.\n"
@@ -779,7 +894,11 @@ PyDoc_STRVAR(ffi_callback_doc,
 "'cdecl' must name a C function pointer type.  The callback invokes the\n"
 "specified 'python_callable' (which may be provided either directly or\n"
 "via a decorator).  Important: the callback object must be manually\n"
-"kept alive for as long as the callback may be invoked from the C code.");
+"kept alive for as long as the callback may be invoked from the C code.\n"
+"\n"
+"If 'deferred' is true, the C function type must return void.  When C\n"
+"code calls the callback, the arguments are only queued; the Python\n"
+"function is called later from the main thread, or by drain_callbacks().");
 
 static PyObject *_ffi_callback_decorator(PyObject *outer_args, PyObject *fn)
 {
@@ -796,12 +915,13 @@ static PyObject *ffi_callback(FFIObject *self, PyObject *args, PyObject *kwds)
 {
     PyObject *c_decl, *python_callable = Py_None, *error = Py_None;
     PyObject *res, *onerror = Py_None;
+    int deferred = 0;
     static char *keywords[] = {"cdecl", "python_callable", "error",
-                               "onerror", NULL};
+                               "onerror", "deferred", NULL};
 
-    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOO", keywords,
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOOp", keywords,
                                      &c_decl, &python_callable, &error,
-                                     &onerror))
+                                     &onerror, &deferred))
         return NULL;
 
     c_decl = (PyObject *)_ffi_type(self, c_decl, ACCEPT_STRING | ACCEPT_CTYPE |
@@ -809,7 +929,8 @@ static PyObject *ffi_callback(FFIObject *self, PyObject *args, PyObject *kwds)
     if (c_decl == NULL)
         return NULL;
 
-    args = Py_BuildValue("(OOOO)", c_decl, python_callable, error, onerror);
+    args = Py_BuildValue("(OOOOi)", c_decl, python_callable, error, onerror,
+                         deferred);
     if (args == NULL)
         return NULL;
 
@@ -825,6 +946,113 @@ static PyObject *ffi_callback(FFIObject *self, PyObject *args, PyObject *kwds)
     return res;
 }
 
+PyDoc_STRVAR(ffi_callback_cache_doc,
+"Like callback(), but return the same callback object if called again\n"
+"with the same 'cdecl', 'python_callable', 'error' and 'onerror'.  The\n"
+"callback objects are kept alive by the ffi object; only the most\n"
+"recently used ones are kept.  Unlike callback(), this cannot be used\n"
+"as a decorator.  The C function pointer of a callback that drops out\n"
+"of the cache is reused by the next callbacks: if C code may call it\n"
+"later, keep the callback object alive yourself.");
+
+#define FFI_CALLBACK_CACHE_SIZE   256
+
+static PyObject *ffi_callback_cache(FFIObject *self, PyObject *args,
+                                    PyObject *kwds)
+{
+    PyObject *c_decl, *python_callable, *error = Py_None;
+    PyObject *onerror = Py_None, *cache, *key, *res;
+    Py_ssize_t pos = 0;
+    PyObject *oldkey, *oldvalue;
+    static char *keywords[] = {"cdecl", "python_callable", "error",
+                               "onerror", NULL};
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|OO:callback_cache",
+                                     keywords, &c_decl, &python_callable,
+                                     &error, &onerror))
+        return NULL;
+
+    c_decl = (PyObject *)_ffi_type(self, c_decl, ACCEPT_STRING | ACCEPT_CTYPE |
+                                                 CONSIDER_FN_AS_FNPTR);
+    if (c_decl == NULL)
+        return NULL;
+
+    args = Py_BuildValue("(OOOO)", c_decl, python_callable, error, onerror);
+    if (args == NULL)
+        return NULL;
+    /* the type of 'error' is part of the key: e.g. 0 and 0.0 are equal,
+       but not equally valid as the error value of an 'int' callback */
+    key = Py_BuildValue("(OOOOO)", c_decl, python_callable,
+                        (PyObject *)Py_TYPE(error), error, onerror);
+    if (key == NULL)
+        goto error;
+    if (PyObject_Hash(key) == -1) {
+        if (!PyErr_ExceptionMatches(PyExc_TypeError))
+            goto error;
+        /* unhashable arguments: don't cache the result */
+        PyErr_Clear();
+        Py_DECREF(key);
+        res = b_callback(NULL, args);
+        Py_DECREF(args);
+        return res;
+    }
+
+    Py_BEGIN_CRITICAL_SECTION(self);
+    cache = self->callback_cache;
+    if (cache == NULL) {
+        self->callback_cache = cache = PyDict_New();
+    }
+    Py_XINCREF(cache);
+    Py_END_CRITICAL_SECTION();
+
+    if (cache == NULL)
+        goto error;
+
+    if (PyDict_GetItemRef(cache, key, &res) < 0)
+        goto error_cache;
+    if (res != NULL) {
+        /* move it to the end, as the most recently used */
+        if (PyDict_DelItem(cache, key) < 0)
+            PyErr_Clear();
+    }
+    else {
+        res = b_callback(NULL, args);
+        if (res == NULL)
+            goto error_cache;
+        if (PyDict_GET_SIZE(cache) >= FFI_CALLBACK_CACHE_SIZE &&
+                PyDict_Next(cache, &pos, &oldkey, &oldvalue)) {
+            /* forget the least recently used callback */
+            Py_INCREF(oldkey);
+            if (PyDict_DelItem(cache, oldkey) < 0)
+                PyErr_Clear();
+            Py_DECREF(oldkey);
+        }
+    }
+    if (PyDict_SetItem(cache, key, res) < 0) {
+        Py_DECREF(res);
+        goto error_cache;
+    }
+    Py_DECREF(cache);
+    Py_DECREF(key);
+    Py_DECREF(args);
+    return res;
+
+ error_cache:
+    Py_DECREF(cache);
+ error:
+    Py_XDECREF(key);
+    Py_DECREF(args);
+    return NULL;
+}
+
+PyDoc_STRVAR(ffi_drain_callbacks_doc,
+"Call now the Python functions of all the deferred callbacks that were\n"
+"invoked from C, in the order of the invocations.  Returns the number of\n"
+"calls done.");
+
+#define ffi_drain_callbacks  b_drain_callbacks  /* ffi_drain_callbacks() =>
+                                       b_drain_callbacks() from _cffi_backend.c */
+
 #ifdef MS_WIN32
 PyDoc_STRVAR(ffi_getwinerror_doc,
 "Return either the GetLastError() or the error number given by the\n"
@@ -1104,24 +1332,36 @@ static PyMethodDef ffi_methods[] = {
  {"alignof",    (PyCFunction)ffi_alignof,    METH_O,       ffi_alignof_doc},
  {"def_extern", (PyCFunction)ffi_def_extern, METH_VKW,     ffi_def_extern_doc},
  {"callback",   (PyCFunction)ffi_callback,   METH_VKW,     ffi_callback_doc},
+ {"callback_cache",(PyCFunction)ffi_callback_cache,METH_VKW,ffi_callback_cache_doc},
  {"cast",       (PyCFunction)ffi_cast,       METH_VARARGS, ffi_cast_doc},
  {"dlclose",    (PyCFunction)ffi_dlclose,    METH_VARARGS, ffi_dlclose_doc},
  {"dlopen",     (PyCFunction)ffi_dlopen,     METH_VARARGS, ffi_dlopen_doc},
+ {"drain_callbacks",(PyCFunction)ffi_drain_callbacks,METH_NOARGS,ffi_drain_callbacks_doc},
  {"from_buffer",(PyCFunction)ffi_from_buffer,METH_VKW,     ffi_from_buffer_doc},
  {"from_handle",(PyCFunction)ffi_from_handle,METH_O,       ffi_from_handle_doc},
  {"gc",         (PyCFunction)ffi_gc,         METH_VKW,     ffi_gc_doc},
+ {"gc_flush",   (PyCFunction)ffi_gc_flush,   METH_NOARGS,  ffi_gc_flush_doc},
  {"getctype",   (PyCFunction)ffi_getctype,   METH_VKW,     ffi_getctype_doc},
 #ifdef MS_WIN32
  {"getwinerror",(PyCFunction)ffi_getwinerror,METH_VKW,     ffi_getwinerror_doc},
 #endif
+ {"handle_table",(PyCFunction)ffi_handle_table,METH_NOARGS,ffi_handle_table_doc},
  {"init_once",  (PyCFunction)ffi_init_once,  METH_VKW,     ffi_init_once_doc},
  {"integer_const",(PyCFunction)ffi_int_const,METH_VKW,     ffi_int_const_doc},
  {"list_types", (PyCFunction)ffi_list_types, METH_NOARGS,  ffi_list_types_doc},
+ {"map_file",   (PyCFunction)ffi_map_file,   METH_VKW,     ffi_map_file_doc},
  {"memmove",    (PyCFunction)ffi_memmove,    METH_VKW,     ffi_memmove_doc},
+ {"msync",      (PyCFunction)ffi_msync,      METH_O,       ffi_msync_doc},
  {"new",        (PyCFunction)ffi_new,        METH_VKW,     ffi_new_doc},
 {"new_allocator",(PyCFunction)ffi_new_allocator,METH_VKW,ffi_new_allocator_doc},
  {"new_handle", (PyCFunction)ffi_new_handle, METH_O,       ffi_new_handle_doc},
+#ifndef MS_WIN32
+ {"new_shared", (PyCFunction)ffi_new_shared, METH_VKW,     ffi_new_shared_doc},
+#endif
  {"offsetof",   (PyCFunction)ffi_offsetof,   METH_VARARGS, ffi_offsetof_doc},
+#ifndef MS_WIN32
+ {"open_shared",(PyCFunction)ffi_open_shared,METH_VKW,     ffi_open_shared_doc},
+#endif
  {"release",    (PyCFunction)ffi_release,    METH_O,       ffi_release_doc},
  {"sizeof",     (PyCFunction)ffi_sizeof,     METH_O,       ffi_sizeof_doc},
  {"string",     (PyCFunction)ffi_string,     METH_VKW,     ffi_string_doc},
@@ -399,14 +399,26 @@ static PyObject _dummy = {0};
 #define cffi_set_size(arg, value) cffi_atomic_store_ssize(&(arg)->ct_size, (value))
 #define cffi_get_size(arg) cffi_atomic_load_ssize(&(arg)->ct_size)
 #define _CFFI_LOAD_OP(arg) cffi_atomic_load(&(arg))
+#define cffi_load_ptr(arg) cffi_atomic_load((void **)&(arg))
+#define cffi_store_ptr(arg, value) cffi_atomic_store((void **)&(arg), (value))
 #else
 #define cffi_check_flag(arg) (arg)
 #define cffi_set_flag(arg, value) (arg) = (value)
 #define cffi_set_size(arg, value) (arg)->ct_size = (value)
 #define cffi_get_size(arg) (arg)->ct_size
 #define _CFFI_LOAD_OP(arg) (arg)
+#define cffi_load_ptr(arg) (arg)
+#define cffi_store_ptr(arg, value) (arg) = (value)
 #endif
 
+/* CFFI_LOCK() is a single process-wide lock, taken only to build or
+   complete types (including the lazy realization of structs and of
+   the types of out-of-line modules).  This can recursively need other
+   types, possibly from other FFI instances, so a single lock is used
+   to avoid lock-ordering issues.  The result is published with atomic
+   stores, and the code paths that only read already-built types, like
+   realize_c_type_or_func() and force_lazy_struct(), check for it first
+   without taking the lock. */
 #define CFFI_LOCK() Py_BEGIN_CRITICAL_SECTION(&_dummy)
 #define CFFI_UNLOCK() Py_END_CRITICAL_SECTION()
 
@@ -466,11 +466,44 @@ static int search_sorted(const char *const *base,
     return -1;
 }
 
+static int search_hashed(const char *const *base, size_t item_size,
+                         const int *slots, unsigned int mask,
+                         const char *search, size_t search_len)
+{
+    /* 32-bit FNV-1a, must match _name_hash() in recompiler.py.  Only
+       the low bits are used, so it doesn't matter if 'unsigned int'
+       has more than 32 bits. */
+    unsigned int h = 2166136261U;
+    size_t i;
+    const char *baseptr = (const char *)base;
+
+    for (i = 0; i < search_len; i++) {
+        h ^= (unsigned char)search[i];
+        h *= 16777619U;
+    }
+    while (1) {
+        int index = slots[h & mask];
+        const char *src;
+        if (index < 0)
+            return -1;
+        src = *(const char *const *)(baseptr + index * item_size);
+        if (strncmp(src, search, search_len) == 0 && src[search_len] == '\0')
+            return index;
+        h++;
+    }
+}
+
 #define MAKE_SEARCH_FUNC(FIELD)                                         \
   static                                                                \
   int search_in_##FIELD(const struct _cffi_type_context_s *ctx,         \
                         const char *search, size_t search_len)          \
   {                                                                     \
+      if ((ctx->flags & _CFFI_CTX_NAME_INDEX) &&                        \
+              ctx->name_index->FIELD != NULL)                           \
+          return search_hashed(&ctx->FIELD->name, sizeof(*ctx->FIELD),  \
+                               ctx->name_index->FIELD,                  \
+                               ctx->name_index->FIELD##_mask,           \
+                               search, search_len);                     \
       return search_sorted(&ctx->FIELD->name, sizeof(*ctx->FIELD),      \
                            ctx->num_##FIELD, search, search_len);       \
   }
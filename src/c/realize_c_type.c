@@ -121,10 +121,16 @@ static int init_builder_c(builder_c_t *builder,
     if (ldict == NULL)
         return -1;
 
-    if (ctx)
-        builder->ctx = *ctx;
-    else
-        memset(&builder->ctx, 0, sizeof(builder->ctx));
+    memset(&builder->ctx, 0, sizeof(builder->ctx));
+    if (ctx) {
+        /* modules made by older versions of cffi have a shorter
+           structure, ending at 'flags' */
+        if (ctx->flags & _CFFI_CTX_NAME_INDEX)
+            builder->ctx = *ctx;
+        else
+            memcpy(&builder->ctx, ctx,
+                   offsetof(struct _cffi_type_context_s, name_index));
+    }
 
     builder->types_dict = ldict;
     builder->included_ffis = NULL;
@@ -750,6 +756,15 @@ realize_c_type_or_func(builder_c_t *builder,
                         _cffi_opcode_t opcodes[], int index)
 {
     PyObject *x;
+    _cffi_opcode_t op = _CFFI_LOAD_OP(opcodes[index]);
+
+    if ((((uintptr_t)op) & 1) == 0) {
+        /* fast path, without the lock: already realized.  The object
+           is kept alive by 'opcodes' */
+        x = (PyObject *)op;
+        Py_INCREF(x);
+        return x;
+    }
     CFFI_LOCK();
     x = realize_c_type_or_func_lock_held(builder, opcodes, index);
     CFFI_UNLOCK();
@@ -4444,6 +4444,18 @@ def test_explicit_release_gc_contextmgr():
     assert p[0] == 12345  # true so far, but might change to raise RuntimeError
     release(p)   # no effect
 
+def test_gc_on_array_keeps_length():
+    BIntP = new_pointer_type(new_primitive_type("int"))
+    BIntArray = new_array_type(BIntP, None)
+    seen = []
+    p1 = newp(BIntArray, [10, 20, 30, 40, 50])
+    p = gcp(p1, seen.append)
+    assert typeof(p) is BIntArray
+    assert len(p) == 5
+    assert list(p) == [10, 20, 30, 40, 50]
+    release(p)
+    assert seen == [p1]
+
 def test_explicit_release_from_buffer():
     a = bytearray(b"xyz")
     BChar = new_primitive_type("char")
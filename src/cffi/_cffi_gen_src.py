@@ -28,7 +28,7 @@
 """Implementation of the ``cffi-gen-src`` command-line tool.
 
 This module is private; the command line is the only supported
-interface. Two subcommands:
+interface. Three subcommands:
 
 ``exec-python``
     Execute a Python script that constructs a :class:`cffi.FFI`
@@ -38,12 +38,22 @@ interface. Two subcommands:
 ``read-sources``
     Create the :class:`cffi.FFI` from a separate ``cdef`` file and C
     source prelude, then emit the generated C source.
+
+``batch``
+    Do the same for all the modules listed in a JSON manifest, in a
+    single process or in a pool of worker processes.
+
+With a depfile, the files read to create the :class:`cffi.FFI` are
+written to it in the Makefile syntax that Make and Ninja understand,
+and the module is only generated again if one of them changed.
 """
 
 import argparse
 import io
+import json
 import os
 import sys
+import traceback
 
 from .api import FFI
 
@@ -115,6 +125,175 @@ def write_c_source(output, generated):
         f.write(generated)
 
 
+def write_c_source_if_changed(output, generated):
+    """Like :func:`write_c_source`, but leave ``output`` untouched if
+    it already contains ``generated``.  Return True if it was written."""
+    if output != '-':
+        try:
+            with open(output, 'r', encoding='utf-8') as f:
+                if f.read() == generated:
+                    return False
+        except (OSError, UnicodeDecodeError):
+            pass
+    write_c_source(output, generated)
+    return True
+
+
+# ____________________________________________________________
+# Dependency tracking.  While a DependencyRecorder is active, an audit
+# hook records the files opened for reading, and the modules imported
+# are recorded too (their source may not be opened if a .pyc is used).
+# Files from the standard library, .pyc files and the cdef cache are
+# ignored.
+
+_current_recorder = None
+_audit_hook_installed = False
+
+
+def _audit_hook(event, args):
+    recorder = _current_recorder
+    if recorder is not None and event == 'open':
+        path, mode, flags = args
+        if mode is None:
+            reading = (flags & 3) == os.O_RDONLY      # from os.open()
+        else:
+            reading = not any(c in mode for c in 'wax+')
+        if reading and isinstance(path, (str, bytes, os.PathLike)):
+            recorder.add(os.fsdecode(path))
+
+
+def _get_library_dirs():
+    import sysconfig
+    paths = sysconfig.get_paths()
+    return tuple(set([os.path.join(os.path.abspath(paths[key]), '')
+                      for key in ('stdlib', 'platstdlib') if key in paths]))
+
+
+class DependencyRecorder(object):
+    """Context manager recording the files that the code running in it
+    depends on.  On exit, the modules it imported, except the ones from
+    the standard library, are removed from ``sys.modules``, so that
+    another build script importing them is executed as if in a new
+    process and gets them recorded too.
+    """
+
+    def __enter__(self):
+        global _current_recorder, _audit_hook_installed
+        # import now what FFI() and cdef() import lazily, to not record
+        # cffi itself as a dependency
+        import _cffi_backend
+        from . import cparser, recompiler
+        if not _audit_hook_installed:
+            sys.addaudithook(_audit_hook)
+            _audit_hook_installed = True
+        self._files = set()
+        self._library_dirs = _get_library_dirs()
+        self._old_modules = set(sys.modules)
+        _current_recorder = self
+        return self
+
+    def __exit__(self, *exc_info):
+        global _current_recorder
+        _current_recorder = None
+        for name in list(sys.modules):
+            if name in self._old_modules:
+                continue
+            filename = getattr(sys.modules[name], '__file__', None)
+            if filename is not None and self.add(filename):
+                del sys.modules[name]
+
+    def add(self, filename):
+        filename = os.path.abspath(filename)
+        if (filename.startswith(self._library_dirs) or
+                filename.endswith(('.pyc', '.cdef-cache')) or
+                not os.path.isfile(filename)):
+            return False
+        self._files.add(filename)
+        return True
+
+    def get_dependencies(self):
+        return sorted(self._files)
+
+
+def _escape_for_depfile(path):
+    return (path.replace('\\', '\\\\').replace(' ', '\\ ')
+                .replace('#', '\\#').replace('$', '$$'))
+
+def write_depfile(depfile, output, dependencies):
+    """Write ``depfile`` saying that ``output`` depends on the given
+    files, one per line."""
+    lines = [_escape_for_depfile(output) + ':']
+    lines += ['  ' + _escape_for_depfile(dep) for dep in dependencies]
+    with open(depfile, 'w', encoding='utf-8') as f:
+        f.write(' \\\n'.join(lines) + '\n')
+
+def read_depfile(depfile):
+    """Return the list of dependencies in a depfile written by
+    :func:`write_depfile`."""
+    with open(depfile, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    dependencies = []
+    for line in lines[1:]:
+        line = line.strip()
+        if line.endswith(' \\'):
+            line = line[:-2]
+        result = []
+        i = 0
+        while i < len(line):
+            if line[i] == '\\' and i + 1 < len(line):
+                i += 1
+            elif line[i] == '$' and line[i + 1:i + 2] == '$':
+                i += 1
+            result.append(line[i])
+            i += 1
+        dependencies.append(''.join(result))
+    return dependencies
+
+def is_up_to_date(output, depfile):
+    """Return True if ``output`` and ``depfile`` exist, and none of the
+    dependencies listed in ``depfile`` changed since it was written."""
+    try:
+        os.stat(output)
+        mtime = os.stat(depfile).st_mtime_ns
+        dependencies = read_depfile(depfile)
+        for dep in dependencies:
+            if os.stat(dep).st_mtime_ns >= mtime:
+                return False
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def generate(make_ffi, output, depfile=None, extra_dependencies=(),
+             force=False):
+    """Call ``make_ffi()`` and write the C source of the returned
+    :class:`FFI` to ``output``.
+
+    With a ``depfile``, skip everything if the depfile says that
+    ``output`` is up-to-date (unless ``force`` is true); otherwise
+    record the dependencies of ``make_ffi()`` in the depfile, together
+    with ``extra_dependencies``, and write ``output`` only if its content
+    changes.  Return False if nothing was generated.
+    """
+    if depfile is None:
+        write_c_source(output, generate_c_source(make_ffi()))
+        return True
+    if not force and is_up_to_date(output, depfile):
+        return False
+    with DependencyRecorder() as recorder:
+        ffi = make_ffi()
+    write_c_source_if_changed(output, generate_c_source(ffi))
+    excluded = set([os.path.abspath(output), os.path.abspath(depfile)])
+    dependencies = [dep for dep in recorder.get_dependencies()
+                    if dep not in excluded]
+    for dep in extra_dependencies:
+        dep = os.path.abspath(dep)
+        if dep not in dependencies:
+            dependencies.append(dep)
+    write_depfile(depfile, output, dependencies)
+    return True
+
+
 def same_input_file(file1, file2):
     if file1 is file2:
         return True
@@ -124,20 +303,110 @@ def same_input_file(file1, file2):
         return False
 
 
-def exec_python(*, output, pyfile, ffi_var):
+def _input_files(*files):
+    # the names of the input files, which are opened before the
+    # dependencies are recorded
+    return [f.name for f in files if f is not sys.stdin]
+
+
+def exec_python(*, output, pyfile, ffi_var, depfile=None, force=False,
+                extra_dependencies=()):
+    def make_ffi():
+        return find_ffi_in_python_script(pyfile.read(), pyfile.name, ffi_var)
+    extra_dependencies = _input_files(pyfile) + list(extra_dependencies)
     with pyfile:
-        ffi = find_ffi_in_python_script(pyfile.read(), pyfile.name, ffi_var)
-    generated = generate_c_source(ffi)
-    write_c_source(output, generated)
+        return generate(make_ffi, output, depfile, extra_dependencies, force)
 
 
-def read_sources(*, output, module_name, cdef_input, csrc_input):
+def read_sources(*, output, module_name, cdef_input, csrc_input,
+                 depfile=None, force=False, extra_dependencies=()):
+    def make_ffi():
+        return make_ffi_from_sources(module_name, cdef_input.read(),
+                                     csrc_input.read())
+    extra_dependencies = (_input_files(cdef_input, csrc_input) +
+                          list(extra_dependencies))
     with csrc_input, cdef_input:
-        csrc = csrc_input.read()
-        cdef = cdef_input.read()
-    ffi = make_ffi_from_sources(module_name, cdef, csrc)
-    generated = generate_c_source(ffi)
-    write_c_source(output, generated)
+        return generate(make_ffi, output, depfile, extra_dependencies, force)
+
+
+_MANIFEST_KEYS = {
+    'exec-python': (('pyfile', 'output'), ('ffi_var', 'depfile')),
+    'read-sources': (('module_name', 'cdef', 'csrc', 'output'), ('depfile',)),
+}
+
+def load_manifest(manifest):
+    """Read and check the JSON manifest of the ``batch`` subcommand: a
+    list of objects, each with a key ``"mode"`` and the arguments of
+    that subcommand."""
+    with open(manifest, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("%s: expected a list of modules" % (manifest,))
+    for i, entry in enumerate(entries):
+        where = '%s: entry %d' % (manifest, i)
+        if not isinstance(entry, dict) or entry.get('mode') not in (
+                _MANIFEST_KEYS):
+            raise ValueError("%s: expected an object with a 'mode' of "
+                             "'exec-python' or 'read-sources'" % (where,))
+        required, optional = _MANIFEST_KEYS[entry['mode']]
+        for key in required:
+            if not isinstance(entry.get(key), str):
+                raise ValueError("%s: missing %r" % (where, key))
+        for key in entry:
+            if key != 'mode' and key not in required + optional:
+                raise ValueError("%s: unknown key %r" % (where, key))
+    return entries
+
+
+def run_manifest_entry(entry, manifest, force=False):
+    """Process one entry of a manifest.  Returns None, or the error
+    message if it failed."""
+    try:
+        extra_dependencies = [manifest]
+        if entry['mode'] == 'exec-python':
+            exec_python(output=entry['output'],
+                        pyfile=open(entry['pyfile'], 'r', encoding='utf-8'),
+                        ffi_var=entry.get('ffi_var', 'ffibuilder'),
+                        depfile=entry.get('depfile'), force=force,
+                        extra_dependencies=extra_dependencies)
+        else:
+            read_sources(output=entry['output'],
+                         module_name=entry['module_name'],
+                         cdef_input=open(entry['cdef'], 'r', encoding='utf-8'),
+                         csrc_input=open(entry['csrc'], 'r', encoding='utf-8'),
+                         depfile=entry.get('depfile'), force=force,
+                         extra_dependencies=extra_dependencies)
+    except Exception:
+        return '%s: %s' % (entry['output'], traceback.format_exc())
+    return None
+
+
+def _run_manifest_entry_star(args):
+    return run_manifest_entry(*args)
+
+
+def batch(*, manifest, jobs=1, force=False):
+    """Process all the entries of ``manifest``, in up to ``jobs`` worker
+    processes (forked, so that cffi and pycparser are imported only
+    once).  Returns the list of error messages."""
+    entries = load_manifest(manifest)
+    tasks = [(entry, manifest, force) for entry in entries]
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    import multiprocessing
+    if (jobs > 1 and len(tasks) > 1 and
+            'fork' in multiprocessing.get_all_start_methods()):
+        from concurrent.futures import ProcessPoolExecutor
+        # make sure that the workers don't need to import them again
+        import _cffi_backend
+        from . import cparser, recompiler
+        mp_context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)),
+                                 mp_context=mp_context) as executor:
+            results = list(executor.map(_run_manifest_entry_star, tasks))
+    else:
+        results = [run_manifest_entry(*task) for task in tasks]
+    return [error for error in results if error is not None]
 
 
 def _prog():
@@ -164,6 +433,11 @@ exec_python_parser.add_argument(
     default='ffibuilder',
     help="Name of the FFI object in the Python script; defaults to 'ffibuilder'.",
 )
+exec_python_parser.add_argument(
+    '--depfile',
+    help='Write the files read by the Python script to this depfile, and '
+         'do nothing if none of them changed since the previous run',
+)
 exec_python_parser.add_argument(
     'pyfile',
     type=argparse.FileType('r', encoding='utf-8'),
@@ -178,6 +452,11 @@ read_sources_parser = subparsers.add_parser(
     'read-sources',
     help='Read cdef and C source prelude files that define an FFI object',
 )
+read_sources_parser.add_argument(
+    '--depfile',
+    help='Write the input files to this depfile, and do nothing if none '
+         'of them changed since the previous run',
+)
 read_sources_parser.add_argument(
     'module_name',
     help='Full name of the generated module, including packages',
@@ -197,11 +476,36 @@ read_sources_parser.add_argument(
     help='Output path for the C source',
 )
 
+batch_parser = subparsers.add_parser(
+    'batch',
+    help='Generate the C source of all the modules listed in a manifest',
+)
+batch_parser.add_argument(
+    '-j', '--jobs',
+    type=int,
+    default=1,
+    help='Number of worker processes; 0 means one per CPU.  Defaults to 1.',
+)
+batch_parser.add_argument(
+    '--force',
+    action='store_true',
+    help='Generate all the modules, even the ones that are up-to-date '
+         'according to their depfile',
+)
+batch_parser.add_argument(
+    'manifest',
+    help='JSON file with a list of modules, like {"mode": "exec-python", '
+         '"pyfile": ..., "output": ..., "depfile": ...} or {"mode": '
+         '"read-sources", "module_name": ..., "cdef": ..., "csrc": ..., '
+         '"output": ..., "depfile": ...}',
+)
+
 
 def run(args=None):
     args = parser.parse_args(args=args)
     if args.mode == 'exec-python':
-        exec_python(output=args.output, pyfile=args.pyfile, ffi_var=args.ffi_var)
+        exec_python(output=args.output, pyfile=args.pyfile,
+                    ffi_var=args.ffi_var, depfile=args.depfile)
     elif args.mode == 'read-sources':
         if same_input_file(args.cdef, args.csrc):
             parser.error('cdef and csrc are the same file and should not be')
@@ -210,7 +514,19 @@ def run(args=None):
             module_name=args.module_name,
             cdef_input=args.cdef,
             csrc_input=args.csrc,
+            depfile=args.depfile,
         )
+    elif args.mode == 'batch':
+        try:
+            errors = batch(manifest=args.manifest, jobs=args.jobs,
+                           force=args.force)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        for error in errors:
+            sys.stderr.write(error)
+        if errors:
+            parser.exit(1, '%d of the modules failed\n' % (len(errors),))
     else:
-        parser.error('a subcommand is required: exec-python or read-sources')
+        parser.error('a subcommand is required: exec-python, read-sources '
+                     'or batch')
     parser.exit(0)
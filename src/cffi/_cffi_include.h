@@ -130,6 +130,14 @@ extern "C" {
 # define _CFFI_UNUSED_FN  /* nothing */
 #endif
 
+/* with set_source(..., shards=N), the module is made of several C files;
+   the symbols they share are not static, but should not be exported */
+#if defined(__GNUC__) && !defined(_WIN32) && !defined(__CYGWIN__)
+# define _CFFI_HIDDEN  __attribute__((visibility("hidden")))
+#else
+# define _CFFI_HIDDEN  /* nothing */
+#endif
+
 #ifdef __cplusplus
 # ifndef _Bool
    typedef bool _Bool;   /* semi-hackish: C++ has no _Bool; bool is builtin */
@@ -234,12 +242,17 @@ extern "C" {
 
 struct _cffi_ctypedescr;
 
+#ifdef _CFFI_SHARDED
+_CFFI_HIDDEN extern void *_cffi_exports[_CFFI_NUM_EXPORTS];
+#else
 static void *_cffi_exports[_CFFI_NUM_EXPORTS];
+#endif
 
 #define _cffi_type(index)   (                           \
     assert((((uintptr_t)_cffi_types[index]) & 1) == 0), \
     (struct _cffi_ctypedescr *)_cffi_types[index])
 
+_CFFI_UNUSED_FN
 static PyObject *_cffi_init(const char *module_name, Py_ssize_t version,
                             const struct _cffi_type_context_s *ctx)
 {
@@ -138,6 +138,34 @@ static void _cffi_py_initialize(void)
     Py_InitializeEx(0);
 }
 
+#ifdef _CFFI_PYTHON_STARTUP_BYTECODE_MAGIC
+#include <marshal.h>
+#endif
+
+static PyObject *_cffi_get_init_code(void)
+{
+#ifdef _CFFI_PYTHON_STARTUP_BYTECODE_MAGIC
+    /* With ffi.embedding_init_code(..., precompile=True), we have the
+       marshalled code object in _CFFI_PYTHON_STARTUP_BYTECODE.  It can
+       only be loaded by the same version of Python as the one that did
+       the build; otherwise, or if loading fails for any reason, we
+       fall back to compiling the source code.
+    */
+    if (PyImport_GetMagicNumber() == _CFFI_PYTHON_STARTUP_BYTECODE_MAGIC) {
+        PyObject *pycode = PyMarshal_ReadObjectFromString(
+                               (const char *)_CFFI_PYTHON_STARTUP_BYTECODE,
+                               sizeof(_CFFI_PYTHON_STARTUP_BYTECODE));
+        if (pycode != NULL && PyCode_Check(pycode))
+            return pycode;
+        Py_XDECREF(pycode);
+    }
+    PyErr_Clear();
+#endif
+    return Py_CompileString(_CFFI_PYTHON_STARTUP_CODE,
+                            "<init code for '" _CFFI_MODULE_NAME "'>",
+                            Py_file_input);
+}
+
 static int _cffi_initialize_python(void)
 {
     /* This initializes Python, imports _cffi_backend, and then the
@@ -163,9 +191,7 @@ static int _cffi_initialize_python(void)
 
     /* Now run the Python code provided to ffi.embedding_init_code().
      */
-    pycode = Py_CompileString(_CFFI_PYTHON_STARTUP_CODE,
-                              "<init code for '" _CFFI_MODULE_NAME "'>",
-                              Py_file_input);
+    pycode = _cffi_get_init_code();
     if (pycode == NULL)
         goto error;
     global_dict = PyDict_New();
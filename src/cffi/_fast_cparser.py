@@ -0,0 +1,460 @@
+# A fast parser for the common subset of the cdef() sources: function
+# declarations, global variables and constants, typedefs, structs, unions
+# and enums whose values are simple numbers.  It builds the same AST as
+# pycparser, so that cparser.Parser turns it into the same model objects.
+# parse() returns None if the source uses anything outside this subset;
+# the caller then parses the source with pycparser, which also gives the
+# error message if the source is invalid.
+import re
+try:
+    from . import _pycparser as pycparser
+except ImportError:
+    import pycparser
+
+c_ast = pycparser.c_ast
+try:
+    Coord = pycparser.c_parser.Coord
+except AttributeError:
+    Coord = pycparser.plyparser.Coord     # pycparser < 3.0
+
+# the AST nodes of pycparser < 2.21 have no 'align'; don't try to build them
+enabled = 'align' in c_ast.Decl.__slots__
+
+
+# any other character is a token of its own, which the parser rejects
+_r_token = re.compile(r"[A-Za-z_][A-Za-z_0-9]*|0[xX][0-9a-fA-F]+[uUlL]*"
+                      r"|[1-9][0-9]*[uUlL]*|0[0-7]*[uUlL]*|\S")
+_NAME_START = frozenset('abcdefghijklmnopqrstuvwxyz'
+                        'ABCDEFGHIJKLMNOPQRSTUVWXYZ_')
+
+_SIMPLE_TYPES = frozenset(['void', '_Bool', 'char', 'short', 'int', 'long',
+                           'float', 'double', 'signed', 'unsigned'])
+_QUALIFIERS = frozenset(['const', 'volatile', 'restrict'])
+_STORAGE = frozenset(['typedef', 'extern', 'static'])
+# all the other keywords of pycparser: not supported here
+_KEYWORDS = _SIMPLE_TYPES | _QUALIFIERS | _STORAGE | frozenset([
+    'struct', 'union', 'enum', 'auto', 'break', 'case', 'continue',
+    'default', 'do', 'else', 'for', 'goto', 'if', 'inline', 'register',
+    'offsetof', 'return', 'sizeof', 'switch', 'while', '__int128',
+    '_Complex', '_Generic', '_Noreturn', '_Thread_local', '_Static_assert',
+    '_Atomic', '_Alignof', '_Alignas', '_Pragma'])
+_END_OF_EXPRESSION = frozenset([',', ';', '}', ']'])
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def parse(csource, typenames, filename):
+    """Parse the preprocessed 'csource' and return the list of top-level
+    declarations, or None.  'typenames' are the typedef names declared
+    outside 'csource'.
+    """
+    if not enabled:
+        return None
+    tokens = []
+    coords = []
+    findall = _r_token.findall
+    for line, text in enumerate(csource.split('\n'), 1):
+        line_tokens = findall(text)
+        if line_tokens:
+            tokens.extend(line_tokens)
+            coords.extend([Coord(filename, line)] * len(line_tokens))
+    tokens.append(None)
+    coords.append(None)
+    try:
+        return _FastParser(tokens, coords, typenames).parse_file()
+    except _Unsupported:
+        return None
+
+
+class _FastParser(object):
+
+    def __init__(self, tokens, coords, typenames):
+        self.tokens = tokens
+        self.coords = coords
+        self.pos = 0
+        self.typenames = set(typenames)
+        self.typenames.update(['__dotdotdot__', '__dotdotdotint__',
+                               '__dotdotdotfloat__'])
+        self.identifiers = set()
+
+    def expect(self, token):
+        if self.tokens[self.pos] != token:
+            raise _Unsupported
+        self.pos += 1
+
+    def is_name(self, token):
+        # an identifier that is neither a keyword nor a typedef name
+        return (token is not None and token[0] in _NAME_START
+                and token not in _KEYWORDS and token not in self.typenames)
+
+    # ----------
+    # declarations
+
+    def parse_file(self):
+        decls = []
+        tokens = self.tokens
+        while tokens[self.pos] is not None:
+            if tokens[self.pos] == ';':
+                self.pos += 1
+            else:
+                decls.extend(self.parse_declaration())
+        return decls
+
+    def parse_declaration(self):
+        quals, storage, spec = self.parse_specifiers(True)
+        tokens = self.tokens
+        if tokens[self.pos] == ';':
+            self.pos += 1
+            node = spec[1]
+            if node is None:
+                raise _Unsupported
+            return [c_ast.Decl(name=None, quals=quals, align=[],
+                               storage=storage, funcspec=[], type=node,
+                               init=None, bitsize=None, coord=node.coord)]
+        is_typedef = 'typedef' in storage
+        result = []
+        while True:
+            decl = self.parse_declarator(False)
+            init = None
+            if tokens[self.pos] == '=':
+                self.pos += 1
+                init = self.parse_expression()
+            if is_typedef:
+                declaration = c_ast.Typedef(name=None, quals=quals,
+                                            storage=storage, type=decl,
+                                            coord=decl.coord)
+            else:
+                declaration = c_ast.Decl(name=None, quals=quals, align=[],
+                                         storage=storage, funcspec=[],
+                                         type=decl, init=init, bitsize=None,
+                                         coord=decl.coord)
+            result.append(self.fix_decl_name_type(declaration, spec))
+            if tokens[self.pos] != ',':
+                break
+            self.pos += 1
+        self.expect(';')
+        for declaration in result:
+            # same checks as pycparser, which uses a single namespace for
+            # the typedefs and the other global names
+            name = declaration.name
+            if is_typedef:
+                if name in self.identifiers:
+                    raise _Unsupported
+                self.typenames.add(name)
+            else:
+                if name in self.typenames:
+                    raise _Unsupported
+                self.identifiers.add(name)
+        return result
+
+    def parse_specifiers(self, allow_storage):
+        # returns (quals, storage, spec), where 'spec' is a tuple
+        # (names, node, coord): either a list of names like ['unsigned',
+        # 'int'] and the coord of the first one, or a Struct, Union or
+        # Enum node
+        tokens = self.tokens
+        quals = []
+        storage = []
+        names = []
+        node = None
+        coord = None
+        while True:
+            token = tokens[self.pos]
+            if token in _QUALIFIERS:
+                quals.append(token)
+                self.pos += 1
+            elif token in _SIMPLE_TYPES:
+                if not names:
+                    coord = self.coords[self.pos]
+                names.append(token)
+                self.pos += 1
+            elif token == 'struct' or token == 'union' or token == 'enum':
+                if node is not None or names:
+                    raise _Unsupported    # "Invalid multiple types specified"
+                if token == 'enum':
+                    node = self.parse_enum()
+                else:
+                    node = self.parse_struct_or_union()
+            elif token in self.typenames:
+                if names or node is not None:
+                    break
+                coord = self.coords[self.pos]
+                names.append(token)
+                self.pos += 1
+            elif token in _STORAGE and allow_storage:
+                storage.append(token)
+                self.pos += 1
+            elif token in _KEYWORDS:
+                raise _Unsupported
+            else:
+                break
+        if node is not None:
+            if names:
+                raise _Unsupported
+        elif not names:
+            raise _Unsupported
+        return quals, storage, (names, node, coord)
+
+    def fix_decl_name_type(self, decl, spec):
+        # like pycparser.CParser._fix_decl_name_type()
+        typ = decl
+        while not isinstance(typ, c_ast.TypeDecl):
+            typ = typ.type
+        decl.name = typ.declname
+        typ.quals = decl.quals[:]
+        names, node, coord = spec
+        if node is not None:
+            typ.type = node
+        else:
+            typ.type = c_ast.IdentifierType(names[:], coord=coord)
+        return decl
+
+    # ----------
+    # structs, unions, enums
+
+    def parse_struct_or_union(self):
+        if self.tokens[self.pos] == 'struct':
+            klass = c_ast.Struct
+        else:
+            klass = c_ast.Union
+        self.pos += 1
+        token = self.tokens[self.pos]
+        coord = self.coords[self.pos]
+        if token is not None and token[0] in _NAME_START:
+            if token in _KEYWORDS:
+                raise _Unsupported
+            self.pos += 1
+            if self.tokens[self.pos] != '{':
+                return klass(name=token, decls=None, coord=coord)
+            self.pos += 1
+            return klass(name=token, decls=self.parse_struct_body(),
+                         coord=coord)
+        if token == '{':
+            self.pos += 1
+            return klass(name=None, decls=self.parse_struct_body(),
+                         coord=coord)
+        raise _Unsupported
+
+    def parse_struct_body(self):
+        tokens = self.tokens
+        decls = []
+        while tokens[self.pos] != '}':
+            if tokens[self.pos] == ';':
+                self.pos += 1
+                continue
+            quals, storage, spec = self.parse_specifiers(False)
+            if tokens[self.pos] == ';':
+                # no declarator: '__dotdotdot__;' or an anonymous nested
+                # struct or union
+                self.pos += 1
+                names, node, coord = spec
+                if node is None:
+                    if len(names) != 1:
+                        raise _Unsupported
+                    node = c_ast.IdentifierType(names, coord=coord)
+                decls.append(c_ast.Decl(name=None, quals=quals, align=[],
+                                        storage=[], funcspec=[], type=node,
+                                        init=None, bitsize=None,
+                                        coord=node.coord))
+                continue
+            while True:
+                decl = self.parse_declarator(False)
+                bitsize = None
+                if tokens[self.pos] == ':':
+                    self.pos += 1
+                    bitsize = self.parse_expression()
+                declaration = c_ast.Decl(name=None, quals=quals, align=[],
+                                         storage=[], funcspec=[], type=decl,
+                                         init=None, bitsize=bitsize,
+                                         coord=decl.coord)
+                decls.append(self.fix_decl_name_type(declaration, spec))
+                if tokens[self.pos] != ',':
+                    break
+                self.pos += 1
+            self.expect(';')
+        self.pos += 1
+        return decls
+
+    def parse_enum(self):
+        tokens = self.tokens
+        coord = self.coords[self.pos]
+        self.pos += 1
+        name = None
+        token = tokens[self.pos]
+        if token is not None and token[0] in _NAME_START:
+            if token in _KEYWORDS:
+                raise _Unsupported
+            name = token
+            self.pos += 1
+        if tokens[self.pos] != '{':
+            return c_ast.Enum(name, None, coord)
+        self.pos += 1
+        enumerators = []
+        while True:
+            token = tokens[self.pos]
+            if not self.is_name(token):
+                raise _Unsupported
+            enum_coord = self.coords[self.pos]
+            self.pos += 1
+            value = None
+            if tokens[self.pos] == '=':
+                self.pos += 1
+                value = self.parse_expression()
+            enumerators.append(c_ast.Enumerator(token, value, enum_coord))
+            if tokens[self.pos] == ',':
+                self.pos += 1
+                if tokens[self.pos] == '}':
+                    break
+            elif tokens[self.pos] == '}':
+                break
+            else:
+                raise _Unsupported
+        self.pos += 1
+        values = c_ast.EnumeratorList(enumerators, enumerators[0].coord)
+        return c_ast.Enum(name, values, coord)
+
+    def parse_expression(self):
+        # only a number or an identifier, optionally negated
+        tokens = self.tokens
+        negate = tokens[self.pos] == '-'
+        if negate:
+            self.pos += 1
+        token = tokens[self.pos]
+        coord = self.coords[self.pos]
+        if token is None:
+            raise _Unsupported
+        if '0' <= token[0] <= '9':
+            suffix = token[-3:].lower()
+            type = ('unsigned ' * suffix.count('u') +
+                    'long ' * suffix.count('l') + 'int')
+            expr = c_ast.Constant(type, token, coord)
+        elif self.is_name(token):
+            expr = c_ast.ID(token, coord)
+        else:
+            raise _Unsupported
+        self.pos += 1
+        if tokens[self.pos] not in _END_OF_EXPRESSION:
+            raise _Unsupported
+        if negate:
+            expr = c_ast.UnaryOp('-', expr, expr.coord)
+        return expr
+
+    # ----------
+    # declarators
+
+    def parse_declarator(self, abstract):
+        # returns the declarator, or None if 'abstract' and there is none
+        tokens = self.tokens
+        ptr = None
+        if tokens[self.pos] == '*':
+            ptr = self.parse_pointer()
+        token = tokens[self.pos]
+        if token == '(':
+            if tokens[self.pos + 1] != '*':
+                raise _Unsupported
+            self.pos += 1
+            decl = self.parse_declarator(abstract)
+            self.expect(')')
+        elif self.is_name(token):
+            decl = c_ast.TypeDecl(declname=token, quals=None, align=None,
+                                  type=None, coord=self.coords[self.pos])
+            self.pos += 1
+        elif not abstract:
+            raise _Unsupported
+        elif token == '[':
+            decl = self.parse_array_decl(
+                c_ast.TypeDecl(None, None, None, None), self.coords[self.pos])
+        else:
+            if ptr is None:
+                return None
+            return self.type_modify_decl(
+                c_ast.TypeDecl(None, None, None, None), ptr)
+        while True:
+            token = tokens[self.pos]
+            if token == '[':
+                decl = self.type_modify_decl(
+                    decl, self.parse_array_decl(None, decl.coord))
+            elif token == '(':
+                decl = self.type_modify_decl(
+                    decl, self.parse_function_decl(decl.coord))
+            else:
+                break
+        if ptr is not None:
+            decl = self.type_modify_decl(decl, ptr)
+        return decl
+
+    def parse_pointer(self):
+        tokens = self.tokens
+        ptr = None
+        while tokens[self.pos] == '*':
+            coord = self.coords[self.pos]
+            self.pos += 1
+            quals = []
+            while tokens[self.pos] in _QUALIFIERS:
+                quals.append(tokens[self.pos])
+                self.pos += 1
+            ptr = c_ast.PtrDecl(quals=quals, type=ptr, coord=coord)
+        return ptr
+
+    def parse_array_decl(self, base_type, coord):
+        self.expect('[')
+        dim = None
+        if self.tokens[self.pos] != ']':
+            dim = self.parse_expression()
+        self.expect(']')
+        return c_ast.ArrayDecl(type=base_type, dim=dim, dim_quals=[],
+                               coord=coord)
+
+    def parse_function_decl(self, coord):
+        self.expect('(')
+        if self.tokens[self.pos] == ')':
+            self.pos += 1
+            return c_ast.FuncDecl(args=None, type=None, coord=coord)
+        params = []
+        while True:
+            params.append(self.parse_parameter())
+            if self.tokens[self.pos] != ',':
+                break
+            self.pos += 1
+        self.expect(')')
+        args = c_ast.ParamList(params, params[0].coord)
+        return c_ast.FuncDecl(args=args, type=None, coord=coord)
+
+    def parse_parameter(self):
+        spec_coord = self.coords[self.pos]
+        quals, storage, spec = self.parse_specifiers(False)
+        decl = self.parse_declarator(True)
+        if decl is not None:
+            typ = decl
+            while not isinstance(typ, c_ast.TypeDecl):
+                typ = typ.type
+            if typ.declname is not None:
+                declaration = c_ast.Decl(name=None, quals=quals, align=[],
+                                         storage=[], funcspec=[], type=decl,
+                                         init=None, bitsize=None,
+                                         coord=decl.coord)
+                return self.fix_decl_name_type(declaration, spec)
+        typename = c_ast.Typename(
+            name='', quals=quals, align=None,
+            type=decl or c_ast.TypeDecl(None, None, None, None),
+            coord=spec_coord)
+        return self.fix_decl_name_type(typename, spec)
+
+    def type_modify_decl(self, decl, modifier):
+        # like pycparser.CParser._type_modify_decl()
+        modifier_head = modifier
+        modifier_tail = modifier
+        while modifier_tail.type:
+            modifier_tail = modifier_tail.type
+        if isinstance(decl, c_ast.TypeDecl):
+            modifier_tail.type = decl
+            return modifier
+        else:
+            decl_tail = decl
+            while not isinstance(decl_tail.type, c_ast.TypeDecl):
+                decl_tail = decl_tail.type
+            modifier_tail.type = decl_tail.type
+            decl_tail.type = modifier_head
+            return decl
@@ -0,0 +1,192 @@
+# asyncio integration: see "cffi.aio" in doc/source/using.rst
+import asyncio
+import socket
+import threading
+import weakref
+
+import _cffi_backend
+
+
+class _Wakeup(object):
+    """A socket pair registered in one event loop.  The C threads that
+    queue calls to deferred callbacks write a byte into the sockets of
+    all loops (only once per burst of calls), and the first loop that
+    runs does all the queued calls.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+        loop.add_reader(self.rsock.fileno(), self._on_readable)
+        _cffi_backend.add_callbacks_wakeup_fd(self.wsock.fileno())
+
+    def _on_readable(self):
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        _cffi_backend.drain_callbacks()
+
+    def close(self):
+        # when this returns, no C thread can still write to 'wsock'
+        _cffi_backend.remove_callbacks_wakeup_fd(self.wsock.fileno())
+        self.rsock.close()
+        self.wsock.close()
+
+_wakeups = {}        # {loop: _Wakeup}
+_wakeup_lock = threading.Lock()
+
+def _install_wakeup(loop):
+    # Each event loop gets its own wakeup socket.  The calls for
+    # callbacks bound to a loop can be done by any other loop, and are
+    # then forwarded with call_soon_threadsafe(); but the C threads wake
+    # up all loops, so that they are delivered even if the other loops
+    # are not running.
+    if not hasattr(_cffi_backend, 'add_callbacks_wakeup_fd'):
+        raise NotImplementedError("cffi.aio is not available on Windows")
+    with _wakeup_lock:
+        if loop in _wakeups:
+            return
+        for old_loop in [l for l in _wakeups if l.is_closed()]:
+            _wakeups.pop(old_loop).close()
+        _wakeups[loop] = _Wakeup(loop)
+
+
+class AsyncCallback(object):
+    """A C callback that delivers its calls to an asyncio event loop.
+
+    'self.callback' is a deferred callback of type 'cdecl' (see
+    ffi.callback(..., deferred=True)), which must return void.  It can be
+    called from any thread, and does not need the GIL.  Each call is
+    turned into a tuple of arguments, converted as usual to Python
+    objects, that can be retrieved with 'await self.get()' or with
+    'async for args in self'.  All the calls done while the loop is busy
+    are delivered together, with a single wakeup of the loop.
+
+    Arguments that are structs or unions are copied, but keep in mind
+    that pointer arguments must remain valid until the tuple is
+    processed.
+    """
+
+    def __init__(self, ffi, cdecl, loop=None, onerror=None):
+        if loop is None:
+            loop = asyncio.get_running_loop()
+        _install_wakeup(loop)
+        self._ffi = ffi
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        # a struct argument is a cdata pointing to memory that is only
+        # valid during the call to _received(), so we need to copy it
+        ctype = ffi.typeof(cdecl) if isinstance(cdecl, str) else cdecl
+        self._struct_args = [(i, ffi.getctype(argtype, '*'))
+                             for i, argtype in enumerate(ctype.args)
+                             if argtype.kind in ('struct', 'union')]
+        self.callback = ffi.callback(cdecl, self._received, onerror=onerror,
+                                     deferred=True)
+
+    def _received(self, *args):
+        # called with the GIL, from the loop or from another thread
+        if self._struct_args:
+            args = list(args)
+            for i, ptrtype in self._struct_args:
+                args[i] = self._ffi.new(ptrtype, args[i])[0]
+            args = tuple(args)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._queue.put_nowait(args)
+        else:
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, args)
+
+    def pending(self):
+        """Return the number of calls received but not retrieved yet."""
+        return self._queue.qsize()
+
+    async def get(self):
+        """Wait for the next call and return its arguments as a tuple."""
+        return await self._queue.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._queue.get()
+
+
+_OFFLOAD_MAX_PENDING = 1024
+_offload_max_pending = _OFFLOAD_MAX_PENDING
+_offload_semaphores = weakref.WeakKeyDictionary()
+
+def configure_offload(max_threads=None, max_pending=None):
+    """Configure offload().  'max_threads' is the maximum number of
+    native threads in the pool (default 4).  'max_pending' is the maximum
+    number of calls, per event loop, that are either running or waiting
+    for a thread (default 1024); more calls to offload() wait before
+    being submitted.  A new value of 'max_pending' only applies to event
+    loops that did not use offload() yet.
+    """
+    global _offload_max_pending
+    if max_threads is not None:
+        _cffi_backend.set_offload_threads(max_threads)
+    if max_pending is not None:
+        if max_pending < 1:
+            raise ValueError("max_pending must be at least 1")
+        _offload_max_pending = max_pending
+
+def _get_offload_semaphore(loop):
+    try:
+        return _offload_semaphores[loop]
+    except KeyError:
+        sem = asyncio.Semaphore(_offload_max_pending)
+        _offload_semaphores[loop] = sem
+        return sem
+
+async def offload(fn, *args):
+    """Call the C function 'fn' in a thread of a native thread pool,
+    and return its result.
+
+    'fn' is a cdata of type function pointer, or a function from the
+    'lib' of an out-of-line API-mode module.  The arguments are converted
+    to C immediately, in the current thread; the worker thread only does
+    the call, without taking the GIL.  The Python objects passed as
+    arguments are kept alive until the call is finished.  If the task is
+    cancelled, the call still runs until completion but its result is
+    ignored.
+    """
+    loop = asyncio.get_running_loop()
+    _install_wakeup(loop)
+    sem = _get_offload_semaphore(loop)
+    await sem.acquire()
+    future = loop.create_future()
+
+    def set_result(result, exc):
+        sem.release()
+        if future.done():      # cancelled
+            return
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+    def on_done(result, exc):
+        # called with the GIL, from the loop or from another thread
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            set_result(result, exc)
+        elif not loop.is_closed():
+            loop.call_soon_threadsafe(set_result, result, exc)
+
+    try:
+        _cffi_backend.offload_call(fn, args, on_done)
+    except BaseException:
+        sem.release()
+        raise
+    return await future
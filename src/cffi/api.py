@@ -11,6 +11,8 @@ except NameError:
 
 _unspecified = object()
 
+_CALLBACK_CACHE_SIZE = 256
+
 
 
 class FFI:
@@ -59,6 +61,7 @@ class FFI:
         self._backend = backend
         self._lock = allocate_lock()
         self._parser = cparser.Parser()
+        self._parser._cache_dir = cparser.default_cache_dir()
         self._cached_btypes = {}
         self._parsed_types = types.ModuleType('parsed_types').__dict__
         self._new_types = types.ModuleType('new_types').__dict__
@@ -68,8 +71,11 @@ class FFI:
         self._included_ffis = []
         self._windows_unicode = None
         self._init_once_cache = {}
+        self._callback_cache = {}
         self._cdef_version = None
         self._embedding = None
+        self._embedding_precompile = False
+        self._embedding_start_function = None
         self._typecache = model.get_typecache(backend)
         if hasattr(backend, 'set_ffi'):
             backend.set_ffi(self)
@@ -104,6 +110,17 @@ class FFI:
         """
         self._cdef(csource, override=override, packed=packed, pack=pack)
 
+    def set_cdef_cache(self, dirname):
+        """Cache the result of parsing the following calls to cdef() in
+        the given directory, so that the same calls done by another
+        process are much faster.  The default comes from the environment
+        variable CFFI_CDEF_CACHE_DIR.  Use None to disable the cache.
+        The files contain pickles: the directory must not be writable by
+        untrusted users.
+        """
+        with self._lock:
+            self._parser._cache_dir = dirname
+
     def embedding_api(self, csource, packed=False, pack=None):
         self._cdef(csource, packed=packed, pack=pack, dllexport=True)
         if self._embedding is None:
@@ -358,6 +375,28 @@ class FFI:
         return self._backend.from_buffer(cdecl, python_buffer,
                                          require_writable)
 
+    def map_file(self, cdecl, path, mode='r', offset=0, length=None,
+                 advice=None):
+        """Map the file 'path' into memory and return a cdata of the
+        given array or pointer type that points to the mapped data, like
+        from_buffer().  'mode' is 'r' (read-only), 'r+' (writes go to
+        the file) or 'c' (private copy-on-write).  'offset' and 'length'
+        select a part of the file; by default, all of it.  'advice' is an
+        optional madvise() hint: 'normal', 'random', 'sequential',
+        'willneed' or 'dontneed'.  Use release() to unmap the file at a
+        known time.
+        """
+        if isinstance(cdecl, basestring):
+            cdecl = self._typeof(cdecl)
+        return self._backend.map_file(cdecl, path, mode, offset, length,
+                                      advice)
+
+    def msync(self, cdata):
+        """Flush the changes done to a cdata returned by map_file() back
+        to the file on disk.
+        """
+        self._backend.msync(cdata)
+
     def memmove(self, dest, src, n):
         """ffi.memmove(dest, src, n) copies n bytes of memory from src to dest.
 
@@ -374,18 +413,27 @@ class FFI:
         """
         return self._backend.memmove(dest, src, n)
 
-    def callback(self, cdecl, python_callable=None, error=None, onerror=None):
+    def callback(self, cdecl, python_callable=None, error=None, onerror=None,
+                 deferred=False):
         """Return a callback object or a decorator making such a
         callback object.  'cdecl' must name a C function pointer type.
         The callback invokes the specified 'python_callable' (which may
         be provided either directly or via a decorator).  Important: the
         callback object must be manually kept alive for as long as the
         callback may be invoked from the C level.
+
+        If 'deferred' is true, the C function type must return void.
+        When C code calls the callback, the arguments are only queued;
+        the Python function is called later from the main thread, or by
+        drain_callbacks().
         """
         def callback_decorator_wrap(python_callable):
             if not callable(python_callable):
                 raise TypeError("the 'python_callable' argument "
                                 "is not callable")
+            if deferred:
+                return self._backend.callback(cdecl, python_callable,
+                                              error, onerror, True)
             return self._backend.callback(cdecl, python_callable,
                                           error, onerror)
         if isinstance(cdecl, basestring):
@@ -395,6 +443,68 @@ class FFI:
         else:
             return callback_decorator_wrap(python_callable)  # direct mode
 
+    def drain_callbacks(self):
+        """Call now the Python functions of all the deferred callbacks
+        that were invoked from C, in the order of the invocations.
+        Returns the number of calls done.
+        """
+        return self._backend.drain_callbacks()
+
+    def callback_cache(self, cdecl, python_callable, error=None,
+                       onerror=None):
+        """Like callback(), but return the same callback object if called
+        again with the same 'cdecl', 'python_callable', 'error' and
+        'onerror'.  The callback objects are kept alive by the ffi
+        object; only the most recently used ones are kept.  Unlike
+        callback(), this cannot be used as a decorator.  The C function
+        pointer of a callback that drops out of the cache is reused by
+        the next callbacks: if C code may call it later, keep the
+        callback object alive yourself.
+        """
+        if not callable(python_callable):
+            raise TypeError("the 'python_callable' argument "
+                            "is not callable")
+        if isinstance(cdecl, basestring):
+            cdecl = self._typeof(cdecl, consider_function_as_funcptr=True)
+        # the type of 'error' is part of the key: e.g. 0 and 0.0 are
+        # equal, but not equally valid as the error value of an 'int'
+        key = (cdecl, python_callable, type(error), error, onerror)
+        try:
+            hash(key)
+        except TypeError:
+            return self.callback(cdecl, python_callable, error, onerror)
+        with self._lock:
+            cache = self._callback_cache
+            res = cache.pop(key, None)
+            if res is None:
+                res = self.callback(cdecl, python_callable, error, onerror)
+                if len(cache) >= _CALLBACK_CACHE_SIZE:
+                    del cache[next(iter(cache))]   # least recently used
+            cache[key] = res
+        return res
+
+    def new_shared(self, cdecl, name, init=None):
+        """Like new(), but allocate the memory in a new POSIX shared
+        memory object called 'name'.  Other processes can attach to the
+        same memory with open_shared(cdecl, name).  Releasing the returned
+        cdata, explicitly with release() or when it is garbage-collected,
+        unmaps the memory and removes the name.  Not available on Windows.
+        """
+        if isinstance(cdecl, basestring):
+            cdecl = self._typeof(cdecl)
+        return self._backend.new_shared(cdecl, name, init)
+
+    def open_shared(self, cdecl, name, readonly=False):
+        """Attach to the POSIX shared memory object 'name' made by
+        new_shared() in any process.  Return a cdata of the given array
+        or pointer type that points to the shared memory, like
+        from_buffer().  Releasing it only unmaps the memory in this
+        process.  Not available on Windows.
+        """
+        if isinstance(cdecl, basestring):
+            cdecl = self._typeof(cdecl)
+        return self._backend.open_shared(cdecl, name, readonly)
+
     def getctype(self, cdecl, replace_with=''):
         """Return a string giving the C type 'cdecl', which may be itself
         a string or a <ctype> object.  If 'replace_with' is given, it gives
@@ -411,7 +521,7 @@ class FFI:
             replace_with = ' ' + replace_with
         return self._backend.getcname(cdecl, replace_with)
 
-    def gc(self, cdata, destructor, size=0):
+    def gc(self, cdata, destructor, size=0, batch=False):
         """Return a new cdata object that points to the same
         data.  Later, when this new cdata object is garbage-collected,
         'destructor(old_cdata_object)' will be called.
@@ -420,9 +530,21 @@ class FFI:
         trigger the garbage collection more eagerly.  So far only used
         on PyPy.  It tells the GC that the returned object keeps alive
         roughly 'size' bytes of external memory.
+
+        If 'batch' is true, 'destructor' must be a C function taking one
+        pointer argument.  Its calls are then queued and done later, in
+        batches and without the GIL; see gc_flush().
         """
+        if batch:
+            return self._backend.gcp(cdata, destructor, size, batch=True)
         return self._backend.gcp(cdata, destructor, size)
 
+    def gc_flush(self):
+        """Call now all the destructors queued by gc(..., batch=True).
+        Returns the number of destructors called.
+        """
+        return self._backend.gc_flush()
+
     def _get_cached_btype(self, type):
         assert self._lock.acquire(False) is False
         # call me with the lock!
@@ -536,6 +658,16 @@ class FFI:
     def from_handle(self, x):
         return self._backend.from_handle(x)
 
+    def handle_table(self):
+        """Return a new, empty handle table.  It is an alternative to
+        new_handle() and from_handle() for programs with many handles:
+        'table.add(x)' returns a 'void *' handle for any Python object x,
+        'table.get(p)' returns x, and 'table.remove(p)' returns x and
+        invalidates p.  Unlike with from_handle(), using a handle that
+        was removed raises ValueError instead of crashing.
+        """
+        return self._backend.new_handle_table(self.BVoidP)
+
     def release(self, x):
         self._backend.release(x)
 
@@ -637,6 +769,9 @@ class FFI:
         if os.sep in module_name or (os.altsep and os.altsep in module_name):
             raise ValueError("'module_name' must not contain '/': use a dotted "
                              "name to make a 'package.module' location")
+        shards = kwds.get('shards', 1)
+        if not isinstance(shards, int) or shards < 1:
+            raise ValueError("'shards' must be a positive integer")
         self._assigned_source = (str(module_name), source,
                                  source_extension, kwds)
 
@@ -702,7 +837,9 @@ class FFI:
                   c_file=filename, call_c_compiler=False,
                   uses_ffiplatform=False, **kwds)
 
-    def compile(self, tmpdir='.', verbose=0, target=None, debug=None):
+    def compile(self, tmpdir='.', verbose=0, target=None, debug=None,
+                cache_dir=_unspecified, lto=False, optimize=None,
+                training=None):
         """The 'target' argument gives the final file name of the
         compiled DLL.  Use '*' to force distutils' choice, suitable for
         regular CPython C API modules.  Use a file name ending in '.*'
@@ -711,15 +848,44 @@ class FFI:
 
         The default is '*' when building a non-embedded C API extension,
         and (module_name + '.*') when building an embedded library.
+
+        If 'cache_dir' is a directory, the compiled modules are stored
+        there, and reused instead of calling the C compiler if all the
+        inputs are the same.  The default comes from the environment
+        variable CFFI_BUILD_CACHE_DIR.
+
+        If 'lto' is true, the module is built with link-time optimization.
+        If 'optimize' is 'pgo', it is built with profile-guided
+        optimization: 'training' must be a function, which is called
+        as training(module) in a forked process with a first, instrumented
+        build of the module; the module is then compiled again using the
+        collected profile.  The build cache is not used in this case.
         """
         from .recompiler import recompile
+        from .ffiplatform import get_build_cache_dir
         #
         if not hasattr(self, '_assigned_source'):
             raise ValueError("set_source() must be called before compile()")
+        if optimize not in (None, 'pgo'):
+            raise ValueError("optimize must be None or 'pgo', not %r"
+                             % (optimize,))
+        if optimize == 'pgo':
+            if not callable(training):
+                raise TypeError("optimize='pgo' needs a 'training' function")
+            if self._embedding is not None:
+                raise ValueError("optimize='pgo' is not supported for "
+                                 "embedded modules")
+            cache_dir = None
+        elif training is not None:
+            raise ValueError("'training' is only used with optimize='pgo'")
+        if cache_dir is _unspecified:
+            cache_dir = get_build_cache_dir()
         module_name, source, source_extension, kwds = self._assigned_source
         return recompile(self, module_name, source, tmpdir=tmpdir,
                          target=target, source_extension=source_extension,
-                         compiler_verbose=verbose, debug=debug, **kwds)
+                         compiler_verbose=verbose, debug=debug,
+                         cache_dir=cache_dir, lto=lto, optimize=optimize,
+                         training=training, **kwds)
 
     def init_once(self, func, tag):
         # Read _init_once_cache[tag], which is either (False, lock) if
@@ -745,7 +911,8 @@ class FFI:
             self._init_once_cache[tag] = (True, result)
         return result
 
-    def embedding_init_code(self, pysource):
+    def embedding_init_code(self, pysource, precompile=False,
+                            start_function=None):
         if self._embedding:
             raise ValueError("embedding_init_code() can only be called once")
         # fix 'pysource' before it gets dumped into the C file:
@@ -769,7 +936,14 @@ class FFI:
         #
         compile(pysource, "cffi_init", "exec")
         #
+        if start_function is not None:
+            if not re.match(r'[A-Za-z_][A-Za-z0-9_]*$', start_function):
+                raise ValueError("start_function must be a C identifier, "
+                                 "got %r" % (start_function,))
+        #
         self._embedding = pysource
+        self._embedding_precompile = bool(precompile)
+        self._embedding_start_function = start_function
 
     def def_extern(self, *args, **kwds):
         raise ValueError("ffi.def_extern() is only available on API-mode FFI "
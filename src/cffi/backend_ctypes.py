@@ -1008,7 +1008,7 @@ class CTypesBackend:
 
     _weakref_cache_ref = None
 
-    def gcp(self, cdata, destructor, size=0):
+    def gcp(self, cdata, destructor, size=0, batch=False):
         if self._weakref_cache_ref is None:
             import weakref
             class MyRef(weakref.ref):
@@ -1045,6 +1045,10 @@ class CTypesBackend:
         weak_cache[MyRef(new_cdata, remove)] = (cdata, destructor)
         return new_cdata
 
+    def gc_flush(self):
+        # 'batch' is ignored by gcp() here: destructors are never queued
+        return 0
+
     typeof = type
 
     def getcname(self, BType, replace_with):
@@ -177,6 +177,9 @@ F_PACKED        = 0x04
 F_EXTERNAL      = 0x08
 F_OPAQUE        = 0x10
 
+CTX_EXTERN_PYTHON = 0x01
+CTX_NAME_INDEX    = 0x02
+
 G_FLAGS = dict([('_CFFI_' + _key, globals()[_key])
                 for _key in ['F_UNION', 'F_CHECK_FIELDS', 'F_PACKED',
                              'F_EXTERNAL', 'F_OPAQUE']])
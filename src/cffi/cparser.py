@@ -1,11 +1,11 @@
-from . import model
+from . import model, _fast_cparser
 from .commontypes import COMMON_TYPES, resolve_common_type
 from .error import FFIError, CDefError
 try:
     from . import _pycparser as pycparser
 except ImportError:
     import pycparser
-import weakref, re, sys
+import weakref, re, sys, os
 
 try:
     if sys.version_info < (3,):
@@ -34,7 +34,7 @@ _r_partial_enum = re.compile(r"=\s*\.\.\.\s*[,}]|\.\.\.\s*\}")
 _r_enum_dotdotdot = re.compile(r"__dotdotdot\d+__$")
 _r_partial_array = re.compile(r"\[\s*\.\.\.\s*\]")
 _r_words = re.compile(r"\w+|\S")
-_parser_cache = None
+_use_fast_parser = True      # see _fast_cparser.py
 _r_int_literal = re.compile(r"-?0?x?[0-9a-f]+[lu]*$", re.IGNORECASE)
 _r_stdcall1 = re.compile(r"\b(__stdcall|WINAPI)\b")
 _r_stdcall2 = re.compile(r"[(]\s*(__stdcall|WINAPI)\b")
@@ -47,11 +47,63 @@ _r_int_dotdotdot = re.compile(r"(\b(int|long|short|signed|unsigned|char)\s*)+"
                               r"\.\.\.")
 _r_float_dotdotdot = re.compile(r"\b(double|float)\s*\.\.\.")
 
+class _CParser(pycparser.CParser):
+    # The typedef names declared by previous calls to cdef() are given
+    # to pycparser in 'outer_typenames', which acts like a scope around
+    # the global scope of the source.  Before, we would add a line
+    # 'typedef int X;' in front of the source for each of them, making
+    # a long series of small cdef() calls quadratic.
+    outer_typenames = extra_typenames = frozenset()
+
+    def _is_outer_type(self, name):
+        return name in self.outer_typenames or name in self.extra_typenames
+
+    def _is_type_in_scope(self, name):
+        for scope in reversed(self._scope_stack):
+            if name in scope:
+                return scope[name]
+        return self._is_outer_type(name)
+
+    def _add_identifier(self, name, coord):
+        if (len(self._scope_stack) == 1 and name not in self._scope_stack[0]
+                and self._is_outer_type(name)):
+            self._parse_error("Non-typedef %r previously declared as typedef "
+                              "in this scope" % (name,), coord)
+        pycparser.CParser._add_identifier(self, name, coord)
+
+_use_outer_typenames = (
+    hasattr(pycparser.CParser, '_is_type_in_scope') and
+    hasattr(pycparser.CParser, '_add_identifier'))
+
+# A pycparser.CParser instance is not thread-safe, but several instances
+# can parse concurrently.  We keep a pool of the idle ones: a thread that
+# finds the pool empty makes a new instance, and gives it back when done.
+# The pool never holds more instances than the maximum number of threads
+# that were parsing at the same time.  'lock' only protects the pool.
+_parser_pool = []
+
 def _get_parser():
-    global _parser_cache
-    if _parser_cache is None:
-        _parser_cache = pycparser.CParser()
-    return _parser_cache
+    if lock is not None:
+        lock.acquire()
+    try:
+        if _parser_pool:
+            return _parser_pool.pop()
+    finally:
+        if lock is not None:
+            lock.release()
+    if _use_outer_typenames:
+        return _CParser()
+    else:
+        return pycparser.CParser()
+
+def _release_parser(parser):
+    if lock is not None:
+        lock.acquire()
+    try:
+        _parser_pool.append(parser)
+    finally:
+        if lock is not None:
+            lock.release()
 
 def _workaround_for_old_pycparser(csource):
     # Workaround for a pycparser issue (fixed between pycparser 2.10 and
@@ -145,24 +197,26 @@ def _preprocess_extern_python(csource):
     parts.append(csource)
     return ''.join(parts)
 
-def _warn_for_string_literal(csource):
+def _warn(message):
+    import warnings
+    warnings.warn(message)
+
+def _warn_for_string_literal(csource, warn):
     if '"' not in csource:
         return
     for line in csource.splitlines():
         if '"' in line and not line.lstrip().startswith('#'):
-            import warnings
-            warnings.warn("String literal found in cdef() or type source. "
-                          "String literals are ignored here, but you should "
-                          "remove them anyway because some character sequences "
-                          "confuse pre-parsing.")
+            warn("String literal found in cdef() or type source. "
+                 "String literals are ignored here, but you should "
+                 "remove them anyway because some character sequences "
+                 "confuse pre-parsing.")
             break
 
-def _warn_for_non_extern_non_static_global_variable(decl):
+def _warn_for_non_extern_non_static_global_variable(decl, warn):
     if not decl.storage:
-        import warnings
-        warnings.warn("Global variable '%s' in cdef(): for consistency "
-                      "with C it should have a storage class specifier "
-                      "(usually 'extern')" % (decl.name,))
+        warn("Global variable '%s' in cdef(): for consistency "
+             "with C it should have a storage class specifier "
+             "(usually 'extern')" % (decl.name,))
 
 def _remove_line_directives(csource):
     # _r_line_directive matches whole lines, without the final \n, if they
@@ -186,7 +240,7 @@ def _put_back_line_directives(csource, line_directives):
         return line_directives[int(s[6:])]
     return _r_line_directive.sub(replace, csource)
 
-def _preprocess(csource):
+def _preprocess(csource, warn=_warn):
     # First, remove the lines of the form '#line N "filename"' because
     # the "filename" part could confuse the rest
     csource, line_directives = _remove_line_directives(csource)
@@ -219,7 +273,7 @@ def _preprocess(csource):
     csource = _preprocess_extern_python(csource)
     #
     # Now there should not be any string literal left; warn if we get one
-    _warn_for_string_literal(csource)
+    _warn_for_string_literal(csource, warn)
     #
     # Replace "[...]" with "[__dotdotdotarray__]"
     csource = _r_partial_array.sub('[__dotdotdotarray__]', csource)
@@ -292,10 +346,106 @@ def _common_type_names(csource):
     return words_used
 
 
+def default_cache_dir():
+    return os.environ.get('CFFI_CDEF_CACHE_DIR') or None
+
+def _sha256_hex(text):
+    import hashlib
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _cdef_cache_key(prev_digest, options, anonymous_counter, csource):
+    from . import __version__
+    return _sha256_hex('\0'.join([
+        'cffi cdef cache', __version__, getattr(pycparser, '__version__', ''),
+        sys.version, prev_digest, repr(sorted(options.items())),
+        str(anonymous_counter), csource]))
+
+def _find_identity_types(declarations):
+    # Find the StructOrUnionOrEnum types reachable from 'declarations',
+    # without going inside them.  Returns {id(tp): (pid, tp)}, where
+    # 'pid' is the name of a declaration and the path from there.
+    result = {}
+    def walk(tp, path):
+        if isinstance(tp, model.StructOrUnionOrEnum):
+            if id(tp) not in result:
+                result[id(tp)] = ((name, path), tp)
+        elif isinstance(tp, model.BaseType):
+            for attr in tp._attrs_:
+                value = getattr(tp, attr)
+                if isinstance(value, tuple):
+                    for i, item in enumerate(value):
+                        walk(item, path + ((attr, i),))
+                else:
+                    walk(value, path + ((attr, None),))
+    for name in sorted(declarations):
+        walk(declarations[name][0], ())
+    return result
+
+def _resolve_identity_type(declarations, pid):
+    name, path = pid
+    tp = declarations[name][0]
+    for attr, i in path:
+        tp = getattr(tp, attr)
+        if i is not None:
+            tp = tp[i]
+    return tp
+
+def _reissue_warnings(caught):
+    import warnings
+    for category, message in caught:
+        warnings.warn(message, category, stacklevel=5)
+
+def _load_cdef_cache(filename, prev_decls):
+    import pickle
+    class Unpickler(pickle.Unpickler):
+        def persistent_load(self, pid):
+            kind, name = pid
+            if kind == 'common':
+                return COMMON_TYPES[name]
+            return _resolve_identity_type(prev_decls, name)
+    try:
+        with open(filename, 'rb') as f:
+            return Unpickler(f).load()
+    except Exception:
+        return None      # missing or broken file: ignore
+
+def _store_cdef_cache(filename, changes, prev_types):
+    # several processes may write the same file concurrently: write to
+    # a temporary file and rename it, so that readers see either no
+    # file or a complete one
+    import pickle, tempfile
+    common_types = dict([(id(tp), name) for name, tp in COMMON_TYPES.items()
+                         if isinstance(tp, model.StructOrUnionOrEnum)])
+    class Pickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            if isinstance(obj, model.StructOrUnionOrEnum):
+                entry = prev_types.get(id(obj))
+                if entry is not None:
+                    return ('decl', entry[0])
+                if id(obj) in common_types:
+                    return ('common', common_types[id(obj)])
+            return None
+    try:
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                Pickler(f, pickle.HIGHEST_PROTOCOL).dump(changes)
+            os.replace(tmpname, filename)
+        except:
+            os.unlink(tmpname)
+            raise
+    except Exception:
+        pass      # the cache is only an optimization
+
+
 class Parser:
 
     def __init__(self):
         self._declarations = {}
+        self._typedef_names = set()
         self._included_declarations = set()
         self._anonymous_counter = 0
         self._structnode2type = weakref.WeakKeyDictionary()
@@ -303,26 +453,40 @@ class Parser:
         self._int_constants = {}
         self._recomplete = []
         self._uses_new_feature = None
+        # a digest of everything done so far to this Parser, used as part
+        # of the key in the cdef cache; None if not known
+        self._cdef_digest = ''
+        self._cache_dir = None
+        self._inside_parse = False
+        # if not None, a list that collects the warnings instead of
+        # issuing them
+        self._caught_warnings = None
+
+    def _warn(self, message):
+        if self._caught_warnings is not None:
+            self._caught_warnings.append((UserWarning, message))
+        else:
+            _warn(message)
 
     def _parse(self, csource):
-        csource, macros = _preprocess(csource)
+        csource, macros = _preprocess(csource, self._warn)
         # XXX: for more efficiency we would need to poke into the
         # internals of CParser...  the following registers the
         # typedefs, because their presence or absence influences the
         # parsing itself (but what they are typedef'ed to plays no role)
         ctn = _common_type_names(csource)
-        typenames = []
-        for name in sorted(self._declarations):
-            if name.startswith('typedef '):
-                name = name[8:]
-                typenames.append(name)
-                ctn.discard(name)
-        typenames += sorted(ctn)
-        #
+        if _use_fast_parser:
+            decls = _fast_cparser.parse(csource, self._typedef_names | ctn,
+                                        CDEF_SOURCE_STRING)
+            if decls is not None:
+                return decls, macros, csource
         csourcelines = []
         csourcelines.append('# 1 "<cdef automatic initialization code>"')
-        for typename in typenames:
-            csourcelines.append('typedef int %s;' % typename)
+        if not _use_outer_typenames:
+            typenames = sorted(self._typedef_names)
+            typenames += sorted(ctn - self._typedef_names)
+            for typename in typenames:
+                csourcelines.append('typedef int %s;' % typename)
         csourcelines.append('typedef int __dotdotdotint__, __dotdotdotfloat__,'
                             ' __dotdotdot__;')
         # this forces pycparser to consider the following in the file
@@ -331,17 +495,30 @@ class Parser:
         csourcelines.append(csource)
         csourcelines.append('')   # see test_missing_newline_bug
         fullcsource = '\n'.join(csourcelines)
-        if lock is not None:
-            lock.acquire()     # pycparser is not thread-safe...
+        parser = _get_parser()
         try:
-            ast = _get_parser().parse(fullcsource)
+            if _use_outer_typenames:
+                parser.outer_typenames = self._typedef_names
+                parser.extra_typenames = ctn
+            try:
+                ast = parser.parse(fullcsource)
+            finally:
+                if _use_outer_typenames:
+                    parser.outer_typenames = frozenset()
+                    parser.extra_typenames = frozenset()
         except pycparser.c_parser.ParseError as e:
             self.convert_pycparser_error(e, csource)
         finally:
-            if lock is not None:
-                lock.release()
+            _release_parser(parser)
+        # find the first "__dotdotdot__" and use that as a separator
+        # between the repeated typedefs and the real csource
+        for i, decl in enumerate(ast.ext):
+            if decl.name == '__dotdotdot__':
+                break
+        else:
+            assert 0
         # csource will be used to find buggy source text
-        return ast, macros, csource
+        return ast.ext[i + 1:], macros, csource
 
     def _convert_pycparser_error(self, e, csource):
         # xxx look for "<cdef source string>:NUM:" at the start of str(e)
@@ -383,31 +560,100 @@ class Parser:
         else:
             pack = 0
         prev_options = self._options
+        prev_digest = self._cdef_digest
+        self._cdef_digest = None    # unless we succeed
         try:
             self._options = {'override': override,
                              'packed': pack,
                              'dllexport': dllexport}
-            self._internal_parse(csource)
+            self._inside_parse = True
+            if prev_digest is not None:
+                key = _cdef_cache_key(prev_digest, self._options,
+                                      self._anonymous_counter, csource)
+            else:
+                key = None
+            if key is not None and self._cache_dir is not None:
+                self._cached_internal_parse(csource, key)
+            else:
+                self._internal_parse(csource)
+            self._cdef_digest = key
         finally:
+            self._inside_parse = False
             self._options = prev_options
 
+    # ----------
+    # The cdef cache.  For each call to parse(), we store in the cache
+    # directory the changes done to the Parser, as a pickle.  Its key
+    # is a digest of the source and options, and of everything done to
+    # this Parser before.  The StructOrUnionOrEnum types already
+    # present before are pickled as references to their name in
+    # '_declarations', because they must keep their identity.
+
+    def _cached_internal_parse(self, csource, key):
+        prev_decls = self._declarations.copy()
+        filename = os.path.join(self._cache_dir, key + '.cdef-cache')
+        changes = _load_cdef_cache(filename, prev_decls)
+        if changes is not None:
+            self._apply_cached_changes(changes, prev_decls)
+            _reissue_warnings(changes['warnings'])
+            return
+        #
+        prev_types = _find_identity_types(prev_decls)
+        prev_dicts = dict([(id(tp), tp.__dict__.copy())
+                           for pid, tp in prev_types.values()])
+        prev_constants = self._int_constants.copy()
+        prev_recomplete = len(self._recomplete)
+        # collect the warnings, which must be stored in the cache too
+        caught = self._caught_warnings = []
+        try:
+            self._internal_parse(csource)
+        finally:
+            self._caught_warnings = None
+        _reissue_warnings(caught)
+        #
+        changes = {
+            'declarations': dict(
+                [(name, value) for name, value in self._declarations.items()
+                               if prev_decls.get(name) is not value]),
+            'int_constants': dict(
+                [(name, value) for name, value in self._int_constants.items()
+                               if name not in prev_constants]),
+            'attributes': [],
+            'recomplete': self._recomplete[prev_recomplete:],
+            'anonymous_counter': self._anonymous_counter,
+            'uses_new_feature': self._uses_new_feature,
+            'warnings': caught,
+        }
+        for pid, tp in prev_types.values():
+            prev_dict = prev_dicts[id(tp)]
+            attrs = dict([(attr, value) for attr, value in tp.__dict__.items()
+                          if attr not in prev_dict
+                             or prev_dict[attr] is not value])
+            if attrs:
+                changes['attributes'].append((pid, attrs))
+        _store_cdef_cache(filename, changes, prev_types)
+
+    def _apply_cached_changes(self, changes, prev_decls):
+        for name, value in changes['declarations'].items():
+            self._declare(name, value[0], quals=value[1])
+        for name, value in changes['int_constants'].items():
+            self._add_constants(name, value)
+        for pid, attrs in changes['attributes']:
+            _resolve_identity_type(prev_decls, pid).__dict__.update(attrs)
+        self._recomplete.extend(changes['recomplete'])
+        self._anonymous_counter = changes['anonymous_counter']
+        if self._uses_new_feature is None:
+            self._uses_new_feature = changes['uses_new_feature']
+
     def _internal_parse(self, csource):
-        ast, macros, csource = self._parse(csource)
+        decls, macros, csource = self._parse(csource)
         # add the macros
         self._process_macros(macros)
-        # find the first "__dotdotdot__" and use that as a separator
-        # between the repeated typedefs and the real csource
-        iterator = iter(ast.ext)
-        for decl in iterator:
-            if decl.name == '__dotdotdot__':
-                break
-        else:
-            assert 0
         current_decl = None
         #
         try:
             self._inside_extern_python = '__cffi_extern_python_stop'
-            for decl in iterator:
+            for decl in decls:
                 current_decl = decl
                 if isinstance(decl, pycparser.c_ast.Decl):
                     self._parse_decl(decl)
@@ -432,8 +678,7 @@ class Parser:
                     self._declare('typedef ' + decl.name, realtype, quals=quals)
                 elif decl.__class__.__name__ == 'Pragma':
                     # skip pragma, only in pycparser 2.15
-                    import warnings
-                    warnings.warn(
+                    self._warn(
                         "#pragma in cdef() are entirely ignored. "
                         "They should be removed for now, otherwise your "
                         "code might behave differently in a future version "
@@ -554,21 +799,26 @@ class Parser:
                     if (quals & model.Q_CONST) and not tp.is_array_type:
                         self._declare('constant ' + decl.name, tp, quals=quals)
                     else:
-                        _warn_for_non_extern_non_static_global_variable(decl)
+                        _warn_for_non_extern_non_static_global_variable(
+                            decl, self._warn)
                         self._declare('variable ' + decl.name, tp, quals=quals)
 
     def parse_type(self, cdecl):
         return self.parse_type_and_quals(cdecl)[0]
 
     def parse_type_and_quals(self, cdecl):
-        ast, macros = self._parse('void __dummy(\n%s\n);' % cdecl)[:2]
+        decls, macros = self._parse('void __dummy(\n%s\n);' % cdecl)[:2]
         assert not macros
-        exprnode = ast.ext[-1].type.args.params[0]
+        exprnode = decls[-1].type.args.params[0]
         if isinstance(exprnode, pycparser.c_ast.ID):
             raise CDefError("unknown identifier '%s'" % (exprnode.name,))
         return self._get_type_and_quals(exprnode.type)
 
     def _declare(self, name, obj, included=False, quals=0):
+        if not self._inside_parse and self._cdef_digest is not None:
+            # e.g. ffi.typeof("struct foo *") declares 'struct foo'
+            self._cdef_digest = _sha256_hex(
+                '%s\0declare\0%s' % (self._cdef_digest, name))
         if name in self._declarations:
             prevobj, prevquals = self._declarations[name]
             if prevobj is obj and prevquals == quals:
@@ -579,6 +829,8 @@ class Parser:
                     "try cdef(xx, override=True))" % (name,))
         assert '__dotdotdot__' not in name.split()
         self._declarations[name] = (obj, quals)
+        if name.startswith('typedef '):
+            self._typedef_names.add(name[8:])
         if included:
             self._included_declarations.add(obj)
 
@@ -979,6 +1231,11 @@ class Parser:
         return tp
 
     def include(self, other):
+        if self._cdef_digest is not None and other._cdef_digest is not None:
+            digest = _sha256_hex('%s\0include\0%s' % (self._cdef_digest,
+                                                        other._cdef_digest))
+        else:
+            digest = None
         for name, (tp, quals) in other._declarations.items():
             if name.startswith('anonymous $enum_$'):
                 continue   # fix for test_anonymous_enum_include
@@ -987,6 +1244,7 @@ class Parser:
                 self._declare(name, tp, included=True, quals=quals)
         for k, v in other._int_constants.items():
             self._add_constants(k, v)
+        self._cdef_digest = digest
 
     def _get_unknown_type(self, decl):
         typenames = decl.type.type.names
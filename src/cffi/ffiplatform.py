@@ -12,12 +12,24 @@ def get_extension(srcfilename, modname, sources=(), **kwds):
         allsources.append(os.path.normpath(src))
     return Extension(name=modname, sources=allsources, **kwds)
 
-def compile(tmpdir, ext, compiler_verbose=0, debug=None):
-    """Compile a C extension module using distutils."""
+def compile(tmpdir, ext, compiler_verbose=0, debug=None, cache_dir=None,
+            lto=False, optimize=None, training=None, jobs=1):
+    """Compile a C extension module using distutils.  If 'cache_dir' is
+    given, look there first for the result of an identical build.
+    If 'lto' is true, use link-time optimization.  If 'optimize' is
+    'pgo', do a profile-guided build: see _build_with_pgo().  If 'jobs'
+    is more than 1, compile up to that many source files at once."""
 
     saved_environ = os.environ.copy()
     try:
-        outputfilename = _build(tmpdir, ext, compiler_verbose, debug)
+        if lto:
+            ext = _with_extra_args(ext, *_get_lto_args())
+        if optimize == 'pgo':
+            outputfilename = _build_with_pgo(tmpdir, ext, compiler_verbose,
+                                             debug, training, jobs)
+        else:
+            outputfilename = _build(tmpdir, ext, compiler_verbose, debug,
+                                    cache_dir, jobs)
         outputfilename = os.path.abspath(outputfilename)
     finally:
         # workaround for a distutils bugs where some env vars can
@@ -27,7 +39,8 @@ def compile(tmpdir, ext, compiler_verbose=0, debug=None):
                 os.environ[key] = value
     return outputfilename
 
-def _build(tmpdir, ext, compiler_verbose=0, debug=None):
+def _build(tmpdir, ext, compiler_verbose=0, debug=None, cache_dir=None,
+           jobs=1):
     # XXX compact but horrible :-(
     from cffi._shimmed_dist_utils import Distribution, CompileError, LinkError, set_threshold, set_verbosity
 
@@ -45,9 +58,23 @@ def _build(tmpdir, ext, compiler_verbose=0, debug=None):
         old_level = set_threshold(0) or 0
         try:
             set_verbosity(compiler_verbose)
-            dist.run_command('build_ext')
             cmd_obj = dist.get_command_obj('build_ext')
+            if cache_dir is not None:
+                cmd_obj.ensure_finalized()
+                [soname] = cmd_obj.get_outputs()
+                key = _build_cache_key(ext, debug, soname, options)
+                if _build_cache_fetch(cache_dir, key, soname):
+                    if compiler_verbose:
+                        print('using the cached build of %s from %r' % (
+                            ext.name, cache_dir))
+                    return soname
+            if jobs > 1:
+                # e.g. with set_source(..., shards=N)
+                _compile_sources_in_parallel(cmd_obj, jobs)
+            dist.run_command('build_ext')
             [soname] = cmd_obj.get_outputs()
+            if cache_dir is not None:
+                _build_cache_store(cache_dir, key, soname)
         finally:
             set_threshold(old_level)
     except (CompileError, LinkError) as e:
@@ -55,6 +82,272 @@ def _build(tmpdir, ext, compiler_verbose=0, debug=None):
     #
     return soname
 
+def _with_extra_args(ext, compile_args, link_args):
+    # return a copy of 'ext' with more compiler and linker arguments
+    import copy
+    ext = copy.copy(ext)
+    ext.extra_compile_args = list(ext.extra_compile_args or ()) + compile_args
+    ext.extra_link_args = list(ext.extra_link_args or ()) + link_args
+    return ext
+
+def _get_lto_args():
+    # the arguments apply to all the 'sources' of the extension; the
+    # libraries that are linked with it are only optimized if they
+    # were themselves compiled for LTO
+    if sys.platform == 'win32':
+        return ['/GL'], ['/LTCG']
+    return ['-flto'], ['-flto']
+
+def _build_with_pgo(tmpdir, ext, compiler_verbose, debug, training, jobs):
+    # Profile-guided optimization, with GCC or clang: build the module
+    # with instrumentation, run training(module) in a forked process,
+    # and build the module again with the profile written by that process
+    import shutil
+    if not hasattr(os, 'fork'):
+        raise VerificationError("optimize='pgo' needs os.fork(), which is "
+                                "not available on this platform")
+    profile_dir = os.path.abspath(os.path.join(tmpdir,
+                                               ext.name + '.profile'))
+    shutil.rmtree(profile_dir, ignore_errors=True)
+    args = ['-fprofile-generate=' + profile_dir]
+    instrumented = _with_extra_args(ext, args, args)
+    soname = _build(tmpdir, instrumented, compiler_verbose, debug, None, jobs)
+    _run_training(os.path.abspath(soname), ext.name, training)
+    _merge_llvm_profiles(profile_dir)
+    args = ['-fprofile-use=' + profile_dir, '-fprofile-correction',
+            '-Wno-missing-profile']
+    return _build(tmpdir, _with_extra_args(ext, args, args),
+                  compiler_verbose, debug, None, jobs)
+
+def _run_training(soname, module_name, training):
+    import importlib.util, traceback
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            spec = importlib.util.spec_from_file_location(module_name, soname)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            training(module)
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            try:
+                _exit_with_destructors(status)
+            finally:
+                os._exit(status)
+    pid, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise VerificationError("the training of %s for optimize='pgo' "
+                                "failed" % (module_name,))
+
+def _exit_with_destructors(status):
+    # unlike os._exit(), the C function exit() runs the destructors of
+    # the shared libraries, which is where the instrumented module writes
+    # its profile
+    from .api import FFI
+    ffi = FFI()
+    ffi.cdef("void exit(int);")
+    ffi.dlopen(None).exit(status)
+
+def _merge_llvm_profiles(profile_dir):
+    # clang writes raw profiles that must be merged before being used
+    import glob, shutil, subprocess
+    raw_profiles = glob.glob(os.path.join(profile_dir, '*.profraw'))
+    if not raw_profiles:
+        return
+    llvm_profdata = shutil.which('llvm-profdata')
+    if llvm_profdata is None:
+        raise VerificationError("optimize='pgo' with clang needs the "
+                                "'llvm-profdata' tool")
+    subprocess.check_call([llvm_profdata, 'merge', '-output=' +
+                           os.path.join(profile_dir, 'default.profdata')] +
+                          raw_profiles)
+
+def _compile_sources_in_parallel(cmd_obj, jobs):
+    # patch the 'build_ext' command object 'cmd_obj' so that its
+    # compiler compiles up to 'jobs' source files of an extension at once
+    orig_build_extension = cmd_obj.build_extension
+    def build_extension(ext):
+        use_parallel_compile(cmd_obj.compiler, jobs)
+        return orig_build_extension(ext)
+    cmd_obj.build_extension = build_extension
+
+def use_parallel_compile(compiler, jobs):
+    """Patch the distutils 'compiler' instance so that its compile()
+    method runs up to 'jobs' compilations in parallel.  Only for the
+    compilers that use the default compile() method, like on Unix.
+    """
+    from cffi._shimmed_dist_utils import CCompiler
+    if jobs <= 1 or type(compiler).compile is not CCompiler.compile:
+        return
+    if getattr(compiler, '_cffi_parallel_jobs', 1) >= jobs:
+        return
+    compiler._cffi_parallel_jobs = jobs
+
+    def compile(sources, output_dir=None, macros=None, include_dirs=None,
+                debug=0, extra_preargs=None, extra_postargs=None,
+                depends=None):
+        # same as CCompiler.compile(), with a thread pool
+        from concurrent.futures import ThreadPoolExecutor
+        macros, objects, extra_postargs, pp_opts, build = (
+            compiler._setup_compile(output_dir, macros, include_dirs,
+                                    sources, depends, extra_postargs))
+        cc_args = compiler._get_cc_args(pp_opts, debug, extra_preargs)
+        def compile_one(obj):
+            try:
+                src, ext = build[obj]
+            except KeyError:
+                return
+            compiler._compile(obj, src, ext, cc_args, extra_postargs,
+                              pp_opts)
+        if objects:
+            with ThreadPoolExecutor(max_workers=min(jobs, len(objects))) \
+                    as executor:
+                list(executor.map(compile_one, objects))
+        return objects
+    compiler.compile = compile
+
+# ____________________________________________________________
+# The build cache.  The key is a hash of everything that goes into the
+# build: the sources and other files named in the Extension, the files
+# in its 'include_dirs', the libraries found in its 'library_dirs', the
+# options, the compiler and its flags, and the versions of Python and
+# cffi.  Headers and libraries from the system directories are not
+# included.  The value is a copy of the compiled module.
+
+BUILD_CACHE_MAX_SIZE = 1024 * 1024 * 1024
+
+def get_build_cache_dir():
+    return os.environ.get('CFFI_BUILD_CACHE_DIR') or None
+
+def _get_build_cache_max_size():
+    try:
+        return int(os.environ['CFFI_BUILD_CACHE_MAX_SIZE'])
+    except (KeyError, ValueError):
+        return BUILD_CACHE_MAX_SIZE
+
+def _build_cache_key(ext, debug, soname, options):
+    import hashlib, shutil, sysconfig
+    from . import __version__
+    h = hashlib.sha256()
+    def add(*items):
+        h.update(repr(items).encode('utf-8'))
+    def add_file(path):
+        add(path)
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(65536)
+                    if not data:
+                        break
+                    h.update(data)
+        except OSError:
+            add('<missing>')
+    #
+    add('cffi build cache', __version__, sys.version, sys.platform,
+        sysconfig.get_config_var('EXT_SUFFIX'),
+        sysconfig.get_config_var('SOABI'),
+        os.path.basename(soname), bool(debug), sorted(options.items()))
+    for var in ['CC', 'CXX', 'CFLAGS', 'CCSHARED', 'CPPFLAGS', 'LDSHARED',
+                'LDCXXSHARED', 'LDFLAGS', 'OPT', 'ARCHFLAGS']:
+        add(var, sysconfig.get_config_var(var), os.environ.get(var))
+    cc = (os.environ.get('CC') or sysconfig.get_config_var('CC') or '').split()
+    if cc:
+        path = shutil.which(cc[0])
+        if path:
+            st = os.stat(path)
+            add(path, st.st_size, st.st_mtime)
+    #
+    for attr in sorted(vars(ext)):
+        add(attr, getattr(ext, attr))
+    for path in (list(ext.sources) + list(ext.depends or ()) +
+                 list(ext.extra_objects or ())):
+        add_file(path)
+    for dirname in ext.include_dirs or ():
+        for root, dirs, files in os.walk(dirname):
+            dirs.sort()
+            for filename in sorted(files):
+                add_file(os.path.join(root, filename))
+    for dirname in ext.library_dirs or ():
+        for libname in ext.libraries or ():
+            for pattern in ['lib%s.so', 'lib%s.a', 'lib%s.dylib', '%s.lib']:
+                path = os.path.join(dirname, pattern % (libname,))
+                if os.path.exists(path):
+                    add_file(path)
+    return h.hexdigest()
+
+def _build_cache_path(cache_dir, key, soname):
+    # keep the extension, because it matters on some platforms
+    return os.path.join(cache_dir, key + '-' + os.path.basename(soname))
+
+def _copy_atomically(src, dst):
+    # copy to a temporary file in the same directory and rename it: other
+    # processes see either the old file or the complete new one, and a
+    # process that has got the old one loaded is not disturbed
+    import shutil, tempfile
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)),
+                                   suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            with open(src, 'rb') as g:
+                shutil.copyfileobj(g, f)
+        shutil.copymode(src, tmpname)
+        os.replace(tmpname, dst)
+    except:
+        os.unlink(tmpname)
+        raise
+
+def _build_cache_fetch(cache_dir, key, soname):
+    cached = _build_cache_path(cache_dir, key, soname)
+    try:
+        os.utime(cached, None)     # most recently used
+        _copy_atomically(cached, soname)
+    except OSError:
+        return False
+    return True
+
+def _build_cache_store(cache_dir, key, soname):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        cached = _build_cache_path(cache_dir, key, soname)
+        _copy_atomically(soname, cached)
+        _build_cache_evict(cache_dir, _get_build_cache_max_size(), cached)
+    except OSError:
+        pass      # the cache is only an optimization
+
+def _build_cache_evict(cache_dir, max_size, keep):
+    # remove the least recently used entries until we fit in 'max_size',
+    # but never the entry 'keep' that we just added
+    entries = []
+    total = 0
+    for filename in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, filename)
+        if filename.endswith('.tmp'):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if path != keep:
+            entries.append((st.st_mtime, path, st.st_size))
+        total += st.st_size
+    entries.sort()
+    for mtime, path, size in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+
 try:
     from os.path import samefile
 except ImportError:
@@ -70,8 +70,17 @@ class BaseTypeByIdentity:
 
 
 class BaseType(BaseTypeByIdentity):
+    # Instances of these classes are never modified after __init__(), so
+    # their hash, items and C names are computed only once.  These cached
+    # values are not pickled, because the hash depends on the process.
+    _cached_hash = None
+    _cached_items = None
+    _cached_c_name = None
+    _cached_c_names = None
 
     def __eq__(self, other):
+        if self is other:
+            return True
         return (self.__class__ == other.__class__ and
                 self._get_items() == other._get_items())
 
@@ -79,7 +88,44 @@ class BaseType(BaseTypeByIdentity):
         return not self == other
 
     def __hash__(self):
-        return hash((self.__class__, tuple(self._get_items())))
+        result = self._cached_hash
+        if result is None:
+            result = hash((self.__class__, self._get_items()))
+            self._cached_hash = result
+        return result
+
+    def _get_items(self):
+        result = self._cached_items
+        if result is None:
+            result = tuple([(name, getattr(self, name))
+                            for name in self._attrs_])
+            self._cached_items = result
+        return result
+
+    def get_c_name(self, replace_with='', context='a C file', quals=0):
+        cache = self._cached_c_names
+        if cache is None:
+            cache = self._cached_c_names = {}
+        key = (replace_with, quals)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        result = BaseTypeByIdentity.get_c_name(self, replace_with, context,
+                                               quals)
+        cache[key] = result
+        return result
+
+    def _get_c_name(self):
+        result = self._cached_c_name
+        if result is None:
+            result = self.c_name_with_marker.replace('&', '')
+            self._cached_c_name = result
+        return result
+
+    def __getstate__(self):
+        return dict([(key, value) for (key, value) in self.__dict__.items()
+                     if not key.startswith('_cached_')])
 
 
 class VoidType(BaseType):
@@ -142,6 +142,23 @@ struct _cffi_typename_s {
                          OP_STRUCT which is itself opaque */
 };
 
+/* Optional hash tables to look up names in the sorted arrays of
+   _cffi_type_context_s, emitted for large arrays.  Each table has
+   'mask + 1' slots, a power of two; a slot contains an index in the
+   array, or -1 if free.  Lookups use the 32-bit FNV-1a hash of the
+   name and linear probing.  A NULL table means "use binary search".
+*/
+struct _cffi_name_index_s {
+    const int *globals;
+    const int *struct_unions;
+    const int *enums;
+    const int *typenames;
+    unsigned int globals_mask;
+    unsigned int struct_unions_mask;
+    unsigned int enums_mask;
+    unsigned int typenames_mask;
+};
+
 struct _cffi_type_context_s {
     _cffi_opcode_t *types;
     const struct _cffi_global_s *globals;
@@ -155,8 +172,13 @@ struct _cffi_type_context_s {
     int num_typenames;
     const char *const *includes;
     int num_types;
-    int flags;      /* future extension */
+    int flags;      /* _CFFI_CTX_xxx flags below */
+    /* the following fields are only present if the corresponding
+       flag is set, and must not be read otherwise */
+    const struct _cffi_name_index_s *name_index;   /* _CFFI_CTX_NAME_INDEX */
 };
+#define _CFFI_CTX_EXTERN_PYTHON  0x01   // uses extern "Python"
+#define _CFFI_CTX_NAME_INDEX     0x02   // has the 'name_index' field
 
 struct _cffi_parse_info_s {
     const struct _cffi_type_context_s *ctx;
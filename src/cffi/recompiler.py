@@ -137,11 +137,16 @@ class TypenameExpr:
 class Recompiler:
     _num_externpy = 0
 
-    def __init__(self, ffi, module_name, target_is_python=False):
+    def __init__(self, ffi, module_name, target_is_python=False,
+                 shared_wrappers=False):
         self.ffi = ffi
         self.module_name = module_name
         self.target_is_python = target_is_python
+        self.shared_wrappers = shared_wrappers
         self._version = VERSION_BASE
+        self._shard_files = None
+        self._shared_wrappers_done = set()
+        self._sorted_declarations = None
 
     def needs_version(self, ver):
         self._version = max(self._version, ver)
@@ -234,16 +239,32 @@ class Recompiler:
                 for _, x in tp._get_items():
                     self._do_collect_type(x)
 
+    def _get_sorted_declarations(self):
+        # the declarations, sorted and split only once for all the steps
+        # of _generate(): a list of (name, kind, realname, tp, quals)
+        if self._sorted_declarations is None:
+            lst = []
+            for name, (tp, quals) in sorted(
+                    self.ffi._parser._declarations.items()):
+                kind, realname = name.split(' ', 1)
+                lst.append((name, kind, realname, tp, quals))
+            self._sorted_declarations = lst
+        return self._sorted_declarations
+
     def _generate(self, step_name):
-        lst = self.ffi._parser._declarations.items()
-        for name, (tp, quals) in sorted(lst):
-            kind, realname = name.split(' ', 1)
+        methods = {}
+        for name, kind, realname, tp, quals in (
+                self._get_sorted_declarations()):
             try:
-                method = getattr(self, '_generate_cpy_%s_%s' % (kind,
-                                                                step_name))
-            except AttributeError:
-                raise VerificationError(
-                    "not implemented in recompile(): %r" % name)
+                method = methods[kind]
+            except KeyError:
+                try:
+                    method = getattr(self, '_generate_cpy_%s_%s' % (
+                        kind, step_name))
+                except AttributeError:
+                    raise VerificationError(
+                        "not implemented in recompile(): %r" % name)
+                methods[kind] = method
             try:
                 self._current_quals = quals
                 method(tp, realname)
@@ -289,6 +310,10 @@ class Recompiler:
     def _prnt(self, what=''):
         self._f.write(what + '\n')
 
+    def _prnt_lines(self, lines):
+        # same as calling _prnt() for each line, but with a single write
+        self._f.write(''.join([line + '\n' for line in lines]))
+
     def write_source_to_f(self, f, preamble):
         if self.target_is_python:
             assert preamble is None
@@ -297,13 +322,59 @@ class Recompiler:
             assert preamble is not None
             self.write_c_source_to_f(f, preamble)
 
+    NAME_INDEX_MIN_SIZE = 16
+
+    def _write_name_index(self):
+        # hash tables to find names in the large sorted arrays without
+        # a binary search; see _cffi_name_index_s in parse_c_type.h
+        prnt = self._prnt
+        tables = []
+        for step_name in ["global", "struct_union", "enum", "typename"]:
+            names = [entry.name for entry in self._lsts[step_name]]
+            if len(names) < self.NAME_INDEX_MIN_SIZE:
+                tables.append((step_name, None, 0))
+                continue
+            slots = _make_name_index(names)
+            prnt('static const int _cffi_%ss_index[] = {' % (step_name,))
+            for i in range(0, len(slots), 16):
+                prnt(','.join([str(n) for n in slots[i:i+16]]) + ',')
+            prnt('};')
+            prnt()
+            tables.append((step_name, '_cffi_%ss_index' % (step_name,),
+                           len(slots) - 1))
+        if not [table for table in tables if table[1] is not None]:
+            return False
+        prnt('static const struct _cffi_name_index_s _cffi_name_index = {')
+        for step_name, table, mask in tables:
+            prnt('  %s,' % (table or 'NULL',))
+        for step_name, table, mask in tables:
+            prnt('  %d,' % (mask,))
+        prnt('};')
+        prnt()
+        return True
+
     def _rel_readlines(self, filename):
         with open(os.path.join(os.path.dirname(__file__), filename), 'r') as g:
             return g.readlines()
 
-    def write_c_source_to_f(self, f, preamble):
+    def write_c_source_to_f(self, f, preamble, shards=None):
+        """Write the C source to 'f'.  If 'shards' is a tuple
+        (header_name, header_f, shard_files), then the wrappers of the
+        functions are instead written round-robin to the files in the
+        list 'shard_files'.  Everything they need is written to
+        'header_f', which 'f' and the shard files include by name.
+        """
         self._f = f
         prnt = self._prnt
+        if shards is not None:
+            if self.ffi._embedding is not None:
+                raise VerificationError("an embedded module cannot be "
+                                        "split into several C files")
+            header_name, header_f, self._shard_files = shards
+            self._prototypes = []
+            self._num_function_decls = 0
+            self._f = header_f
+            prnt('#define _CFFI_SHARDED')
         if self.ffi._embedding is not None:
             prnt('#define _CFFI_USE_EMBEDDING')
         if not USE_LIMITED_API:
@@ -323,6 +394,8 @@ class Recompiler:
             prnt('static const char _CFFI_PYTHON_STARTUP_CODE[] = {')
             self._print_string_literal_in_array(self.ffi._embedding)
             prnt('0 };')
+            if self.ffi._embedding_precompile:
+                self._print_precompiled_init_code()
             prnt('#ifdef PYPY_VERSION')
             prnt('# define _CFFI_PYTHON_STARTUP_FUNC  _cffi_pypyinit_%s' % (
                 base_module_name,))
@@ -335,8 +408,22 @@ class Recompiler:
             lines[i:i+1] = self._rel_readlines('_cffi_errors.h')
             prnt(''.join(lines))
             self.needs_version(VERSION_EMBEDDED)
+            if self.ffi._embedding_start_function is not None:
+                prnt('CFFI_DLLEXPORT int %s(void)' % (
+                    self.ffi._embedding_start_function,))
+                prnt('{')
+                prnt('    return cffi_start_python();')
+                prnt('}')
+                prnt()
         #
         # then paste the C source given by the user, verbatim.
+        if self._shard_files is not None:
+            # it is included in every shard, which only needs its
+            # declarations: see _generate_cpy_function_wrappers()
+            prnt('#ifdef __GNUC__')
+            prnt('#  pragma GCC diagnostic ignored "-Wunused-function"')
+            prnt('#  pragma GCC diagnostic ignored "-Wunused-variable"')
+            prnt('#endif')
         prnt('/************************************************************/')
         prnt()
         prnt(preamble)
@@ -344,14 +431,27 @@ class Recompiler:
         prnt('/************************************************************/')
         prnt()
         #
+        storage = 'static'
+        if self._shard_files is not None:
+            storage = '_CFFI_HIDDEN'
+            prnt('_CFFI_HIDDEN extern void *_cffi_types[];')
+            prnt()
+            for self._f in [f] + self._shard_files:
+                prnt('#include "%s"' % (header_name,))
+                prnt()
+            self._f = f
+            prnt('#ifndef PYPY_VERSION')
+            prnt('_CFFI_HIDDEN void *_cffi_exports[_CFFI_NUM_EXPORTS];')
+            prnt('#endif')
+            prnt()
+        #
         # the declaration of '_cffi_types'
-        prnt('static void *_cffi_types[] = {')
-        typeindex2type = dict([(i, tp) for (tp, i) in self._typesdict.items()])
-        for i, op in enumerate(self.cffi_types):
-            comment = ''
-            if i in typeindex2type:
-                comment = ' // ' + typeindex2type[i]._get_c_name()
-            prnt('/* %2d */ %s,%s' % (i, op.as_c_expr(), comment))
+        prnt('%s void *_cffi_types[] = {' % (storage,))
+        comments = [''] * len(self.cffi_types)
+        for tp, i in self._typesdict.items():
+            comments[i] = ' // ' + tp._get_c_name()
+        self._prnt_lines(['/* %2d */ %s,%s' % (i, op.as_c_expr(), comments[i])
+                          for i, op in enumerate(self.cffi_types)])
         if not self.cffi_types:
             prnt('  0')
         prnt('};')
@@ -361,6 +461,11 @@ class Recompiler:
         # ffi._parser._declarations.  This generates all the functions.
         self._seen_constants = set()
         self._generate("decl")
+        if self._shard_files is not None:
+            # the prototypes of the functions written to the shards
+            header_f.write(''.join([line + '\n'
+                                    for line in self._prototypes]))
+            self._shard_files = None
         #
         # the declaration of '_cffi_globals' and '_cffi_typenames'
         nums = {}
@@ -370,8 +475,7 @@ class Recompiler:
             if nums[step_name] > 0:
                 prnt('static const struct _cffi_%s_s _cffi_%ss[] = {' % (
                     step_name, step_name))
-                for entry in lst:
-                    prnt(entry.as_c_expr())
+                self._prnt_lines([entry.as_c_expr() for entry in lst])
                 prnt('};')
                 prnt()
         #
@@ -396,6 +500,9 @@ class Recompiler:
             prnt('};')
             prnt()
         #
+        # the declaration of '_cffi_name_index', if any array is large
+        name_index = self._write_name_index()
+        #
         # the declaration of '_cffi_type_context'
         prnt('static const struct _cffi_type_context_s _cffi_type_context = {')
         prnt('  _cffi_types,')
@@ -414,8 +521,14 @@ class Recompiler:
         prnt('  %d,  /* num_types */' % (len(self.cffi_types),))
         flags = 0
         if self._num_externpy > 0 or self.ffi._embedding is not None:
-            flags |= 1     # set to mean that we use extern "Python"
+            flags |= CTX_EXTERN_PYTHON
+        if name_index:
+            flags |= CTX_NAME_INDEX
         prnt('  %d,  /* flags */' % flags)
+        if name_index:
+            prnt('  &_cffi_name_index,')
+        else:
+            prnt('  NULL,  /* no name_index */')
         prnt('};')
         prnt()
         #
@@ -428,7 +541,7 @@ class Recompiler:
         prnt('PyMODINIT_FUNC')
         prnt('_cffi_pypyinit_%s(const void *p[])' % (base_module_name,))
         prnt('{')
-        if flags & 1:
+        if flags & CTX_EXTERN_PYTHON:
             prnt('    if (((intptr_t)p[0]) >= 0x0A03) {')
             prnt('        _cffi_call_python_org = '
                  '(void(*)(struct _cffi_externpy_s *, char *))p[1];')
@@ -663,6 +776,29 @@ class Recompiler:
             # constant function pointer (no CPython wrapper)
             self._generate_cpy_constant_decl(tp, name)
             return
+        saved_f = self._f
+        try:
+            self._generate_cpy_function_wrappers(tp, name)
+        finally:
+            self._f = saved_f
+
+    def _prnt_function_header(self, declaration):
+        # 'declaration' is the C declaration of a wrapper function, without
+        # storage class; with shards, it is not static but needs a prototype
+        if self._shard_files is None:
+            self._prnt('static %s' % (declaration,))
+        else:
+            self._prnt('_CFFI_HIDDEN %s' % (declaration,))
+            self._prototypes.append('_CFFI_HIDDEN %s;' % (declaration,))
+
+    def _prnt_function_directive(self, line):
+        # a preprocessor line among the wrappers, also needed in the
+        # prototypes if we have shards
+        self._prnt(line)
+        if self._shard_files is not None:
+            self._prototypes.append(line)
+
+    def _generate_cpy_function_wrappers(self, tp, name):
         prnt = self._prnt
         numargs = len(tp.args)
         if numargs == 0:
@@ -687,7 +823,7 @@ class Recompiler:
         else:
             abi = ''
         name_and_arguments = '%s_cffi_d_%s(%s)' % (abi, name, repr_arguments)
-        prnt('static %s' % (tp.result.get_c_name(name_and_arguments),))
+        self._prnt_function_header(tp.result.get_c_name(name_and_arguments))
         prnt('{')
         call_arguments = ', '.join(call_arguments)
         result_code = 'return '
@@ -696,10 +832,71 @@ class Recompiler:
         prnt('  %s%s(%s);' % (result_code, name, call_arguments))
         prnt('}')
         #
-        prnt('#ifndef PYPY_VERSION')        # ------------------------------
+        callee = name
+        if self._shard_files is not None:
+            # the other wrappers are the bulk of the C code: with shards,
+            # they go to the extra C files, round-robin.  They call the
+            # 'd' version, so that only this file calls the functions of
+            # the user's C source: the shards include it too, but should
+            # not use the copy of its static functions and variables
+            self._f = self._shard_files[
+                self._num_function_decls % len(self._shard_files)]
+            self._num_function_decls += 1
+            callee = '_cffi_d_%s' % (name,)
+        #
+        self._prnt_function_directive('#ifndef PYPY_VERSION')   # ---------
+        #
+        if self.shared_wrappers:
+            # a stub that calls the wrapper shared by all functions of
+            # the same type, passing it the 'd' version to call
+            wrapper = self._generate_cpy_shared_wrapper(tp, argname)
+        self._prnt_function_header('PyObject *\n_cffi_f_%s(PyObject *self, '
+                                   'PyObject *%s)' % (name, argname))
+        if self.shared_wrappers:
+            prnt('{')
+            if numargs > 1:
+                prnt('  return %s(self, %s, _cffi_d_%s, "%s");' % (
+                    wrapper, argname, name, name))
+            else:
+                prnt('  return %s(self, %s, _cffi_d_%s);' % (
+                    wrapper, argname, name))
+            prnt('}')
+        else:
+            self._generate_cpy_function_body(tp, callee, name,
+                                             '"%s"' % (name,))
+        #
+        self._prnt_function_directive('#else')        # ------------------
         #
-        prnt('static PyObject *')
-        prnt('_cffi_f_%s(PyObject *self, PyObject *%s)' % (name, argname))
+        # the PyPy version: need to replace struct/union arguments with
+        # pointers, and if the result is a struct/union, insert a first
+        # arg that is a pointer to the result.  We also do that for
+        # complex args and return type.
+        self._generate_cpy_function_pypy(tp, name, callee, abi)
+
+    def _generate_cpy_shared_wrapper(self, tp, argname):
+        # with shared_wrappers=True: write the CPython wrapper for all the
+        # functions of type 'tp' in the current file, if not done already
+        type_index = self._typesdict[tp.as_raw_function()]
+        wrapper = '_cffi_w_%d' % (type_index,)
+        key = (id(self._f), type_index)
+        if key not in self._shared_wrappers_done:
+            self._shared_wrappers_done.add(key)
+            arguments = ['PyObject *self', 'PyObject *%s' % (argname,),
+                         tp.get_c_name(' fn', 'shared wrapper')]
+            if len(tp.args) > 1:
+                arguments.append('const char *fname')
+            self._prnt('static PyObject *')
+            self._prnt('%s(%s)' % (wrapper, ', '.join(arguments)))
+            self._generate_cpy_function_body(tp, 'fn', 'shared wrapper',
+                                             'fname')
+        return wrapper
+
+    def _generate_cpy_function_body(self, tp, callee, name, name_expr):
+        # the body of a CPython wrapper, from '{' to '}'; 'callee' is
+        # the C function to call, and 'name_expr' a C expression giving
+        # its name for error messages
+        prnt = self._prnt
+        numargs = len(tp.args)
         prnt('{')
         #
         context = 'argument of %s' % name
@@ -729,8 +926,8 @@ class Recompiler:
             for i in rng:
                 prnt('  PyObject *arg%d;' % i)
             prnt()
-            prnt('  if (!PyArg_UnpackTuple(args, "%s", %d, %d, %s))' % (
-                name, len(rng), len(rng),
+            prnt('  if (!PyArg_UnpackTuple(args, %s, %d, %d, %s))' % (
+                name_expr, len(rng), len(rng),
                 ', '.join(['&arg%d' % i for i in rng])))
             prnt('    return NULL;')
         prnt()
@@ -744,7 +941,7 @@ class Recompiler:
         prnt('  _cffi_restore_errno();')
         call_arguments = ['x%d' % i for i in range(len(tp.args))]
         call_arguments = ', '.join(call_arguments)
-        prnt('  { %s%s(%s); }' % (result_code, name, call_arguments))
+        prnt('  { %s%s(%s); }' % (result_code, callee, call_arguments))
         prnt('  _cffi_save_errno();')
         prnt('  Py_END_ALLOW_THREADS')
         prnt()
@@ -764,13 +961,16 @@ class Recompiler:
             prnt('  Py_INCREF(Py_None);')
             prnt('  return Py_None;')
         prnt('}')
-        #
-        prnt('#else')        # ------------------------------
-        #
-        # the PyPy version: need to replace struct/union arguments with
-        # pointers, and if the result is a struct/union, insert a first
-        # arg that is a pointer to the result.  We also do that for
-        # complex args and return type.
+
+    def _generate_cpy_function_pypy(self, tp, name, callee, abi):
+        prnt = self._prnt
+        if not isinstance(tp.result, model.VoidType):
+            result_code = 'result = '
+            context = 'result of %s' % name
+            result_decl = '  %s;' % tp.result.get_c_name(' result', context)
+        else:
+            result_decl = None
+            result_code = ''
         def need_indirection(type):
             return (isinstance(type, model.StructOrUnion) or
                     (isinstance(type, model.PrimitiveType) and
@@ -801,19 +1001,21 @@ class Recompiler:
             repr_arguments = repr_arguments or 'void'
             name_and_arguments = '%s_cffi_f_%s(%s)' % (abi, name,
                                                        repr_arguments)
-            prnt('static %s' % (tp_result.get_c_name(name_and_arguments),))
+            self._prnt_function_header(
+                tp_result.get_c_name(name_and_arguments))
             prnt('{')
             if result_decl:
                 prnt(result_decl)
             call_arguments = ', '.join(call_arguments)
-            prnt('  { %s%s(%s); }' % (result_code, name, call_arguments))
+            prnt('  { %s%s(%s); }' % (result_code, callee, call_arguments))
             if result_decl:
                 prnt('  return result;')
             prnt('}')
         else:
-            prnt('#  define _cffi_f_%s _cffi_d_%s' % (name, name))
+            self._prnt_function_directive('#  define _cffi_f_%s _cffi_d_%s' %
+                                          (name, name))
         #
-        prnt('#endif')        # ------------------------------
+        self._prnt_function_directive('#endif')        # -----------------
         prnt()
 
     def _generate_cpy_function_ctx(self, tp, name):
@@ -1300,6 +1502,28 @@ class Recompiler:
       _generate_cpy_extern_python_plus_c_ctx = \
       _generate_cpy_extern_python_ctx
 
+    def _print_precompiled_init_code(self):
+        # the init code, compiled and marshalled by the Python running
+        # the build; _embedding.h only uses it if the magic number
+        # matches the Python that runs it, and otherwise compiles the
+        # source as usual
+        if '__pypy__' in sys.builtin_module_names:
+            return
+        import marshal
+        from importlib.util import MAGIC_NUMBER
+        prnt = self._prnt
+        code = compile(self.ffi._embedding,
+                       "<init code for '%s'>" % (self.module_name,), "exec")
+        data = bytearray(marshal.dumps(code))
+        magic = int.from_bytes(MAGIC_NUMBER, 'little')
+        prnt('#ifndef PYPY_VERSION')
+        prnt('#define _CFFI_PYTHON_STARTUP_BYTECODE_MAGIC  %dL' % (magic,))
+        prnt('static const unsigned char _CFFI_PYTHON_STARTUP_BYTECODE[] = {')
+        for i in range(0, len(data), 16):
+            prnt(','.join([str(c) for c in data[i:i+16]]) + ',')
+        prnt('};')
+        prnt('#endif')
+
     def _print_string_literal_in_array(self, s):
         prnt = self._prnt
         prnt('// # NB. this is not a string because of a size limit in MSVC')
@@ -1315,13 +1539,19 @@ class Recompiler:
                 # type(line) is bytes, which enumerates like a list of integers
                 comment = ascii(comment)[1:-1]
             prnt(('// ' + comment).rstrip())
-            printed_line = ''
+            printed_lines = []
+            printed_line = []
+            length = 0
             for c in line:
-                if len(printed_line) >= 76:
-                    prnt(printed_line)
-                    printed_line = ''
-                printed_line += '%d,' % (c,)
-            prnt(printed_line)
+                if length >= 76:
+                    printed_lines.append(''.join(printed_line))
+                    printed_line = []
+                    length = 0
+                item = _BYTE_LITERALS[c]
+                printed_line.append(item)
+                length += len(item)
+            printed_lines.append(''.join(printed_line))
+            self._prnt_lines(printed_lines)
 
     # ----------
     # emitting the opcodes for individual types
@@ -1407,15 +1637,51 @@ else:
                 s = s.encode('ascii')
             super().write(s)
 
+_BYTE_LITERALS = ['%d,' % (c,) for c in range(256)]
+
+def _name_hash(name):
+    # 32-bit FNV-1a, must match search_hashed() in parse_c_type.c
+    h = 2166136261
+    for c in bytearray(name.encode('utf-8')):
+        h = ((h ^ c) * 16777619) & 0xffffffff
+    return h
+
+def _make_name_index(names):
+    size = 1
+    while size < 2 * len(names):
+        size *= 2
+    mask = size - 1
+    slots = [-1] * size
+    for i, name in enumerate(names):
+        h = _name_hash(name)
+        while slots[h & mask] >= 0:
+            h += 1
+        slots[h & mask] = i
+    return slots
+
 def _is_file_like(maybefile):
     # compare to xml.etree.ElementTree._get_writer
     return hasattr(maybefile, 'write')
 
-def _make_c_or_py_source(ffi, module_name, preamble, target_file, verbose):
+def _make_c_or_py_source(ffi, module_name, preamble, target_file, verbose,
+                         shards=1, shared_wrappers=False):
     if verbose:
         print("generating %s" % (target_file,))
+    if shards > 1:
+        if _is_file_like(target_file):
+            raise TypeError("Writing to file-like objects is not supported "
+                            "with shards=%d" % (shards,))
+        header_name = _get_shard_file_names(target_file, shards)[0]
+        outputs = _generate_c_sources(ffi, module_name, preamble,
+                                      os.path.basename(header_name), shards,
+                                      shared_wrappers)
+        updated = _write_c_sources(outputs, target_file)
+        if verbose and not updated:
+            print("(already up-to-date)")
+        return updated
     recompiler = Recompiler(ffi, module_name,
-                            target_is_python=(preamble is None))
+                            target_is_python=(preamble is None),
+                            shared_wrappers=shared_wrappers)
     recompiler.collect_type_table()
     recompiler.collect_step_tables()
     if _is_file_like(target_file):
@@ -1423,7 +1689,9 @@ def _make_c_or_py_source(ffi, module_name, preamble, target_file, verbose):
         return True
     f = NativeIO()
     recompiler.write_source_to_f(f, preamble)
-    output = f.getvalue()
+    return _write_source_if_changed(f.getvalue(), target_file, verbose)
+
+def _write_source_if_changed(output, target_file, verbose=False):
     try:
         with open(target_file, 'r') as f1:
             if f1.read(len(output) + 1) != output:
@@ -1442,10 +1710,44 @@ def _make_c_or_py_source(ffi, module_name, preamble, target_file, verbose):
             os.rename(tmp_file, target_file)
         return True
 
-def make_c_source(ffi, module_name, preamble, target_c_file, verbose=False):
+def _get_shard_file_names(c_file, shards):
+    """Return the name of the shared header and the list of names of the
+    extra C files, for a module split with shards=N."""
+    root, source_extension = os.path.splitext(c_file)
+    return (root + '.cffi.h',
+            ['%s.%d%s' % (root, i, source_extension)
+             for i in range(1, shards + 1)])
+
+def _generate_c_sources(ffi, module_name, preamble, header_name, shards,
+                        shared_wrappers=False):
+    # returns the list [main C file, header, shard 1, ..., shard N]
+    recompiler = Recompiler(ffi, module_name, shared_wrappers=shared_wrappers)
+    recompiler.collect_type_table()
+    recompiler.collect_step_tables()
+    files = [NativeIO() for i in range(shards + 2)]
+    recompiler.write_c_source_to_f(files[0], preamble,
+                                   shards=(header_name, files[1], files[2:]))
+    return [f.getvalue() for f in files]
+
+def _write_c_sources(outputs, c_file):
+    # write the result of _generate_c_sources(); returns True if any
+    # of the files changed
+    filenames = [c_file]
+    if len(outputs) > 1:
+        header_name, shard_names = _get_shard_file_names(c_file,
+                                                         len(outputs) - 2)
+        filenames += [header_name] + shard_names
+    updated = False
+    for output, filename in zip(outputs, filenames):
+        if _write_source_if_changed(output, filename):
+            updated = True
+    return updated
+
+def make_c_source(ffi, module_name, preamble, target_c_file, verbose=False,
+                  shards=1, shared_wrappers=False):
     assert preamble is not None
     return _make_c_or_py_source(ffi, module_name, preamble, target_c_file,
-                                verbose)
+                                verbose, shards, shared_wrappers)
 
 def make_py_source(ffi, module_name, target_py_file, verbose=False):
     return _make_c_or_py_source(ffi, module_name, None, target_py_file,
@@ -1518,7 +1820,9 @@ def _patch_for_target(patchlist, target):
 def recompile(ffi, module_name, preamble, tmpdir='.', call_c_compiler=True,
               c_file=None, source_extension='.c', extradir=None,
               compiler_verbose=1, target=None, debug=None,
-              uses_ffiplatform=True, **kwds):
+              uses_ffiplatform=True, cache_dir=None, shards=1,
+              shared_wrappers=False, lto=False, optimize=None, training=None,
+              **kwds):
     if not isinstance(module_name, str):
         module_name = module_name.encode('ascii')
     if ffi._windows_unicode:
@@ -1547,10 +1851,16 @@ def recompile(ffi, module_name, preamble, tmpdir='.', call_c_compiler=True,
         #
         if uses_ffiplatform:
             ext = ffiplatform.get_extension(ext_c_file, module_name, **kwds)
+            if shards > 1:
+                header_name, shard_names = _get_shard_file_names(ext_c_file,
+                                                                 shards)
+                ext.sources[1:1] = shard_names
+                ext.depends.append(header_name)
         else:
             ext = None
         updated = make_c_source(ffi, module_name, preamble, c_file,
-                                verbose=compiler_verbose)
+                                verbose=compiler_verbose, shards=shards,
+                                shared_wrappers=shared_wrappers)
         if call_c_compiler:
             patchlist = []
             cwd = os.getcwd()
@@ -1565,9 +1875,17 @@ def recompile(ffi, module_name, preamble, tmpdir='.', call_c_compiler=True,
                     else:
                         msg = 'setting the current directory to'
                     print('%s %r' % (msg, os.path.abspath(tmpdir)))
+                if cache_dir is not None:
+                    cache_dir = os.path.abspath(cache_dir)
                 os.chdir(tmpdir)
+                if shards > 1:
+                    jobs = os.cpu_count() or 1   # compile the shards at once
+                else:
+                    jobs = 1
                 outputfilename = ffiplatform.compile('.', ext,
-                                                     compiler_verbose, debug)
+                                                     compiler_verbose, debug,
+                                                     cache_dir, lto,
+                                                     optimize, training, jobs)
             finally:
                 os.chdir(cwd)
                 _unpatch_meths(patchlist)
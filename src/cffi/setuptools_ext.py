@@ -26,7 +26,7 @@ def execfile(filename, glob):
     exec(code, glob, glob)
 
 
-def add_cffi_module(dist, mod_spec):
+def _load_ffi(mod_spec):
     from cffi.api import FFI
 
     if not isinstance(mod_spec, basestring):
@@ -61,16 +61,97 @@ def add_cffi_module(dist, mod_spec):
                                                       type(ffi).__name__))
     if not hasattr(ffi, '_assigned_source'):
         error("%r: the set_source() method was not called" % (mod_spec,))
+    return ffi
+
+def _get_assigned_source(ffi):
     module_name, source, source_extension, kwds = ffi._assigned_source
     if ffi._windows_unicode:
         kwds = kwds.copy()
         ffi._apply_windows_unicode(kwds)
+    return module_name, source, source_extension, kwds
+
+def add_cffi_module(dist, mod_spec):
+    ffi = _load_ffi(mod_spec)
+    module_name, source, source_extension, kwds = _get_assigned_source(ffi)
 
     if source is None:
         _add_py_module(dist, ffi, module_name)
     else:
         _add_c_module(dist, ffi, module_name, source, source_extension, kwds)
 
+
+def _get_build_jobs():
+    """Return the value of the environment variable CFFI_BUILD_JOBS:
+    a number of processes, or 'auto' for the number of CPUs.  The
+    default is 1, i.e. no parallel build.
+    """
+    value = os.environ.get('CFFI_BUILD_JOBS', '').strip()
+    if not value:
+        return 1
+    if value == 'auto':
+        return os.cpu_count() or 1
+    try:
+        jobs = int(value)
+    except ValueError:
+        error("CFFI_BUILD_JOBS must be a number or 'auto', not %r" % (value,))
+    return max(jobs, 1)
+
+def _can_fork():
+    import multiprocessing
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+def _prepare_cffi_module(mod_spec):
+    # Runs in a worker process: execute the build script and generate the
+    # .c or .py source.  Returns only picklable data.
+    from cffi import recompiler
+    from cffi.recompiler import NativeIO
+
+    ffi = _load_ffi(mod_spec)
+    module_name, source, source_extension, kwds = _get_assigned_source(ffi)
+    if source is None:
+        f = NativeIO()
+        recompiler.make_py_source(ffi, module_name, f)
+        generated = f.getvalue()
+    else:
+        shards = kwds.get('shards', 1)
+        shared_wrappers = kwds.get('shared_wrappers', False)
+        if shards > 1:
+            header_name = recompiler._get_shard_file_names(
+                module_name + source_extension, shards)[0]
+            generated = recompiler._generate_c_sources(
+                ffi, module_name, source, header_name, shards,
+                shared_wrappers)
+        else:
+            f = NativeIO()
+            recompiler.make_c_source(ffi, module_name, source, f,
+                                     shared_wrappers=shared_wrappers)
+            generated = [f.getvalue()]
+    return module_name, source, source_extension, kwds, generated
+
+def _add_cffi_modules_in_parallel(dist, mod_specs, jobs):
+    # Each build script is executed in one of 'jobs' forked processes,
+    # which also generates the source.  The results are collected in the
+    # order of 'mod_specs', so the Extensions are the same as in a
+    # sequential build.
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    mp_context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers=min(jobs, len(mod_specs)),
+                             mp_context=mp_context) as executor:
+        results = list(executor.map(_prepare_cffi_module, mod_specs))
+
+    for mod_spec, result in zip(mod_specs, results):
+        module_name, source, source_extension, kwds, generated = result
+        def load_ffi(mod_spec=mod_spec):
+            return _load_ffi(mod_spec)
+        if source is None:
+            _add_py_module(dist, None, module_name, generated=generated)
+        else:
+            _add_c_module(dist, None, module_name, source, source_extension,
+                          kwds, generated=generated, load_ffi=load_ffi,
+                          jobs=jobs)
+
 def _set_py_limited_api(Extension, kwds):
     """
     Add py_limited_api to kwds if setuptools >= 26 is in use.
@@ -118,14 +199,17 @@ def _set_py_limited_api(Extension, kwds):
         kwds.setdefault("define_macros", []).append(("_CFFI_NO_LIMITED_API", None))
     return kwds
 
-def _add_c_module(dist, ffi, module_name, source, source_extension, kwds):
+def _add_c_module(dist, ffi, module_name, source, source_extension, kwds,
+                  generated=None, load_ffi=None, jobs=1):
     # We are a setuptools extension. Need this build_ext for py_limited_api.
     from setuptools.command.build_ext import build_ext
     from cffi._shimmed_dist_utils import Extension, log, mkpath
-    from cffi import recompiler
+    from cffi import recompiler, ffiplatform
 
     allsources = ['$PLACEHOLDER']
     allsources.extend(kwds.pop('sources', []))
+    shards = kwds.pop('shards', 1)
+    shared_wrappers = kwds.pop('shared_wrappers', False)
     kwds = _set_py_limited_api(Extension, kwds)
     ext = Extension(name=module_name, sources=allsources, **kwds)
 
@@ -138,8 +222,23 @@ def _add_c_module(dist, ffi, module_name, source, source_extension, kwds):
         # subclass the 'distutils.command.build_ext.build_ext' class and
         # add a method 'def pre_run(self, ext, ffi)'.
         if pre_run is not None:
-            pre_run(ext, ffi)
-        updated = recompiler.make_c_source(ffi, module_name, source, c_file)
+            ffi1 = ffi if ffi is not None else load_ffi()
+            pre_run(ext, ffi1)
+            updated = recompiler.make_c_source(
+                ffi1, module_name, source, c_file, shards=shards,
+                shared_wrappers=shared_wrappers)
+        elif generated is not None:
+            # already generated by _add_cffi_modules_in_parallel()
+            updated = recompiler._write_c_sources(generated, c_file)
+        else:
+            updated = recompiler.make_c_source(
+                ffi, module_name, source, c_file, shards=shards,
+                shared_wrappers=shared_wrappers)
+        if shards > 1:
+            header_name, shard_names = recompiler._get_shard_file_names(
+                c_file, shards)
+            ext.sources[1:1] = shard_names
+            ext.depends.append(header_name)
         if not updated:
             log.info("already up-to-date")
         return c_file
@@ -154,7 +253,15 @@ def _add_c_module(dist, ffi, module_name, source, source_extension, kwds):
             if ext.sources[0] == '$PLACEHOLDER':
                 pre_run = getattr(self, 'pre_run', None)
                 ext.sources[0] = make_mod(self.build_temp, pre_run)
+            if jobs > 1 and not self.parallel:
+                self.parallel = jobs     # compile the extensions in parallel
             base_class.run(self)
+        def build_extension(self, ext1):
+            if ext1 is ext and shards > 1:
+                # compile the shards in parallel
+                ffiplatform.use_parallel_compile(self.compiler,
+                                                 os.cpu_count() or 1)
+            base_class.build_extension(self, ext1)
     dist.cmdclass['build_ext'] = build_ext_make_mod
     # NB. multiple runs here will create multiple 'build_ext_make_mod'
     # classes.  Even in this case the 'build_ext' command should be
@@ -162,7 +269,7 @@ def _add_c_module(dist, ffi, module_name, source, source_extension, kwds):
     # called again.
 
 
-def _add_py_module(dist, ffi, module_name):
+def _add_py_module(dist, ffi, module_name, generated=None):
     from setuptools.command.build_py import build_py
     from setuptools.command.build_ext import build_ext
     from cffi._shimmed_dist_utils import log, mkpath
@@ -171,7 +278,10 @@ def _add_py_module(dist, ffi, module_name):
     def generate_mod(py_file):
         log.info("generating cffi module %r" % py_file)
         mkpath(os.path.dirname(py_file))
-        updated = recompiler.make_py_source(ffi, module_name, py_file)
+        if generated is not None:
+            updated = recompiler._write_source_if_changed(generated, py_file)
+        else:
+            updated = recompiler.make_py_source(ffi, module_name, py_file)
         if not updated:
             log.info("already up-to-date")
 
@@ -227,5 +337,9 @@ def cffi_modules(dist, attr, value):
     if isinstance(value, basestring):
         value = [value]
 
+    jobs = _get_build_jobs()
+    if jobs > 1 and len(value) > 1 and _can_fork():
+        _add_cffi_modules_in_parallel(dist, value, jobs)
+        return
     for cffi_module in value:
         add_cffi_module(dist, cffi_module)
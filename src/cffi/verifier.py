@@ -1,7 +1,7 @@
 #
 # DEPRECATED: implementation for ffi.verify()
 #
-import sys, os, binascii, shutil, io
+import sys, os, hashlib, io
 from . import __version_verifier_modules__
 from . import ffiplatform
 from .error import VerificationError
@@ -56,12 +56,10 @@ class Verifier:
                               ffi._cdefsources)
             if sys.version_info >= (3,):
                 key = key.encode('utf-8')
-            k1 = hex(binascii.crc32(key[0::2]) & 0xffffffff)
-            k1 = k1.lstrip('0x').rstrip('L')
-            k2 = hex(binascii.crc32(key[1::2]) & 0xffffffff)
-            k2 = k2.lstrip('0').rstrip('L')
-            modulename = '_cffi_%s_%s%s%s' % (tag, self._vengine._class_key,
-                                              k1, k2)
+            # the name contains a hash of everything that goes into the
+            # module: if a module with this name exists, it is up-to-date
+            k = hashlib.sha256(key).hexdigest()[:32]
+            modulename = '_cffi_%s_%s%s' % (tag, self._vengine._class_key, k)
         suffix = _get_so_suffixes()[0]
         self.tmpdir = tmpdir or _caller_dir_pycache()
         self.sourcefilename = os.path.join(self.tmpdir, modulename + source_extension)
@@ -85,9 +83,10 @@ class Verifier:
         with self.ffi._lock:
             if self._has_module:
                 raise VerificationError("module already compiled")
-            if not self._has_source:
-                self._write_source()
-            self._compile_module()
+            with _FileLock(self._get_lock_filename()):
+                if not self._has_source:
+                    self._write_source()
+                self._compile_module()
 
     def load_library(self):
         """Get a C module from this Verifier instance.
@@ -100,9 +99,14 @@ class Verifier:
             if not self._has_module:
                 self._locate_module()
                 if not self._has_module:
-                    if not self._has_source:
-                        self._write_source()
-                    self._compile_module()
+                    # only one process compiles the module; the others
+                    # wait for the lock and then find the module
+                    with _FileLock(self._get_lock_filename()):
+                        self._locate_module()
+                        if not self._has_module:
+                            if not self._has_source:
+                                self._write_source()
+                            self._compile_module()
             return self._load_library()
 
     def get_module_name(self):
@@ -144,6 +148,9 @@ class Verifier:
 
     # ----------
 
+    def _get_lock_filename(self):
+        return self.modulefilename + '.lock'
+
     def _locate_module(self):
         if not os.path.isfile(self.modulefilename):
             if self.ext_package:
@@ -196,16 +203,18 @@ class Verifier:
             self._has_source = True
 
     def _compile_module(self):
-        # compile this C source
-        tmpdir = os.path.dirname(self.sourcefilename)
+        # compile this C source in a directory of its own, and move the
+        # result to 'self.modulefilename' with an atomic rename: the other
+        # processes see either no module or the complete module
+        tmpdir = os.path.join(os.path.dirname(self.sourcefilename), 'build',
+                              self.get_module_name())
         outputfilename = ffiplatform.compile(tmpdir, self.get_extension())
+        _ensure_dir(self.modulefilename)
         try:
-            same = ffiplatform.samefile(outputfilename, self.modulefilename)
-        except OSError:
-            same = False
-        if not same:
-            _ensure_dir(self.modulefilename)
-            shutil.move(outputfilename, self.modulefilename)
+            os.replace(outputfilename, self.modulefilename)
+        except OSError:      # e.g. on another file system
+            ffiplatform._copy_atomically(outputfilename, self.modulefilename)
+            os.unlink(outputfilename)
         self._has_module = True
 
     def _load_library(self):
@@ -241,6 +250,49 @@ def _locate_engine_class(ffi, force_generic_engine):
 
 # ____________________________________________________________
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+class _FileLock(object):
+    """An exclusive lock between processes, on the given lock file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        _ensure_dir(self.filename)
+        self._fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            else:
+                while True:
+                    try:
+                        # LK_LOCK gives up after 10 seconds
+                        msvcrt.locking(self._fd, msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+        except:
+            os.close(self._fd)
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, 0)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        finally:
+            os.close(self._fd)
+
+# ____________________________________________________________
+
 _TMPDIR = None
 
 def _caller_dir_pycache():
@@ -260,7 +312,7 @@ def set_tmpdir(dirname):
 
 def cleanup_tmpdir(tmpdir=None, keep_so=False):
     """Clean up the temporary directory by removing all files in it
-    called `_cffi_*.{c,so}` as well as the `build` subdirectory."""
+    called `_cffi_*.{c,so,so.lock}` as well as the `build` subdirectory."""
     tmpdir = tmpdir or _caller_dir_pycache()
     try:
         filelist = os.listdir(tmpdir)
@@ -272,7 +324,8 @@ def cleanup_tmpdir(tmpdir=None, keep_so=False):
         suffix = _get_so_suffixes()[0].lower()
     for fn in filelist:
         if fn.lower().startswith('_cffi_') and (
-                fn.lower().endswith(suffix) or fn.lower().endswith('.c')):
+                fn.lower().endswith(suffix) or fn.lower().endswith('.c') or
+                fn.lower().endswith(suffix + '.lock')):
             try:
                 os.unlink(os.path.join(tmpdir, fn))
             except OSError:
@@ -303,4 +356,5 @@ def _get_so_suffixes():
 def _ensure_dir(filename):
     dirname = os.path.dirname(filename)
     if dirname and not os.path.isdir(dirname):
-        os.makedirs(dirname)
+        # exist_ok: another process may be creating it at the same time
+        os.makedirs(dirname, exist_ok=True)
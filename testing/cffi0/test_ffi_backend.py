@@ -39,6 +39,28 @@ class TestFFI(backend_tests.BackendTests,
         assert ffi.from_handle(ffi.cast("char *", p)) is o
         pytest.raises(RuntimeError, ffi.from_handle, ffi.NULL)
 
+    def test_handle_table(self):
+        ffi = FFI(backend=self.Backend())
+        table = ffi.handle_table()
+        o = [2, 3, 4]
+        p = table.add(o)
+        assert ffi.typeof(p) == ffi.typeof("void *")
+        assert p != ffi.NULL
+        assert table.get(p) is o
+        assert table.get(ffi.cast("char *", p)) is o
+        assert len(table) == 1
+        assert table.remove(p) is o
+        assert len(table) == 0
+        pytest.raises(ValueError, table.get, p)
+        pytest.raises(ValueError, table.remove, p)
+        pytest.raises(ValueError, table.get, ffi.NULL)
+        q = table.add(o)      # reuses the slot, but with a new generation
+        assert q != p
+        pytest.raises(ValueError, table.get, p)
+        assert table.get(q) is o
+        pytest.raises(ValueError, ffi.handle_table().get, q)
+        pytest.raises(TypeError, table.get, ffi.cast("int *", q))
+
     def test_callback_onerror(self):
         ffi = FFI(backend=self.Backend())
         seen = []
@@ -58,6 +80,35 @@ class TestFFI(backend_tests.BackendTests,
         assert tb.tb_frame.f_code.co_name == 'cb'
         assert tb.tb_frame.f_locals['n'] == 234
 
+    def test_callback_reuses_closure(self):
+        ffi = FFI(backend=self.Backend())
+        BFunc = ffi.typeof("short(*)(short, char, short)")   # unique type
+        a = ffi.callback(BFunc, lambda n, c, m: n + 1)
+        addr = ffi.cast("intptr_t", a)
+        assert a(41, b"x", 0) == 42
+        del a
+        import gc; gc.collect()
+        b = ffi.callback(BFunc, lambda n, c, m: n * 3)
+        assert ffi.cast("intptr_t", b) == addr     # same closure
+        assert b(41, b"x", 0) == 123
+        c = ffi.callback(BFunc, lambda n, c, m: n - m)
+        assert ffi.cast("intptr_t", c) != addr
+        assert (b(5, b"x", 1), c(5, b"x", 1)) == (15, 4)
+
+    def test_callback_cache(self):
+        ffi = FFI(backend=self.Backend())
+        def f(n):
+            return n + 1
+        a = ffi.callback_cache("int(*)(int)", f)
+        assert ffi.callback_cache("int(*)(int)", f) is a
+        assert ffi.callback_cache(ffi.typeof("int(*)(int)"), f) is a
+        assert ffi.callback_cache("int(*)(int)", f, error=-1) is not a
+        assert (ffi.callback_cache("int(*)(int)", f, error=0) is not
+                ffi.callback_cache("int(*)(int)", f, error=False))
+        assert ffi.callback_cache("long(*)(long)", f) is not a
+        assert a(41) == 42
+        pytest.raises(TypeError, ffi.callback_cache, "int(*)(int)", 42)
+
     def test_ffi_new_allocator_2(self):
         ffi = FFI(backend=self.Backend())
         seen = []
@@ -411,6 +462,118 @@ class TestBitfield:
         pytest.raises((TypeError, BufferError), ffi.from_buffer, b"abcd",
                                                  require_writable=True)
 
+    def test_map_file(self):
+        import struct
+        from testing.udir import udir
+        fn = str(udir / 'test_map_file_0.bin')
+        with open(fn, 'wb') as f:
+            for i in range(1000):
+                f.write(struct.pack("ii", i, -i))
+        ffi = FFI()
+        ffi.cdef("struct rec_s { int a, b; };")
+        p = ffi.map_file("struct rec_s[]", fn, advice="sequential")
+        assert ffi.typeof(p) is ffi.typeof("struct rec_s[]")
+        assert len(p) == 1000
+        assert (p[10].a, p[999].b) == (10, -999)
+        q = ffi.map_file("struct rec_s[]", fn, offset=8 * 3, length=8 * 5)
+        assert len(q) == 5
+        assert q[0].a == 3
+        w = ffi.map_file("struct rec_s[]", fn, mode="r+")
+        w[0].a = 42
+        ffi.msync(w)
+        ffi.release(w)
+        assert p[0].a == 42
+        ffi.release(p)
+        pytest.raises(ValueError, ffi.msync, p)
+        pytest.raises(TypeError, ffi.msync, ffi.new("int[2]"))
+        pytest.raises(ValueError, ffi.map_file, "char[]", fn, mode="w")
+        pytest.raises(ValueError, ffi.map_file, "char[]", fn, advice="foo")
+
+    @pytest.mark.skipif("sys.platform == 'win32'")
+    def test_new_shared(self):
+        import os, subprocess
+        name = "cffi-test-new-shared-%d" % os.getpid()
+        ffi = FFI()
+        ffi.cdef("struct tbl_s { int n; int data[10]; };")
+        p = ffi.new_shared("struct tbl_s *", name, {'n': 5})
+        assert p.n == 5
+        q = ffi.open_shared("struct tbl_s *", name)
+        q.data[3] = 42
+        assert p.data[3] == 42
+        ffi.release(q)
+        # another process can attach to the same memory
+        code = ("import cffi; ffi = cffi.FFI(); "
+                "p = ffi.open_shared('int[]', %r); p[2] = p[0] + p[4]" % (name,))
+        subprocess.check_call([sys.executable, '-c', code])
+        assert p.data[1] == 5 + 42
+        pytest.raises(FileExistsError, ffi.new_shared, "int[2]", name)
+        # releasing the first cdata removes the name
+        ffi.release(p)
+        pytest.raises(FileNotFoundError, ffi.open_shared, "int[]", name)
+
+    def test_gc_batch(self):
+        ffi = FFI()
+        ffi.cdef("void *malloc(size_t); void free(void *);")
+        lib = ffi.dlopen(None)
+        ffi.gc_flush()
+        ptrs = [ffi.gc(lib.malloc(16), lib.free, batch=True)
+                for i in range(1000)]   # more than one batch
+        del ptrs
+        ffi.gc_flush()
+        assert ffi.gc_flush() == 0
+        #
+        seen = []
+        @ffi.callback("void(*)(void *)")
+        def destructor(p):
+            seen.append(int(ffi.cast("intptr_t", p)))
+        q = ffi.gc(ffi.cast("void *", 42), destructor, batch=True)
+        ffi.gc(ffi.cast("void *", 43), destructor, batch=True)
+        ffi.gc_flush()
+        assert seen == [43]
+        ffi.release(q)     # synchronous
+        assert seen == [43, 42]
+        #
+        pytest.raises(TypeError, ffi.gc, ffi.new("int *"), lib.free,
+                      batch=True)
+        pytest.raises(TypeError, ffi.gc, ffi.NULL, lambda p: None,
+                      batch=True)
+        pytest.raises(TypeError, ffi.gc, ffi.NULL, lib.malloc, batch=True)
+
+    def test_gc_batch_not_flushed_by_dealloc(self):
+        # a full queue grows: the other destructors are not called from
+        # the deallocator of the object that doesn't fit
+        ffi = FFI()
+        ffi.gc_flush()
+        in_del = [False]
+        seen = []
+        @ffi.callback("void(*)(void *)")
+        def destructor(p):
+            seen.append(in_del[0])
+        ptrs = [ffi.gc(ffi.cast("void *", i + 1), destructor, batch=True)
+                for i in range(2000)]
+        in_del[0] = True
+        del ptrs
+        in_del[0] = False
+        ffi.gc_flush()
+        assert seen == [False] * 2000
+
+    def test_gc_batch_after_exit_flush(self):
+        import subprocess
+        code = """if 1:
+            import atexit, os, cffi
+            ffi = cffi.FFI()
+            @ffi.callback("void(*)(void *)")
+            def destructor(p):
+                os.write(1, b"freed %d\\n" % int(ffi.cast("intptr_t", p)))
+            def late():
+                # runs after the atexit handler that flushes the queue
+                ffi.gc(ffi.cast("void *", 43), destructor, batch=True)
+            atexit.register(late)
+            ffi.gc(ffi.cast("void *", 42), destructor, batch=True)
+        """
+        out = subprocess.check_output([sys.executable, '-c', code])
+        assert out.splitlines() == [b"freed 42", b"freed 43"]
+
     def test_release(self):
         ffi = FFI()
         p = ffi.new("int[]", 123)
@@ -118,3 +118,19 @@ def test_union_type():
 def test_enum_type():
     enum_type = EnumType("foo_e", [], [])
     assert enum_type.get_c_name() == "enum foo_e"
+
+def test_cached_hash_and_c_name():
+    import pickle
+    ptr_type = PointerType(PrimitiveType("int"))
+    assert ptr_type.get_c_name("x") == "int * x"
+    assert ptr_type.get_c_name("x") == "int * x"
+    assert ptr_type.get_c_name("x", quals=Q_CONST) == "int * const x"
+    assert ptr_type._get_c_name() == "int *"
+    h = hash(ptr_type)
+    assert hash(ptr_type) == h == hash(PointerType(PrimitiveType("int")))
+    # the cached values depend on the process: they are not pickled
+    ptr_type2 = pickle.loads(pickle.dumps(ptr_type))
+    assert '_cached_hash' not in ptr_type2.__dict__
+    assert '_cached_c_names' not in ptr_type2.__dict__
+    assert ptr_type2 == ptr_type
+    assert hash(ptr_type2) == h
@@ -1,10 +1,18 @@
 import sys, re
 import pytest
-from cffi import FFI, FFIError, CDefError, VerificationError
+from cffi import FFI, FFIError, CDefError, VerificationError, model
 from .backend_tests import needs_dlopen_none
 from testing.support import is_musl
 
 
+@pytest.fixture(autouse=True, params=['fast', 'pycparser'])
+def cdef_parser(request, monkeypatch):
+    # run all the tests twice: with the fast parser for the simple
+    # declarations, and with pycparser for everything
+    from cffi import cparser
+    monkeypatch.setattr(cparser, '_use_fast_parser', request.param == 'fast')
+    return request.param
+
 class FakeBackend:
 
     def nonstandard_integer_types(self):
@@ -618,3 +626,261 @@ def test_missing_newline_bug():
     ffi = FFI(backend=FakeBackend())
     ffi.cdef("#pragma foobar")
     ffi.cdef("#pragma foobar")    # used to crash the second time
+
+def _cdef_sequence(ffi):
+    ffi.cdef("struct foo; typedef struct foo foo_t; int f(foo_t *);")
+    p = ffi.new("foo_t **")
+    ffi.cdef("""
+        struct foo { int x; struct { int a, b; } in; };
+        enum e { A, B=5 };
+        #define K 42
+        typedef int... myint_t;
+    """)
+    ffi.cdef("int h(struct foo, enum e);")
+    return p
+
+def test_cdef_cache(tmp_path, monkeypatch):
+    from cffi import cparser
+    ffi1 = FFI()
+    ffi1.set_cdef_cache(str(tmp_path))
+    _cdef_sequence(ffi1)
+    assert len(list(tmp_path.iterdir())) == 3
+    #
+    def no_parsing(self, csource):
+        raise AssertionError("the cdef should not be parsed again")
+    monkeypatch.setattr(cparser.Parser, '_internal_parse', no_parsing)
+    ffi2 = FFI()
+    ffi2.set_cdef_cache(str(tmp_path))
+    p = _cdef_sequence(ffi2)
+    assert sorted(ffi2._parser._declarations) == (
+        sorted(ffi1._parser._declarations))
+    assert ffi2._parser._int_constants == {'A': 0, 'B': 5, 'K': 42}
+    # 'struct foo' keeps its identity, and was completed in-place
+    assert ffi2.typeof(p) is ffi2.typeof("struct foo **")
+    assert ffi2.typeof("foo_t") is ffi2.typeof("struct foo")
+    assert [name for name, _ in ffi2.typeof("struct foo").fields] == (
+        ['x', 'in'])
+    assert str(ffi2.typeof("int(*)(struct foo, enum e)")) == (
+        "<ctype 'int(*)(foo_t, enum e)'>")
+    assert ffi2.typeof("struct foo").fields[1][1].type.kind == 'struct'
+    assert ffi2._parser._uses_new_feature == "'typedef int... myint_t'"
+    assert len(list(tmp_path.iterdir())) == 3
+
+def test_cdef_cache_key(tmp_path):
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    ffi.cdef("int f(int);")
+    ffi.cdef("int g(int);", override=True)
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    ffi.cdef("int f(int);")
+    ffi.typeof("struct never_declared_before *")
+    ffi.cdef("int g(int);", override=True)   # different previous state
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    ffi.cdef("int f(int);")
+    ffi.cdef("int g(int);")                  # different options
+    assert len(list(tmp_path.iterdir())) == 4
+
+def test_cdef_cache_broken_file(tmp_path):
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    ffi.cdef("int f(int);")
+    [cache_file] = list(tmp_path.iterdir())
+    cache_file.write_bytes(b"garbage")
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    ffi.cdef("int f(int);")
+    assert 'function f' in ffi._parser._declarations
+    assert cache_file.read_bytes() != b"garbage"    # rewritten
+    assert len(list(tmp_path.iterdir())) == 1
+
+def test_cdef_cache_no_caching_after_error(tmp_path):
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    pytest.raises(CDefError, ffi.cdef, "int f(int); foo bar baz;")
+    ffi.cdef("int g(int);")
+    assert list(tmp_path.iterdir()) == []
+
+def test_cdef_cache_warnings(tmp_path):
+    import warnings
+    for i in range(2):
+        ffi = FFI()
+        ffi.set_cdef_cache(str(tmp_path))
+        with warnings.catch_warnings(record=True) as log:
+            warnings.simplefilter("always")
+            ffi.cdef("int some_global_var;")
+        assert len(log) == 1
+        assert "Global variable 'some_global_var'" in str(log[0].message)
+
+def test_cdef_cache_leaves_warning_filters(tmp_path, monkeypatch):
+    # the warnings are collected without changing the process-wide
+    # filters, which other threads could be using at the same time
+    import warnings
+    from cffi import cparser
+    seen = []
+    org_internal_parse = cparser.Parser._internal_parse
+    def _internal_parse(self, csource):
+        seen.append(list(warnings.filters))
+        return org_internal_parse(self, csource)
+    monkeypatch.setattr(cparser.Parser, '_internal_parse', _internal_parse)
+    ffi = FFI()
+    ffi.set_cdef_cache(str(tmp_path))
+    with warnings.catch_warnings(record=True) as log:
+        warnings.simplefilter("always", UserWarning)
+        ffi.cdef("int some_global_var;")
+        assert seen == [list(warnings.filters)]
+    assert len(log) == 1
+
+def test_cdef_cache_threads(tmp_path):
+    import threading
+    csource = "".join("int f%d(int);\n" % i for i in range(200))
+    def run():
+        ffi = FFI()
+        ffi.set_cdef_cache(str(tmp_path))
+        ffi.cdef(csource)
+        assert len(ffi._parser._declarations) == 200
+    threads = [threading.Thread(target=run) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(list(tmp_path.iterdir())) == 1
+    run()
+
+def test_incremental_typedefs(monkeypatch, cdef_parser):
+    from cffi import cparser
+    if cdef_parser == 'fast':
+        pytest.skip("tests the parsing done by pycparser")
+    if not cparser._use_outer_typenames:
+        pytest.skip("this version of pycparser needs the typedefs repeated")
+    lengths = []
+    org_parse = cparser._CParser.parse
+    def parse(self, text, *args):
+        lengths.append(len(text))
+        return org_parse(self, text, *args)
+    monkeypatch.setattr(cparser._CParser, 'parse', parse)
+    ffi = FFI(backend=FakeBackend())
+    ffi.cdef("typedef int t0;")
+    for i in range(1, 100):
+        ffi.cdef("typedef t%d t%d;" % (i - 1, i))
+    # the previous typedefs are not repeated in the source given to pycparser
+    assert max(lengths) - min(lengths) < 10
+    assert str(ffi.typeof("t99")) == '<int>'
+    e = pytest.raises(CDefError, ffi.cdef, "int t5;")
+    assert "Non-typedef 't5' previously declared as typedef" in str(e.value)
+    ffi.cdef("int f(int t5);")       # not in the global scope: fine
+
+def test_parse_in_parallel_threads(monkeypatch, cdef_parser):
+    import threading
+    from cffi import cparser
+    if cdef_parser == 'fast':
+        pytest.skip("tests the parsing done by pycparser")
+    n_threads = 4
+    barrier = threading.Barrier(n_threads, timeout=30)
+    parser_cls = type(cparser._get_parser())
+    org_parse = parser_cls.parse
+    parsers = set()
+    def parse(self, text, *args):
+        parsers.add(self)
+        barrier.wait()     # all threads are inside parse() at the same time
+        return org_parse(self, text, *args)
+    monkeypatch.setattr(parser_cls, 'parse', parse)
+    results = [None] * n_threads
+    def run(n):
+        ffi = FFI()
+        ffi.cdef("typedef long t%d; struct s%d { t%d x; };" % (n, n, n))
+        results[n] = ffi.typeof("struct s%d" % n).fields[0][1].type.cname
+    threads = [threading.Thread(target=run, args=(n,))
+               for n in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == ['long'] * n_threads
+    assert len(parsers) == n_threads
+    assert len(cparser._parser_pool) >= n_threads
+
+FAST_PARSER_SOURCES = [
+    "int f(int a, const char *b, double c[]);",
+    "void g(void); long h(); int varargs(int, ...);",
+    "extern unsigned long long x; static const int K = -42; "
+    "static const unsigned int K2 = 0x10u;",
+    "struct foo { int a, *b; struct foo *next; char name[16]; };",
+    "struct bits { unsigned a:3, b:5; int c; };",
+    "typedef struct { int x, y; } point_t, *point_p; point_t p(point_p);",
+    "typedef struct node_s node_t; struct node_s { node_t *next; };",
+    "union u { int i; float f; struct { short lo, hi; }; };",
+    "enum e { A, B = 5, C, D = -2 }; enum e get_e(enum e);",
+    "enum { X1 = 1, X2 = X1, }; extern int arr[X2];",
+    "typedef int (*callback_t)(void *userdata, int);"
+    "int (*get_cb(int))(void *, int); void set_cb(callback_t cb);",
+    "extern int *const *volatile ppx; extern const char *const names[];",
+    "void m(int (*cmp)(const void *, const void *), char *[], int [3][4]);",
+    "typedef int... myint_t; typedef float... myfloat_t;",
+    "typedef ... opaque_t; typedef ... *opaque_p; opaque_p mk(void);",
+    "struct partial { int a; ...; }; enum pe { P1, P2, ... };",
+    "extern int partial_arr[...]; struct sa { int n[...]; };",
+    "size_t strlen(const char *); extern int32_t i32; extern FILE *fp;"
+    "extern bool flag;",
+    "int __stdcall stdfn(int); extern int (__stdcall *stdptr)(int);",
+    'extern "Python" int cb(int); extern "Python+C" { void cb2(void); }',
+    "#define FOO 42\n#define BAR ...\nint use_foo(int);",
+]
+
+def _describe_declarations(parser):
+    def describe(tp):
+        if isinstance(tp, (model.StructOrUnion, model.EnumType)):
+            extra = [getattr(tp, attr, None) for attr in
+                     ('fldnames', 'fldbitsize', 'fldquals', 'partial',
+                      'enumerators', 'enumvalues')]
+            if getattr(tp, 'fldtypes', None) is not None:
+                extra.append([t._get_c_name() for t in tp.fldtypes])
+            return (tp._get_c_name(), extra)
+        if isinstance(tp, model.BaseTypeByIdentity):
+            return tp._get_c_name()
+        return tp
+    return (sorted([(name, describe(tp), quals) for name, (tp, quals)
+                    in parser._declarations.items()]),
+            sorted(parser._int_constants.items()))
+
+def test_fast_parser_same_result(monkeypatch):
+    from cffi import cparser
+    for csource in FAST_PARSER_SOURCES:
+        results = []
+        for use_fast_parser in [True, False]:
+            monkeypatch.setattr(cparser, '_use_fast_parser', use_fast_parser)
+            parser = cparser.Parser()
+            parser.parse(csource)
+            results.append(_describe_declarations(parser))
+        assert results[0] == results[1]
+
+def test_fast_parser_subset():
+    from cffi import cparser
+    from cffi.cparser import _preprocess, _fast_cparser, CDEF_SOURCE_STRING
+    if not _fast_cparser.enabled:
+        pytest.skip("this version of pycparser is too old")
+    def fast_parse(csource, typenames=()):
+        csource = _preprocess(csource)[0]
+        return _fast_cparser.parse(csource, set(typenames), CDEF_SOURCE_STRING)
+    for csource in FAST_PARSER_SOURCES:
+        assert fast_parse(csource, ['size_t', 'int32_t', 'FILE', 'bool'])
+    # not in the subset: left to pycparser
+    for csource in ["int f(void) { return 0; }",
+                    "int a[2 + 3];",
+                    "static const char c = 'x';",
+                    "static const double d = 1.5;",
+                    "#pragma foo\nint x;",
+                    "int f(size_t);",          # unknown type name
+                    "typedef int t; int t;",
+                    "typedef int t; void f(int t);",
+                    "inline int f(void);",
+                    "float _Complex z;",
+                    "enum { A B };",
+                    "int x"]:
+        assert fast_parse(csource) is None
+    # the line numbers are the same as with pycparser
+    decls = fast_parse("int a;\n\nstruct s {\n  int b;\n};\n")
+    assert [decl.coord.line for decl in decls] == [1, 3]
+    assert decls[1].type.decls[0].coord.line == 4
+    assert decls[1].coord.file == CDEF_SOURCE_STRING
@@ -1606,6 +1606,57 @@ def test_callback_in_thread():
     result = g.wait()
     assert result == 0
 
+def test_deferred_callback_in_threads():
+    if sys.platform == 'win32':
+        pytest.skip("pthread only")
+    ffi = FFI()
+    ffi.cdef("""
+        struct pt_s { short x; double y; };
+        int run_threads(void (*cb)(int, struct pt_s, long long), int n);
+    """)
+    lib = ffi.verify("""
+        #include <pthread.h>
+        struct pt_s { short x; double y; };
+        struct job_s { void (*cb)(int, struct pt_s, long long); int t, n; };
+        static void *worker(void *arg) {
+            struct job_s *job = (struct job_s *)arg;
+            int i;
+            for (i = 0; i < job->n; i++) {
+                struct pt_s pt = { (short)i, i * 0.5 };
+                job->cb(job->t, pt, (long long)i << 33);
+            }
+            return NULL;
+        }
+        int run_threads(void (*cb)(int, struct pt_s, long long), int n) {
+            pthread_t th[4];
+            struct job_s jobs[4];
+            int t;
+            for (t = 0; t < 4; t++) {
+                jobs[t].cb = cb; jobs[t].t = t; jobs[t].n = n;
+                if (pthread_create(&th[t], NULL, worker, &jobs[t]) != 0)
+                    return -1;
+            }
+            for (t = 0; t < 4; t++)
+                pthread_join(th[t], NULL);
+            return 0;
+        }
+    """, extra_link_args=['-lpthread'])
+    seen = {0: [], 1: [], 2: [], 3: []}
+    @ffi.callback("void(*)(int, struct pt_s, long long)", deferred=True)
+    def cb(t, pt, big):
+        assert big == pt.x << 33
+        seen[t].append((pt.x, pt.y))
+    assert lib.run_threads(cb, 1000) == 0
+    ffi.drain_callbacks()
+    for t in range(4):
+        assert seen[t] == [(i, i * 0.5) for i in range(1000)]
+    assert ffi.drain_callbacks() == 0
+    #
+    pytest.raises(TypeError, ffi.callback, "int(*)(int)", lambda n: n,
+                  deferred=True)
+    pytest.raises(TypeError, ffi.callback, "void(*)(int)", lambda n: None,
+                  error=42, deferred=True)
+
 def test_keepalive_lib():
     ffi = FFI()
     ffi.cdef("int foobar(void);")
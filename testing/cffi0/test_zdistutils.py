@@ -285,6 +285,51 @@ class DistUtilsTest:
         assert ffi.verifier.sourcefilename == fn1
         assert ffi.verifier.modulefilename == fn2
 
+    def test_strong_hash_in_modulename(self):
+        ffi = FFI()
+        ffi.cdef("double sin(double x);")
+        v1 = Verifier(ffi, "#include <math.h>\n/*a*/",
+                      force_generic_engine=self.generic)
+        v2 = Verifier(ffi, "#include <math.h>\n/*b*/",
+                      force_generic_engine=self.generic)
+        name1 = v1.get_module_name()
+        name2 = v2.get_module_name()
+        assert name1 != name2
+        assert len(name1) == len(name2) >= len('_cffi__') + 32
+
+    @pytest.mark.skipif("sys.platform == 'win32'")
+    def test_concurrent_verify(self):
+        # several processes call verify() on the same module at the same
+        # time: exactly one of them compiles it
+        import subprocess, textwrap
+        tmpdir = udir / ('concurrent_verify_%d' % (self.generic,))
+        script = textwrap.dedent("""
+            import sys, time
+            from cffi import FFI
+            ffi = FFI()
+            ffi.cdef("int test_concurrent(int);")
+            start = float(sys.argv[1])
+            while time.time() < start:
+                time.sleep(0.01)
+            lib = ffi.verify("int test_concurrent(int x) { return x + 1; }",
+                             tmpdir=%r, force_generic_engine=%r)
+            assert lib.test_concurrent(41) == 42
+            print(ffi.verifier._has_source)
+        """ % (str(tmpdir), self.generic))
+        import time
+        start = str(time.time() + 2.0)
+        env = os.environ.copy()
+        rootdir = os.path.dirname(os.path.dirname(os.path.abspath(
+            __import__('cffi').__file__)))
+        env['PYTHONPATH'] = os.pathsep.join(
+            [rootdir] + [p for p in [env.get('PYTHONPATH')] if p])
+        procs = [subprocess.Popen([sys.executable, '-c', script, start],
+                                  stdout=subprocess.PIPE, env=env)
+                 for i in range(6)]
+        outputs = [proc.communicate()[0].decode().strip() for proc in procs]
+        assert [proc.returncode for proc in procs] == [0] * 6
+        assert sorted(outputs) == ['False'] * 5 + ['True']
+
 
 class TestDistUtilsCPython(DistUtilsTest):
     generic = False
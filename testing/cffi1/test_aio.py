@@ -0,0 +1,231 @@
+import os, sys, signal, threading
+import pytest
+import _cffi_backend as _cffi1_backend
+from cffi import FFI
+
+pytestmark = pytest.mark.skipif("sys.platform == 'win32'")
+
+
+def run(coro):
+    import asyncio
+    return asyncio.run(coro)
+
+def test_async_callback_from_threads():
+    from cffi.aio import AsyncCallback
+    ffi = _cffi1_backend.FFI()
+
+    async def main():
+        ac = AsyncCallback(ffi, "void(*)(int, int)")
+        def worker(t):
+            for i in range(100):
+                ac.callback(t, i)     # releases the GIL around the call
+        threads = [threading.Thread(target=worker, args=(t,))
+                   for t in range(4)]
+        for th in threads:
+            th.start()
+        got = [await ac.get() for i in range(400)]
+        for th in threads:
+            th.join()
+        assert ac.pending() == 0
+        return got
+
+    got = run(main())
+    for t in range(4):
+        assert [i for (t1, i) in got if t1 == t] == list(range(100))
+
+def test_async_callback_iter():
+    from cffi.aio import AsyncCallback
+    ffi = FFI()
+    ffi.cdef("struct point_s { int x, y; };")
+
+    async def main():
+        ac = AsyncCallback(ffi, "void(*)(struct point_s)")
+        p = ffi.new("struct point_s *", [5, 6])
+        ac.callback(p[0])
+        p.x = 7
+        ac.callback(p[0])
+        result = []
+        async for (pt,) in ac:
+            result.append((pt.x, pt.y))
+            if len(result) == 2:
+                break
+        return result
+
+    assert run(main()) == [(5, 6), (7, 6)]
+
+def run_in_thread(func):
+    # not in the main thread, which would also do the queued calls
+    # when it runs CPython's pending calls
+    result = []
+    th = threading.Thread(target=lambda: result.append(func()))
+    th.start()
+    th.join()
+    assert len(result) == 1
+    return result[0]
+
+def test_async_callback_second_loop():
+    from cffi.aio import AsyncCallback
+    ffi = _cffi1_backend.FFI()
+
+    async def main():
+        ac = AsyncCallback(ffi, "void(*)(int)")
+        th = threading.Thread(target=ac.callback, args=(42,))
+        th.start()
+        th.join()
+        return await ac.get()
+
+    def two_loops():
+        import asyncio
+        loop1 = asyncio.new_event_loop()
+        try:
+            assert loop1.run_until_complete(main()) == (42,)
+            # 'loop1' is still open, but not running
+            return run(asyncio.wait_for(main(), 10))
+        finally:
+            loop1.close()
+
+    assert run_in_thread(two_loops) == (42,)
+
+def test_async_callback_must_return_void():
+    from cffi.aio import AsyncCallback
+    ffi = _cffi1_backend.FFI()
+
+    async def main():
+        AsyncCallback(ffi, "int(*)(int)")
+
+    pytest.raises(TypeError, run, main())
+
+def test_offload():
+    from cffi.aio import offload
+    ffi = FFI()
+    ffi.cdef("size_t strlen(const char *); int usleep(unsigned int);")
+    lib = ffi.dlopen(None)
+
+    async def main():
+        assert await offload(lib.strlen, b"hello") == 5
+        # a list is converted to a temporary array, kept alive by offload()
+        assert await offload(lib.strlen, [b"a", b"b", b"\0"]) == 2
+        await offload(lib.usleep, 1000)
+
+    run(main())
+
+def test_offload_concurrent():
+    import asyncio
+    from cffi.aio import offload, configure_offload
+    from testing.cffi1.test_recompiler import verify
+    ffi = FFI()
+    ffi.cdef("int wait_for_all(int);")
+    # each call waits until 'n' calls have started, and returns 0 if it
+    # gives up after 10 seconds
+    lib = verify(ffi, "test_offload_concurrent", """
+        #include <pthread.h>
+        #include <time.h>
+        static pthread_mutex_t mutex = PTHREAD_MUTEX_INITIALIZER;
+        static pthread_cond_t cond = PTHREAD_COND_INITIALIZER;
+        static int started = 0;
+        static int wait_for_all(int n) {
+            struct timespec deadline;
+            int result = 1;
+            clock_gettime(CLOCK_REALTIME, &deadline);
+            deadline.tv_sec += 10;
+            pthread_mutex_lock(&mutex);
+            started++;
+            pthread_cond_broadcast(&cond);
+            while (started < n) {
+                if (pthread_cond_timedwait(&cond, &mutex, &deadline) != 0) {
+                    result = 0;
+                    break;
+                }
+            }
+            pthread_mutex_unlock(&mutex);
+            return result;
+        }
+    """)
+
+    async def main():
+        return await asyncio.gather(*[offload(lib.wait_for_all, 8)
+                                      for i in range(8)])
+
+    configure_offload(max_threads=8)
+    try:
+        assert run(main()) == [1] * 8
+    finally:
+        configure_offload(max_threads=4)
+
+def test_offload_second_loop():
+    import asyncio
+    from cffi.aio import offload
+    ffi = FFI()
+    ffi.cdef("int usleep(unsigned int);")
+    lib = ffi.dlopen(None)
+
+    async def main():
+        return await offload(lib.usleep, 100000)
+
+    def two_loops():
+        loop1 = asyncio.new_event_loop()
+        try:
+            assert loop1.run_until_complete(main()) == 0
+            # 'loop1' is still open, but not running
+            return run(asyncio.wait_for(main(), 10))
+        finally:
+            loop1.close()
+
+    assert run_in_thread(two_loops) == 0
+
+@pytest.mark.skipif("not hasattr(os, 'fork')")
+def test_offload_after_fork():
+    import asyncio
+    from cffi.aio import offload
+    ffi = FFI()
+    ffi.cdef("int usleep(unsigned int);")
+    lib = ffi.dlopen(None)
+
+    async def main():
+        return await offload(lib.usleep, 1000)
+
+    assert run(main()) == 0       # starts a worker thread
+    pid = os.fork()
+    if pid == 0:
+        try:
+            signal.alarm(10)
+            status = 0 if run(main()) == 0 else 1
+        except BaseException:
+            status = 2
+        os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+def test_offload_bad_arguments():
+    from cffi.aio import offload
+    ffi = FFI()
+    ffi.cdef("size_t strlen(const char *);")
+    lib = ffi.dlopen(None)
+
+    async def main():
+        with pytest.raises(TypeError):
+            await offload(lib.strlen, 42)
+        with pytest.raises(TypeError):
+            await offload(lib.strlen)
+        with pytest.raises(TypeError):
+            await offload(len, b"foo")
+
+    run(main())
+
+def test_offload_api_mode():
+    from cffi.aio import offload
+    from testing.cffi1.test_recompiler import verify
+    ffi = FFI()
+    ffi.cdef("struct pt { int x, y; }; struct pt add_pt(struct pt, int);")
+    lib = verify(ffi, "test_offload_api_mode", """
+        struct pt { int x, y; };
+        static struct pt add_pt(struct pt p, int n) {
+            p.x += n; p.y += n; return p;
+        }
+    """)
+
+    async def main():
+        p = await offload(lib.add_pt, [10, 20], 5)
+        return (p.x, p.y)
+
+    assert run(main()) == (15, 25)
@@ -4,6 +4,7 @@ The command line is the tool's only public interface, so these
 tests drive it exclusively through subprocesses.
 """
 
+import json
 import os
 import shutil
 import subprocess
@@ -174,6 +175,128 @@ def test_read_sources(tmp_path, run_cffi_gen_src):
     assert "PyInit" in generated or "_cffi_f_" in generated
 
 
+def _read_depfile(path):
+    lines = path.read_text().split(" \\\n")
+    return lines[0], [line.strip() for line in lines[1:]]
+
+
+def test_exec_python_depfile(tmp_path, run_cffi_gen_src):
+    (tmp_path / "helper.py").write_text("HEADER = '#include \"square.h\"'\n")
+    (tmp_path / "squared.cdef.txt").write_text("int square(int n);\n")
+    pyfile = tmp_path / "_squared_build.py"
+    pyfile.write_text("""\
+import os
+from cffi import FFI
+from helper import HEADER
+
+ffibuilder = FFI()
+with open(os.path.join(os.path.dirname(__file__), "squared.cdef.txt")) as f:
+    ffibuilder.cdef(f.read())
+ffibuilder.set_source("squared._squared", HEADER)
+""")
+    output = tmp_path / "out.c"
+    depfile = tmp_path / "out.c.d"
+    args = ("exec-python", "--depfile", str(depfile), str(pyfile), str(output))
+    proc = run_cffi_gen_src(*args)
+    assert proc.returncode == 0, proc.stderr
+    assert "square" in output.read_text()
+    target, deps = _read_depfile(depfile)
+    assert target == str(output) + ":"
+    assert sorted(deps) == sorted(str(tmp_path / name) for name in [
+        "helper.py", "squared.cdef.txt", "_squared_build.py"])
+    # nothing changed: the output is not written again
+    os.utime(output, (0, 0))
+    proc = run_cffi_gen_src(*args)
+    assert proc.returncode == 0, proc.stderr
+    assert output.stat().st_mtime == 0
+    # the cdef changed
+    (tmp_path / "squared.cdef.txt").write_text("int square(int n, int m);\n")
+    proc = run_cffi_gen_src(*args)
+    assert proc.returncode == 0, proc.stderr
+    assert output.stat().st_mtime != 0
+    assert "square(x0, x1)" in output.read_text()
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_batch(tmp_path, run_cffi_gen_src, jobs):
+    (tmp_path / "helper.py").write_text("HEADER = '#include \"square.h\"'\n")
+    for name in ["a", "b"]:
+        (tmp_path / ("%s_build.py" % name)).write_text("""\
+from cffi import FFI
+from helper import HEADER
+
+ffibuilder = FFI()
+ffibuilder.cdef("int square_%s(int n);")
+ffibuilder.set_source("squared._%s", HEADER)
+""" % (name, name))
+    (tmp_path / "c.cdef.txt").write_text("int square_c(int n);\n")
+    (tmp_path / "c.csrc.c").write_text('#include "square.h"\n')
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps([
+        {"mode": "exec-python", "pyfile": str(tmp_path / "a_build.py"),
+         "output": str(tmp_path / "a.c"), "depfile": str(tmp_path / "a.d")},
+        {"mode": "exec-python", "pyfile": str(tmp_path / "b_build.py"),
+         "output": str(tmp_path / "b.c"), "depfile": str(tmp_path / "b.d")},
+        {"mode": "read-sources", "module_name": "squared._c",
+         "cdef": str(tmp_path / "c.cdef.txt"),
+         "csrc": str(tmp_path / "c.csrc.c"),
+         "output": str(tmp_path / "c.c"), "depfile": str(tmp_path / "c.d")},
+    ]))
+    proc = run_cffi_gen_src("batch", "-j", jobs, str(manifest))
+    assert proc.returncode == 0, proc.stderr
+    for name in ["a", "b", "c"]:
+        assert "square_%s" % name in (tmp_path / ("%s.c" % name)).read_text()
+    # every build script that imports 'helper' depends on it, even if
+    # they run in the same process
+    for name in ["a", "b"]:
+        target, deps = _read_depfile(tmp_path / ("%s.d" % name))
+        assert sorted(deps) == sorted(str(tmp_path / name) for name in [
+            "helper.py", "%s_build.py" % name, "manifest.json"])
+    target, deps = _read_depfile(tmp_path / "c.d")
+    assert sorted(deps) == sorted(str(tmp_path / name) for name in [
+        "c.cdef.txt", "c.csrc.c", "manifest.json"])
+    #
+    for name in ["a", "b", "c"]:
+        os.utime(tmp_path / ("%s.d" % name), (2000000000, 2000000000))
+    (tmp_path / "b_build.py").write_text(
+        (tmp_path / "b_build.py").read_text().replace("square_b", "cube_b"))
+    os.utime(tmp_path / "b_build.py", (2000000001, 2000000001))
+    proc = run_cffi_gen_src("batch", "-j", jobs, str(manifest))
+    assert proc.returncode == 0, proc.stderr
+    # only 'b' was generated again
+    assert (tmp_path / "a.d").stat().st_mtime == 2000000000
+    assert (tmp_path / "b.d").stat().st_mtime != 2000000000
+    assert (tmp_path / "c.d").stat().st_mtime == 2000000000
+    assert "cube_b" in (tmp_path / "b.c").read_text()
+    # --force
+    proc = run_cffi_gen_src("batch", "--force", str(manifest))
+    assert proc.returncode == 0, proc.stderr
+    assert (tmp_path / "a.d").stat().st_mtime != 2000000000
+
+
+def test_batch_errors(tmp_path, run_cffi_gen_src):
+    (tmp_path / "bad_build.py").write_text("raise ValueError('oops')\n")
+    (tmp_path / "good_build.py").write_text(SIMPLE_SCRIPT)
+    manifest = tmp_path / "manifest.json"
+    manifest.write_text(json.dumps([
+        {"mode": "exec-python", "pyfile": str(tmp_path / "bad_build.py"),
+         "output": str(tmp_path / "bad.c")},
+        {"mode": "exec-python", "pyfile": str(tmp_path / "good_build.py"),
+         "output": str(tmp_path / "good.c")},
+    ]))
+    proc = run_cffi_gen_src("batch", str(manifest))
+    assert proc.returncode == 1
+    assert "ValueError: oops" in proc.stderr
+    assert "1 of the modules failed" in proc.stderr
+    assert "square" in (tmp_path / "good.c").read_text()
+    assert not (tmp_path / "bad.c").exists()
+    #
+    manifest.write_text(json.dumps([{"mode": "exec-python"}]))
+    proc = run_cffi_gen_src("batch", str(manifest))
+    assert proc.returncode == 2
+    assert "entry 0: missing 'pyfile'" in proc.stderr
+
+
 def test_read_sources_same_input_fails(run_cffi_gen_src):
     proc = run_cffi_gen_src("read-sources", "_squared", "-", "-", "-")
     assert proc.returncode != 0
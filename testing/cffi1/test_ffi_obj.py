@@ -167,6 +167,79 @@ def test_ffi_callback_onerror():
     pytest.raises(TypeError, ffi.callback, "int(int)",
                    lambda x: x, onerror=42)   # <- not callable
 
+def test_ffi_callback_deferred():
+    ffi = _cffi1_backend.FFI()
+    seen = []
+    cb = ffi.callback("void(int, double)", lambda *a: seen.append(a),
+                      deferred=True)
+    for i in range(5):
+        cb(i, i / 2)
+    ffi.drain_callbacks()
+    assert seen == [(i, i / 2) for i in range(5)]
+    # pending calls are discarded, with a warning, if the callback is
+    # freed.  This is done in another thread, because the main thread
+    # could do the pending calls at any point.
+    del seen[:]
+    def free_callback():
+        cb_list[0](42, 0.0)
+        cb_list.pop()
+    cb_list = [cb]
+    del cb
+    import gc, threading, warnings
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter("always")
+        th = threading.Thread(target=free_callback)
+        th.start()
+        th.join()
+        gc.collect()
+    assert seen == []
+    assert len(w) == 1
+    assert w[0].category is RuntimeWarning
+    assert "1 queued call(s)" in str(w[0].message)
+    assert ffi.drain_callbacks() == 0
+
+def test_ffi_callback_deferred_freed_while_draining():
+    # a deferred callback that frees another one whose calls are already
+    # being drained: these calls are still done
+    ffi = _cffi1_backend.FFI()
+    seen = []
+    def f1(x):
+        seen.append(('f1', x))
+        del holder['cb2']
+        gc.collect()
+        ffi.new("char[]", 1000)
+    holder = {}
+    cb1 = ffi.callback("void(int)", f1, deferred=True)
+    holder['cb2'] = ffi.callback("void(int)", lambda x: seen.append(('f2', x)),
+                                 deferred=True)
+    def make_calls():
+        cb1(1)
+        holder['cb2'](2)
+    import gc, threading
+    th = threading.Thread(target=make_calls)
+    th.start()
+    th.join()
+    ffi.drain_callbacks()
+    assert seen == [('f1', 1), ('f2', 2)]
+    assert holder == {}
+
+def test_ffi_callback_cache():
+    ffi = _cffi1_backend.FFI()
+    f = lambda x: x + 42
+    cb = ffi.callback_cache("int(int)", f)
+    assert cb(10) == 52
+    assert ffi.callback_cache("int(*)(int)", f) is cb
+    assert ffi.callback_cache("int(int)", f, error=-66) is not cb
+    assert ffi.callback_cache("int(int)", f, onerror=print) is not cb
+    # unhashable arguments: still works, but not cached
+    g = ffi.callback_cache("int(int)", f, onerror=[].append)
+    assert g(10) == 52
+    # only the most recent callbacks are kept
+    for i in range(300):
+        ffi.callback_cache("int(int)", lambda x: x)
+    assert ffi.callback_cache("int(int)", f) is not cb
+    pytest.raises(TypeError, ffi.callback_cache, "int(int)", 42)
+
 def test_ffi_getctype():
     ffi = _cffi1_backend.FFI()
     assert ffi.getctype("int") == "int"
@@ -206,6 +279,25 @@ def test_handle_unique():
     assert ffi.new_handle(None) is not ffi.new_handle(None)
     assert ffi.new_handle(None) != ffi.new_handle(None)
 
+def test_handle_table():
+    ffi = _cffi1_backend.FFI()
+    table = ffi.handle_table()
+    objs = [[i] for i in range(100)]
+    handles = [table.add(x) for x in objs]
+    assert len(set(handles)) == 100
+    for x, h in zip(objs, handles):
+        assert table.get(h) is x
+    for h in handles[::2]:
+        table.remove(h)
+    assert len(table) == 50
+    for i, h in enumerate(handles):
+        if i % 2:
+            assert table.get(h) == [i]
+        else:
+            pytest.raises(ValueError, table.get, h)
+    more = [table.add(None) for i in range(50)]
+    assert not set(more) & set(handles)
+
 def test_ffi_cast():
     ffi = _cffi1_backend.FFI()
     assert ffi.cast("int(*)(int)", 0) == ffi.NULL
@@ -272,6 +364,64 @@ def test_ffi_from_buffer():
     pytest.raises((TypeError, BufferError), ffi.from_buffer, b"abcd",
                                              require_writable=True)
 
+def test_ffi_map_file():
+    from testing.udir import udir
+    fn = str(udir / 'test_ffi_map_file.bin')
+    with open(fn, 'wb') as f:
+        f.write(b"abcdefghij" * 1000)
+    ffi = _cffi1_backend.FFI()
+    p = ffi.map_file("char[]", fn)
+    assert len(p) == 10000
+    assert p[9999] == b"j"
+    q = ffi.map_file("char[3]", fn, offset=5001)
+    assert ffi.string(q, 3) == b"bcd"
+    c = ffi.map_file("char[]", fn, mode="c", length=10)
+    assert len(c) == 10
+    c[0] = b"X"
+    assert p[0] == b"a"
+    with ffi.map_file(ffi.typeof("char[]"), path=fn, mode="r+") as w:
+        w[1] = b"Y"
+        ffi.msync(w)
+    assert p[1] == b"Y"
+    pytest.raises(ValueError, ffi.map_file, "char[]", fn, offset=-1)
+    pytest.raises(ValueError, ffi.map_file, "char[]", fn, length=0)
+    pytest.raises(ValueError, ffi.map_file, "char[20000]", fn)
+
+@pytest.mark.skipif("sys.platform == 'win32'")
+def test_ffi_new_shared():
+    import os
+    name = "cffi-test-ffi-new-shared-%d" % os.getpid()
+    ffi = _cffi1_backend.FFI()
+    a = ffi.new_shared("short[]", name, [10, 20, 30])
+    assert ffi.typeof(a) is ffi.typeof("short[]")
+    assert len(a) == 3
+    b = ffi.open_shared("short[]", "/" + name, readonly=True)
+    assert list(b) == [10, 20, 30]
+    a[1] = -1
+    assert b[1] == -1
+    pytest.raises(TypeError, ffi.new_shared, "short[]", name + "x", ["?"])
+    pytest.raises(FileNotFoundError, ffi.open_shared, "char[]", name + "x")
+    del a
+    import gc; gc.collect()
+    pytest.raises(FileNotFoundError, ffi.open_shared, "char[]", name)
+    assert b[2] == 30     # still mapped here
+
+def test_ffi_gc_batch():
+    ffi = _cffi1_backend.FFI()
+    seen = []
+    @ffi.callback("void(*)(int *)")
+    def destructor(p):
+        seen.append(p[0])
+    a = ffi.new("int[]", [5, 6])
+    q = ffi.gc(a + 1, destructor, batch=True)
+    assert ffi.typeof(q) is ffi.typeof("int *")
+    del q
+    ffi.gc_flush()
+    assert seen == [6]
+    pytest.raises(TypeError, ffi.gc, a, destructor, batch=True)
+    f = ffi.cast("void(*)(int *, int)", 0)
+    pytest.raises(TypeError, ffi.gc, a + 0, f, batch=True)
+
 def test_memmove():
     ffi = _cffi1_backend.FFI()
     p = ffi.new("short[]", [-1234, -2345, -3456, -4567, -5678])
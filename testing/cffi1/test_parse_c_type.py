@@ -377,3 +377,36 @@ def test_stdcall_cdecl():
     parse_error("__cdecl int", "identifier expected", 0)
     parse_error("int __stdcall", "expected '('", 13)
     parse_error("int __cdecl", "expected '('", 11)
+
+def test_name_index():
+    from cffi.recompiler import _make_name_index
+    inputs = ["struct %s" % (name,) for name in struct_names + ["foo_s2"]]
+    inputs += ["enum %s" % (name,) for name in enum_names + ["efoo_s2"]]
+    inputs += identifier_names + ["id5"]
+    inputs += ["int[%s]" % (name,) for name in global_names + ["SIX"]]
+    def parse_all():
+        result = []
+        for input in inputs:
+            try:
+                result.append(parse(input))
+            except ParseError as e:
+                result.append(e.args)
+        return result
+    expected = parse_all()
+    index = ffi.new("struct _cffi_name_index_s *")
+    keepalive = []
+    for field, names in [("globals", global_names),
+                         ("struct_unions", struct_names),
+                         ("enums", enum_names),
+                         ("typenames", identifier_names)]:
+        slots = ffi.new("int[]", _make_name_index(names))
+        keepalive.append(slots)
+        setattr(index, field, slots)
+        setattr(index, field + "_mask", len(slots) - 1)
+    ctx.name_index = index
+    ctx.flags |= lib._CFFI_CTX_NAME_INDEX
+    try:
+        assert parse_all() == expected
+    finally:
+        ctx.flags &= ~lib._CFFI_CTX_NAME_INDEX
+        ctx.name_index = ffi.NULL
@@ -1853,6 +1853,55 @@ def test_extern_python_plus_c():
     assert lib.bar(100) == 6300
     assert lib.call_me(100) == -2100
 
+def test_extern_python_reentrant():
+    ffi = FFI()
+    ffi.cdef("""
+        extern "Python" int step(int);
+        int loop(int);
+    """)
+    lib = verify(ffi, 'test_extern_python_reentrant', """
+        #include <errno.h>
+        static int step(int);
+        static int loop(int n) {
+            int i, total = 0;
+            for (i = 0; i < n; i++) {
+                total += step(n);
+                if (errno != 42 + n)
+                    return -1;
+            }
+            return total;
+        }
+    """)
+    #
+    seen = []
+    @ffi.def_extern()
+    def step(n):
+        # nested calls into C and back, and calls in other threads
+        seen.append(n)
+        if n > 1:
+            assert lib.loop(n - 1) == n - 1
+            assert ffi.addressof(lib, 'loop')(n - 1) == n - 1
+        ffi.errno = 42 + n
+        return 1
+    assert lib.loop(3) == 3
+    assert lib.loop(1) == 1
+    assert ffi.addressof(lib, 'loop')(3) == 3
+    #
+    import threading
+    errors = []
+    def run():
+        try:
+            for i in range(20):
+                assert lib.loop(3) == 3
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
 def test_introspect_function():
     ffi = FFI()
     ffi.cdef("float f1(double);")
@@ -2595,3 +2644,230 @@ def test_large_enum():
         relements[biglist[i]] = i
     assert e.elements == elements
     assert e.relements == relements
+
+def test_realize_types_in_threads():
+    import threading
+    ffi = FFI()
+    source = "".join("struct s%d { int a; struct s%d *next; };\n" % (i, i + 1)
+                     for i in range(50))
+    ffi.cdef(source + "struct s50 { int a; };")
+    lib = verify(ffi, 'test_realize_types_in_threads',
+                 source + "struct s50 { int a; };")
+    errors = []
+    barrier = threading.Barrier(8)
+    def run(k):
+        try:
+            barrier.wait()
+            for i in range(51):
+                j = (i + k * 7) % 51
+                p = ffi.new("struct s%d *" % j)
+                p.a = j
+                assert p.a == j
+                assert ffi.typeof(p[0]).fields[0][0] == 'a'
+                q = ffi.new("struct s%d[]" % j, 4)
+                assert len(q[1:3]) == 2
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+
+def test_name_index():
+    # more than NAME_INDEX_MIN_SIZE names: looked up with a hash table
+    n = 100
+    cdef = "".join("int f%d(int); struct s%d { int a; }; "
+                   "typedef int t%d; enum e%d { E%d };\n" % (i, i, i, i, i)
+                   for i in range(n))
+    ffi = FFI()
+    ffi.cdef(cdef)
+    c_file = str(udir / 'test_name_index_emit.c')
+    recompiler.make_c_source(ffi, "test_name_index_emit", "", c_file)
+    with open(c_file) as f:
+        c_source = f.read()
+    for name in ['global', 'struct_union', 'enum', 'typename']:
+        assert '_cffi_%ss_index[]' % name in c_source
+    #
+    ffi = FFI()
+    ffi.cdef(cdef)
+    lib = verify(ffi, "test_name_index",
+                 "".join("static int f%d(int x) { return x + %d; } "
+                         "struct s%d { int a; }; typedef int t%d; "
+                         "enum e%d { E%d = %d };\n" % (i, i, i, i, i, i, i)
+                         for i in range(n)))
+    for i in range(n):
+        assert getattr(lib, "f%d" % i)(1000) == 1000 + i
+        assert getattr(lib, "E%d" % i) == i
+        assert ffi.integer_const("E%d" % i) == i
+        assert ffi.typeof("struct s%d" % i).fields[0][0] == "a"
+        assert ffi.typeof("t%d" % i) is ffi.typeof("int")
+        assert ffi.typeof("enum e%d" % i).kind == "enum"
+    assert not hasattr(lib, "f%d" % n)
+    pytest.raises(ffi.error, ffi.typeof, "struct s%d" % n)
+    pytest.raises(ffi.error, ffi.typeof, "t%d" % n)
+
+def test_shards():
+    ffi = FFI()
+    ffi.cdef("""
+        struct point { int x, y; };
+        int f(int);
+        struct point g(struct point, int);
+        void h(void);
+        int add3(int, int, int);
+        int printf(const char *, ...);
+        extern int glob;
+        #define FORTY_TWO 42
+        extern "Python+C" int cb(int);
+    """)
+    lib = verify(ffi, "test_shards", """
+        #include <stdio.h>
+        struct point { int x, y; };
+        static int f(int x) { return x + 1; }
+        static struct point g(struct point p, int n) {
+            p.x += n; p.y += n; return p;
+        }
+        static int h_called = 0;
+        static void h(void) { h_called = 1; }
+        int cb(int);
+        static int add3(int a, int b, int c) { return cb(a + b + c); }
+        static int glob = 5;
+        #define FORTY_TWO 42
+    """, shards=3)
+    @ffi.def_extern()
+    def cb(n):
+        return n * 10
+    assert lib.f(41) == 42
+    p = lib.g([1, 2], 10)
+    assert (p.x, p.y) == (11, 12)
+    assert lib.h() is None
+    assert lib.add3(1, 2, 3) == 60
+    assert lib.glob == 5
+    assert lib.FORTY_TWO == 42
+    assert ffi.addressof(lib, 'f')(1) == 2
+    #
+    c_file = str(udir / '_CFFI_test_shards.c')
+    if not os.path.exists(c_file):
+        c_file = str(udir / '_CFFI_test_shards.cpp')
+    root, source_extension = os.path.splitext(c_file)
+    with open(root + '.cffi.h') as f:
+        assert '#define _CFFI_SHARDED' in f.read()
+    found = []
+    for i in range(1, 4):
+        with open('%s.%d%s' % (root, i, source_extension)) as f:
+            content = f.read()
+        assert content.startswith('#include "_CFFI_test_shards.cffi.h"\n')
+        found += [name for name in ['f', 'g', 'h', 'add3']
+                  if ('_cffi_f_%s(' % name) in content]
+    assert sorted(found) == ['add3', 'f', 'g', 'h']
+    with open(c_file) as f:
+        content = f.read()
+    assert '_cffi_f_f(' not in content
+    assert '_cffi_d_f(' in content
+
+def test_shards_static_state():
+    # the shards must not call their own copy of the static functions
+    ffi = FFI()
+    ffi.cdef("int counter; void incr(void); int get(void);")
+    lib = verify(ffi, "test_shards_static_state", """
+        static int counter;
+        static void incr(void) { counter++; }
+        static int get(void) { return counter; }
+    """, shards=2)
+    lib.incr()
+    lib.incr()
+    assert lib.counter == 2
+    assert lib.get() == 2
+
+def test_shared_wrappers():
+    ffi = FFI()
+    ffi.cdef("""
+        struct point { int x, y; };
+        int f1(int); int f2(int);
+        struct point g1(struct point, int); struct point g2(struct point, int);
+        void h1(void); void h2(void);
+        int add3(int, int, int); int mul3(int, int, int);
+    """)
+    lib = verify(ffi, "test_shared_wrappers", """
+        struct point { int x, y; };
+        static int f1(int x) { return x + 1; }
+        static int f2(int x) { return x - 1; }
+        static struct point g1(struct point p, int n) {
+            p.x += n; p.y += n; return p;
+        }
+        static struct point g2(struct point p, int n) {
+            p.x -= n; p.y -= n; return p;
+        }
+        static int h_called = 0;
+        static void h1(void) { h_called += 1; }
+        static void h2(void) { h_called += 10; }
+        static int add3(int a, int b, int c) { return a + b + c; }
+        static int mul3(int a, int b, int c) { return a * b * c; }
+    """, shared_wrappers=True)
+    assert lib.f1(41) == 42
+    assert lib.f2(41) == 40
+    p = lib.g1([1, 2], 10)
+    assert (p.x, p.y) == (11, 12)
+    p = lib.g2([1, 2], 10)
+    assert (p.x, p.y) == (-9, -8)
+    assert lib.h1() is None
+    assert lib.h2() is None
+    assert lib.add3(2, 3, 4) == 9
+    assert lib.mul3(2, 3, 4) == 24
+    e = pytest.raises(TypeError, lib.mul3, 1, 2)
+    assert str(e.value) == "mul3 expected 3 arguments, got 2"
+    pytest.raises(TypeError, lib.f2, "x")
+    assert ffi.addressof(lib, 'f2')(1) == 0
+    #
+    c_file = str(udir / '_CFFI_test_shared_wrappers.c')
+    if not os.path.exists(c_file):
+        c_file = str(udir / '_CFFI_test_shared_wrappers.cpp')
+    with open(c_file) as f:
+        content = f.read()
+    # one shared wrapper for each of the 4 function types
+    assert content.count('static PyObject *\n_cffi_w_') == 4
+
+def test_shared_wrappers_with_shards():
+    ffi = FFI()
+    ffi.cdef("int f1(int); int f2(int); int f3(int); int f4(int);")
+    lib = verify(ffi, "test_shared_wrappers_with_shards", """
+        static int f1(int x) { return x + 1; }
+        static int f2(int x) { return x + 2; }
+        static int f3(int x) { return x + 3; }
+        static int f4(int x) { return x + 4; }
+    """, shared_wrappers=True, shards=2)
+    assert [lib.f1(0), lib.f2(0), lib.f3(0), lib.f4(0)] == [1, 2, 3, 4]
+
+def test_parallel_compile_only_with_shards(monkeypatch):
+    from cffi import ffiplatform
+    seen = []
+    monkeypatch.setattr(ffiplatform, '_compile_sources_in_parallel',
+                        lambda cmd_obj, jobs: seen.append(jobs))
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    extra_c = udir / 'test_parallel_compile_extra.c'
+    extra_c.write_text("int extra_twice(int x) { return x * 2; }\n")
+    for shards in [1, 2]:
+        ffi = FFI()
+        ffi.cdef("int extra_twice(int); int f(int);")
+        lib = verify(ffi, "test_parallel_compile_%d" % shards, """
+            int extra_twice(int);
+            static int f(int x) { return x + 1; }
+        """, sources=[str(extra_c)], shards=shards)
+        assert lib.extra_twice(lib.f(20)) == 42
+    # only the build with shards=2 compiles its sources in parallel
+    assert seen == [4]
+
+def test_shards_invalid():
+    ffi = FFI()
+    pytest.raises(ValueError, ffi.set_source, "foo", "", shards=0)
+    pytest.raises(ValueError, ffi.set_source, "foo", "", shards="2")
+    ffi.set_source("foo", "", shards=2)
+    import io
+    pytest.raises(TypeError, ffi.emit_c_code, io.StringIO())
+    #
+    ffi = FFI()
+    ffi.embedding_api("int f(int);")
+    ffi.set_source("foo", "", shards=2)
+    pytest.raises(VerificationError, ffi.emit_c_code,
+                  str(udir / 'test_shards_invalid.c'))
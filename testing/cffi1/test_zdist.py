@@ -260,6 +260,159 @@ class TestDist:
                                         'mymod.c': None},
                 'Release': '?'})
 
+    def _count_build_ext(self, monkeypatch):
+        from cffi._shimmed_dist_utils import Distribution
+        seen = []
+        orig_run_command = Distribution.run_command
+        def run_command(dist, command):
+            seen.append(command)
+            return orig_run_command(dist, command)
+        monkeypatch.setattr(Distribution, 'run_command', run_command)
+        return seen
+
+    @chdir_to_tmp
+    def test_api_compile_cache_dir(self, monkeypatch):
+        seen = self._count_build_ext(monkeypatch)
+        cache_dir = str(self.udir / 'cache')
+        source = "int foo(int x) { return x + 42; }"
+        ffi = cffi.FFI()
+        ffi.cdef("int foo(int);")
+        ffi.set_source("mymod", source)
+        x1 = ffi.compile('build1', cache_dir=cache_dir)
+        assert seen == ['build_ext']
+        assert len(os.listdir(cache_dir)) == 1
+        # the same build in another directory: found in the cache
+        x2 = ffi.compile('build2', cache_dir=cache_dir)
+        assert seen == ['build_ext']
+        assert os.path.basename(x2) == os.path.basename(x1)
+        with open(x1, 'rb') as f1, open(x2, 'rb') as f2:
+            assert f1.read() == f2.read()
+        assert not os.path.exists(os.path.join('build2', 'mymod.o'))
+        self.run(['-c', 'import mymod; assert mymod.lib.foo(-2) == 40'],
+                 cwd='build2')
+        # a different source: not found
+        ffi = cffi.FFI()
+        ffi.cdef("int foo(int);")
+        ffi.set_source("mymod", source.replace('42', '43'))
+        ffi.compile('build3', cache_dir=cache_dir)
+        assert seen == ['build_ext', 'build_ext']
+        assert len(os.listdir(cache_dir)) == 2
+        # other options: not found
+        ffi.compile('build4', cache_dir=cache_dir, debug=True)
+        assert seen == ['build_ext'] * 3
+
+    @chdir_to_tmp
+    def test_api_compile_cache_dir_includes(self, monkeypatch):
+        seen = self._count_build_ext(monkeypatch)
+        cache_dir = str(self.udir / 'cache')
+        os.mkdir('inc')
+        with open(os.path.join('inc', 'foo.h'), 'w') as f:
+            f.write("#define FOO 42\n")
+        ffi = cffi.FFI()
+        ffi.cdef("#define FOO ...")
+        ffi.set_source("mymod", '#include "foo.h"',
+                       include_dirs=[os.path.abspath('inc')])
+        ffi.compile('build1', cache_dir=cache_dir)
+        ffi.compile('build2', cache_dir=cache_dir)
+        assert seen == ['build_ext']
+        with open(os.path.join('inc', 'foo.h'), 'w') as f:
+            f.write("#define FOO 43\n")
+        ffi.compile('build3', cache_dir=cache_dir)
+        assert seen == ['build_ext', 'build_ext']
+        self.run(['-c', 'import mymod; assert mymod.lib.FOO == 43'],
+                 cwd='build3')
+
+    @chdir_to_tmp
+    def test_api_compile_cache_dir_env(self, monkeypatch):
+        seen = self._count_build_ext(monkeypatch)
+        cache_dir = str(self.udir / 'cache')
+        monkeypatch.setenv('CFFI_BUILD_CACHE_DIR', cache_dir)
+        monkeypatch.setenv('CFFI_BUILD_CACHE_MAX_SIZE', '1')
+        for i in range(3):
+            ffi = cffi.FFI()
+            ffi.set_source("mymod", "int foo%d;" % i)
+            ffi.compile('build%d' % i)
+        assert seen == ['build_ext'] * 3
+        # the cache is over its maximum size: only the last entry is kept
+        assert len(os.listdir(cache_dir)) == 1
+        ffi.compile('build3')
+        assert seen == ['build_ext'] * 3
+        # cache_dir=None disables the cache
+        ffi.compile('build4', cache_dir=None)
+        assert seen == ['build_ext'] * 4
+
+    def _record_extra_args(self, monkeypatch):
+        from cffi import ffiplatform
+        seen = []
+        orig_build = ffiplatform._build
+        def _build(tmpdir, ext, *args):
+            seen.append(ext.extra_compile_args)
+            return orig_build(tmpdir, ext, *args)
+        monkeypatch.setattr(ffiplatform, '_build', _build)
+        return seen
+
+    @chdir_to_tmp
+    def test_api_compile_lto(self, monkeypatch):
+        seen = self._record_extra_args(monkeypatch)
+        ffi = cffi.FFI()
+        ffi.cdef("int foo(int);")
+        ffi.set_source("mymod", "int foo(int x) { return x + 42; }",
+                       extra_compile_args=['-O2'])
+        ffi.compile('build', lto=True)
+        if sys.platform == 'win32':
+            assert seen == [['-O2', '/GL']]
+        else:
+            assert seen == [['-O2', '-flto']]
+        self.run(['-c', 'import mymod; assert mymod.lib.foo(-2) == 40'],
+                 cwd='build')
+
+    @pytest.mark.skipif("not hasattr(os, 'fork')")
+    @chdir_to_tmp
+    def test_api_compile_pgo(self, monkeypatch):
+        seen = self._record_extra_args(monkeypatch)
+        ffi = cffi.FFI()
+        ffi.cdef("int foo(int);")
+        ffi.set_source("mymod", """
+            int foo(int x) { return x > 0 ? x + 42 : x - 42; }
+        """)
+        marker = os.path.abspath('trained')
+        def training(module):
+            for i in range(1000):
+                module.lib.foo(i)
+            with open(marker, 'w') as f:
+                f.write(str(os.getpid()))
+        x = ffi.compile('build', optimize='pgo', training=training)
+        with open(marker) as f:
+            assert int(f.read()) != os.getpid()
+        profile_dir = os.path.abspath(os.path.join('build', 'mymod.profile'))
+        assert os.listdir(profile_dir)
+        assert seen == [['-fprofile-generate=' + profile_dir],
+                        ['-fprofile-use=' + profile_dir,
+                         '-fprofile-correction', '-Wno-missing-profile']]
+        assert os.path.samefile(x, os.path.join('build', os.path.basename(x)))
+        self.run(['-c', 'import mymod; assert mymod.lib.foo(-2) == -44'],
+                 cwd='build')
+
+    @pytest.mark.skipif("not hasattr(os, 'fork')")
+    @chdir_to_tmp
+    def test_api_compile_pgo_errors(self):
+        from cffi import VerificationError
+        ffi = cffi.FFI()
+        ffi.cdef("int foo(int);")
+        ffi.set_source("mymod", "int foo(int x) { return x; }")
+        pytest.raises(ValueError, ffi.compile, optimize='speed')
+        pytest.raises(TypeError, ffi.compile, optimize='pgo')
+        pytest.raises(ValueError, ffi.compile, training=lambda module: None)
+        def training(module):
+            raise ValueError("training failed")
+        pytest.raises(VerificationError, ffi.compile, 'build',
+                      optimize='pgo', training=training)
+        ffi = cffi.FFI()
+        ffi.embedding_api("int bar(int);")
+        ffi.set_source("mymod", "")
+        pytest.raises(ValueError, ffi.compile, optimize='pgo',
+                      training=training)
+
     @chdir_to_tmp
     def test_api_distutils_extension_1(self):
         ffi = cffi.FFI()
@@ -420,3 +573,97 @@ class TestDist:
                                    'src1': {'pack3': {'__init__.py': None,
                                                       '_build.py': None,
                                                       'mymod.SO': None}}})
+
+    def _make_setuptools_api_many(self, n):
+        self._prepare_setuptools()
+        os.mkdir("src4")
+        os.mkdir(os.path.join("src4", "pack4"))
+        with open(os.path.join("src4", "pack4", "__init__.py"), "w") as f:
+            pass
+        for i in range(n):
+            with open(os.path.join("src4", "pack4", "_build%d.py" % i),
+                      "w") as f:
+                f.write("""if 1:
+                    import cffi
+                    ffi = cffi.FFI()
+                    ffi.cdef("struct s { int a, b; }; int f(int);"
+                             "typedef struct { int c; } t; extern t *g;")
+                    ffi.set_source("pack4.mod%d", '''
+                        struct s { int a, b; };
+                        static int f(int x) { return x + %d; }
+                        typedef struct { int c; } t;
+                        static t *g;
+                    ''', shards=%d)
+                    ffi._hi_there = %d
+                """ % (i, i, 1 + (i == 1), i))
+        with open(os.path.join("src4", "pack4", "_buildpy.py"), "w") as f:
+            f.write("""if 1:
+                import cffi
+                ffi = cffi.FFI()
+                ffi.cdef("int f(int);")
+                ffi.set_source("pack4.modpy", None)
+            """)
+        with open("setup.py", "w") as f:
+            f.write("""if 1:
+                from setuptools import setup
+                from distutils.command.build_ext import build_ext
+                import os
+
+                class TestBuildExt(build_ext):
+                    def pre_run(self, ext, ffi):
+                        assert ext.name == "pack4.mod%%d" %% ffi._hi_there
+
+                setup(name='example1',
+                      version='0.1',
+                      packages=['pack4'],
+                      package_dir={'': 'src4'},
+                      cffi_modules=["src4/pack4/_build%%d.py:ffi" %% i
+                                    for i in range(%d)] +
+                                   ["src4/pack4/_buildpy.py:ffi"],
+                      cmdclass=({'build_ext': TestBuildExt}
+                                if os.environ.get('TEST_PRE_RUN') else {}),
+                      )
+            """ % (n,))
+
+    def _read_generated_c_files(self, n):
+        result = {}
+        for root, dirs, files in os.walk('build'):
+            for fn in files:
+                if fn.endswith('.c'):
+                    with open(os.path.join(root, fn)) as f:
+                        result[fn] = f.read()
+        assert sorted(result) == sorted(['pack4.mod%d.c' % i
+                                         for i in range(n)] +
+                                        ['pack4.mod1.1.c', 'pack4.mod1.2.c'])
+        return result
+
+    @chdir_to_tmp
+    def test_setuptools_api_parallel(self, monkeypatch):
+        from cffi.setuptools_ext import _can_fork
+        if not _can_fork():
+            pytest.skip("needs fork()")
+        n = 4
+        self._make_setuptools_api_many(n)
+        monkeypatch.setenv('CFFI_BUILD_JOBS', '3')
+        self.run(["setup.py", "build_ext", "-i"])
+        parallel_sources = self._read_generated_c_files(n)
+        content = {'__init__.py': None, '_buildpy.py': None,
+                   'modpy.py': None}
+        for i in range(n):
+            content['_build%d.py' % i] = None
+            content['mod%d.SO' % i] = None
+        self.check_produced_files({'setup.py': None, 'build': '?',
+                                   'src4': {'pack4': content.copy()}})
+        self.run(['-c', 'import pack4.mod3, pack4.modpy; '
+                        'assert pack4.mod3.lib.f(10) == 13'], cwd='src4')
+        # the generated sources are the same as in a sequential build
+        rmtree('build')
+        monkeypatch.setenv('CFFI_BUILD_JOBS', '1')
+        self.run(["setup.py", "build_ext", "-i"])
+        assert self._read_generated_c_files(n) == parallel_sources
+        # the pre_run() hook still works
+        rmtree('build')
+        monkeypatch.setenv('CFFI_BUILD_JOBS', 'auto')
+        monkeypatch.setenv('TEST_PRE_RUN', '1')
+        self.run(["setup.py", "build_ext", "-i"])
+        assert self._read_generated_c_files(n) == parallel_sources
@@ -0,0 +1,17 @@
+#include <stdio.h>
+
+extern int precompiled_start(void);
+extern int mul2(int);
+
+
+int main(void)
+{
+    int x;
+    x = precompiled_start();
+    printf("started: %d\n", x);
+    x = precompiled_start();
+    printf("started again: %d\n", x);
+    x = mul2(21);
+    printf("got: %d\n", x);
+    return 0;
+}
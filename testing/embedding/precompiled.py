@@ -0,0 +1,25 @@
+import cffi
+
+ffi = cffi.FFI()
+
+ffi.embedding_api("""
+    int mul2(int);
+""")
+
+ffi.embedding_init_code(r"""
+    import sys
+    sys.stdout.write("init code\n")
+    sys.stdout.flush()
+
+    from _precompiled_cffi import ffi
+
+    @ffi.def_extern()
+    def mul2(x):
+        return x * 2
+""", precompile=True, start_function="precompiled_start")
+
+ffi.set_source("_precompiled_cffi", """
+""")
+
+fn = ffi.compile(verbose=True)
+print('FILENAME: %s' % (fn,))
@@ -0,0 +1,30 @@
+import cffi
+import importlib.util
+
+# pretend that the build is done by a different version of Python, whose
+# bytecode cannot be loaded: the init code is then compiled at runtime
+importlib.util.MAGIC_NUMBER = b'\xff\xff\r\n'
+
+ffi = cffi.FFI()
+
+ffi.embedding_api("""
+    int mul2(int);
+""")
+
+ffi.embedding_init_code(r"""
+    import sys
+    sys.stdout.write("init code\n")
+    sys.stdout.flush()
+
+    from _precompiled_badmagic_cffi import ffi
+
+    @ffi.def_extern()
+    def mul2(x):
+        return x * 2
+""", precompile=True, start_function="precompiled_start")
+
+ffi.set_source("_precompiled_badmagic_cffi", """
+""")
+
+fn = ffi.compile(verbose=True)
+print('FILENAME: %s' % (fn,))
@@ -0,0 +1,21 @@
+from testing.embedding.test_basic import EmbeddingTests
+
+
+class TestPrecompiled(EmbeddingTests):
+    def test_precompiled_init_code(self):
+        precompiled_cffi = self.prepare_module('precompiled')
+        self.compile('precompiled-test', [precompiled_cffi])
+        output = self.execute('precompiled-test')
+        assert output == ("init code\n"
+                          "started: 0\n"
+                          "started again: 0\n"
+                          "got: 42\n")
+
+    def test_precompiled_fallback_to_source(self):
+        precompiled_cffi = self.prepare_module('precompiled_badmagic')
+        self.compile('precompiled-test', [precompiled_cffi])
+        output = self.execute('precompiled-test')
+        assert output == ("init code\n"
+                          "started: 0\n"
+                          "started again: 0\n"
+                          "got: 42\n")